@@ -0,0 +1,131 @@
+"""crud の AsyncSession 版（DB_ASYNC=1 のとき app/async_routes.py から使う）
+
+毎リクエスト通るトークン解決と所有チェックは async のクエリで直接書き、それ以外は
+AsyncSession.run_sync で crud の同期関数をそのまま呼ぶ。run_sync はスレッドを使わず
+greenlet 上で動き、I/O は非同期ドライバに任せるので、クエリの中身を二重に持たずに済む。
+
+run_sync の中身はイベントループのスレッドで動くので、DB 以外のブロッキング処理（画像ファイルの
+削除、書き込みスレッドの完了待ち）は入れない。クイズ削除はコミットまでを run_sync で行い、
+ファイルの後始末は asyncio.to_thread に回す。
+"""
+from __future__ import annotations
+import asyncio
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import select, desc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from app import crud, models
+from app.database import SessionLocal
+from app.services import search, grading, response_cache, storage, user_cache
+from app.services.user_cache import token_cache
+from app.services.write_queue import writer
+
+# ---- User ----
+async def resolve_user_id(db: AsyncSession, token: str) -> Optional[int]:
+    uid = token_cache.get(token)
+    if uid is not None:
+        return uid
+    row = (await db.execute(user_cache.user_lookup_stmt(token))).first()
+    if row is None:
+        return None
+    now = datetime.utcnow()
+    if user_cache.needs_touch(row.last_seen_at, now):
+        await db.execute(user_cache.touch_stmt(row.id, now))
+        await db.commit()
+    token_cache.put(token, row.id)
+    return row.id
+
+async def user_matches(db: AsyncSession, user_id: int, token: str) -> bool:
+    u = models.User
+    return (await db.execute(select(u.id).where(u.id == user_id, u.token == token))).first() is not None
+
+async def get_or_create_user(db: AsyncSession, token: str) -> models.User:
+    return await db.run_sync(crud.get_or_create_user, token)
+
+# ---- Quiz ----
+async def get_quiz_owned(db: AsyncSession, quiz_id: int, user: models.User) -> Optional[models.Quiz]:
+    return (await db.execute(
+        select(models.Quiz).where(models.Quiz.id == quiz_id, models.Quiz.user_id == user.id)
+    )).scalar_one_or_none()
+
+async def create_quiz(db: AsyncSession, user: models.User, question: str, answer: str) -> models.Quiz:
+    if writer.enabled:
+        return await asyncio.wrap_future(writer.submit(crud._insert_quiz, user.id, question, answer))
+    return await db.run_sync(crud.create_quiz, user, question, answer)
+
+async def delete_quiz_owned(db: AsyncSession, quiz_id: int, user: models.User) -> bool:
+    paths = await db.run_sync(crud.delete_quiz_rows, quiz_id, user)
+    if paths is None:
+        return False
+    if paths:
+        # ファイルの削除はイベントループの外で（コミット済みなので別スレッド・別セッションで良い）
+        await asyncio.to_thread(_release_files, paths)
+    return True
+
+def _release_files(paths: List[str]) -> None:
+    db = SessionLocal()
+    try:
+        storage.release(db, paths)
+    finally:
+        db.close()
+
+async def list_quizzes_page(db: AsyncSession, user: models.User, q, order, offset, limit, status_filter, cursor=None) -> Tuple[List[dict], Optional[str]]:
+    return await db.run_sync(lambda s: crud.list_quizzes_page(s, user, q, order, offset, limit, status_filter, cursor=cursor))
+
+async def search_quizzes(db: AsyncSession, user: models.User, q: str, offset: int = 0, limit: int = 50) -> List[dict]:
+    return await db.run_sync(lambda s: search.search_quizzes(s, user, q, offset=offset, limit=limit))
+
+# ---- Image ----
+async def get_latest_image_by_quiz(db: AsyncSession, quiz: models.Quiz) -> Optional[models.GeneratedImage]:
+    # variants はレスポンスで使うので一緒に読む（async では遅延ロードできない）
+    return (await db.execute(
+        select(models.GeneratedImage)
+        .options(selectinload(models.GeneratedImage.variants))
+        .where(models.GeneratedImage.quiz_id == quiz.id)
+        .order_by(desc(models.GeneratedImage.created_at))
+        .limit(1)
+    )).scalar_one_or_none()
+
+# ---- Answer & Stats ----
+async def log_answer(db: AsyncSession, user: models.User, quiz: models.Quiz, user_answer: str, image_shown: bool) -> Tuple[bool, models.AnswerLog]:
+    correct = grading.grade(user_answer, quiz)
+    if writer.enabled:
+        # 書き込みスレッドの完了はイベントループを止めずに待つ
+        rec = await asyncio.wrap_future(writer.submit(crud._insert_answer, user.id, quiz.id, correct, user_answer, image_shown))
+        return correct, rec
+    rec = await db.run_sync(crud._insert_answer, user.id, quiz.id, correct, user_answer, image_shown)
+    await db.commit()
+    return correct, rec
+
+async def log_answers_batch(db: AsyncSession, user: models.User, items: Sequence, _retry: bool = True) -> List[dict]:
+    if not writer.enabled:
+        return await db.run_sync(crud.log_answers_batch, user, items)
+    results, new_logs = await db.run_sync(crud._plan_answers_batch, user, items)
+    if new_logs:
+        try:
+            await asyncio.wrap_future(writer.submit(crud._insert_answers_batch, user.id, new_logs))
+        except IntegrityError:
+            # crud.log_answers_batch と同じ（先にコミットされた再送は、読み直せば duplicate になる）
+            await db.rollback()
+            if not _retry:
+                raise
+            return await log_answers_batch(db, user, items, _retry=False)
+    return results
+
+async def get_data_version(db: AsyncSession, user: models.User) -> Optional[int]:
+    if user.id is None:
+        return None
+    return (await db.execute(response_cache.version_stmt(user.id))).scalar_one_or_none()
+
+async def get_stats_summary(db: AsyncSession, user: models.User):
+    return await db.run_sync(crud.get_stats_summary, user)
+
+async def get_quiz_stats(db: AsyncSession, user: models.User, offset: int = 0, limit: int = 200):
+    return await db.run_sync(crud.get_quiz_stats, user, offset, limit)
+
+async def get_review_queue(db: AsyncSession, user: models.User, limit: int = 20, include_new: bool = False):
+    return await db.run_sync(crud.get_review_queue, user, limit, include_new)
@@ -0,0 +1,183 @@
+"""主要ルートの async 版（DB_ASYNC=1 のとき run.py が routes.py の同名ルートと差し替える）
+
+回答・一覧・集計のようにリクエスト数の多いルートだけを AsyncSession で処理し、
+スレッドプールの大きさに縛られずに多数の同時接続をさばく。
+
+DB_ASYNC=1 でも次のルートは routes.py の同期 Session のまま（スレッドプールで DB を使う）:
+- POST /quiz/import（本文は async で読み、バッチの INSERT をスレッドで実行）
+- GET /export/answers（ストリーミングの各チャンクをスレッドで読む）
+- 画像: POST /quiz/image/generate、POST /quiz/image/jobs、GET /quiz/image/jobs/{id}
+  （生成はジョブのワーカースレッド。ルートは投入と状態の読み出しだけ）
+- /admin/images/pregenerate*
+画像の最新取得（GET /quiz/{id}/images/latest）はこちらで処理する。
+"""
+from typing import Optional, List
+from uuid import uuid4
+from fastapi import APIRouter, Depends, HTTPException, Header, Request, Response, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .database import get_async_db
+from . import async_crud, schemas, models
+from .services.image_variants import pick_variant
+from .services.user_cache import token_cache
+from .services.response_cache import response_cache, serialize
+
+router = APIRouter()
+
+async def get_current_user(
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    x_token: Optional[str] = Header(default=None, alias="X-Token"),
+) -> models.User:
+    """読み取り用。ユーザー行は作らない（未登録なら id=None の一時オブジェクト）"""
+    if x_token is None:
+        token = str(uuid4())
+        response.headers["X-Token-Issued"] = token
+        return models.User(id=None, token=token)
+    return models.User(id=await async_crud.resolve_user_id(db, x_token), token=x_token)
+
+async def get_write_user(
+    db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(get_current_user),
+) -> models.User:
+    """書き込み用（行は作らない）。キャッシュの id を DB と照合する（routes.get_write_user と同じ）"""
+    if user.id is not None and not await async_crud.user_matches(db, user.id, user.token):
+        token_cache.invalidate(token=user.token)
+        user.id = await async_crud.resolve_user_id(db, user.token)
+    return user
+
+async def get_or_create_current_user(
+    db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(get_write_user),
+) -> models.User:
+    """書き込み用。ここで初めてユーザー行を作る"""
+    if user.id is None:
+        created = await async_crud.get_or_create_user(db, user.token)
+        token_cache.put(created.token, created.id)
+        user.id = created.id
+    return user
+
+# ----- Quiz CRUD -----
+@router.post("/quiz/create", response_model=schemas.QuizOut)
+async def create_quiz(payload: schemas.QuizCreate, db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_or_create_current_user)):
+    return await async_crud.create_quiz(db, user=user, question=payload.question, answer=payload.answer)
+
+@router.get("/quiz/list", response_model=List[schemas.QuizWithStatusOut])
+async def list_quizzes(
+    request: Request,
+    response: Response,
+    q: Optional[str] = Query(default=None, description="部分一致検索"),
+    order: str = Query(default="created_desc", pattern="^(created_desc|created_asc)$"),
+    status: str = Query(default="all", pattern="^(all|incorrect_only|unanswered_only)$"),
+    offset: int = 0, limit: int = Query(default=200, ge=1, le=1000),
+    cursor: Optional[str] = Query(default=None, description="前ページの X-Next-Cursor"),
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_current_user),
+):
+    version = await async_crud.get_data_version(db, user)
+    cached = response_cache.lookup(request, user.id, version)
+    if cached is not None:
+        return cached
+    try:
+        items, next_cursor = await async_crud.list_quizzes_page(db, user, q, order, offset, limit, status, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response_cache.store(request, user.id, version, serialize(schemas.QuizWithStatusList, items, trusted=True), dict(response.headers))
+
+@router.get("/quiz/search", response_model=List[schemas.QuizSearchOut])
+async def search_quizzes(
+    q: str = Query(min_length=1, max_length=200),
+    offset: int = 0, limit: int = Query(default=50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_current_user),
+):
+    return await async_crud.search_quizzes(db, user, q, offset=offset, limit=limit)
+
+@router.delete("/quiz/{quiz_id}", status_code=204)
+async def delete_quiz(quiz_id: int, db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_write_user)):
+    ok = await async_crud.delete_quiz_owned(db, quiz_id=quiz_id, user=user)
+    if not ok:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    return Response(status_code=204)
+
+# ----- Image -----
+@router.get("/quiz/{quiz_id}/images/latest", response_model=Optional[schemas.ImageOut])
+async def latest_image(
+    quiz_id: int,
+    w: Optional[int] = Query(default=None, ge=1, le=4096, description="表示幅(px)。url にこれ以上で最小の派生画像を返す"),
+    fmt: str = Query(default="webp", pattern="^(webp|avif|png)$"),
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_current_user),
+):
+    quiz = await async_crud.get_quiz_owned(db, quiz_id=quiz_id, user=user)
+    if not quiz:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    im = await async_crud.get_latest_image_by_quiz(db, quiz=quiz)
+    if im is None:
+        return None
+    out = schemas.ImageOut.model_validate(im)
+    out.url = pick_variant(im, w, fmt)
+    return out
+
+# ----- Answer & Stats -----
+@router.post("/quiz/{quiz_id}/answer", response_model=schemas.AnswerResultOut)
+async def answer_quiz(
+    quiz_id: int,
+    body: schemas.AnswerIn,
+    db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(get_write_user),
+):
+    quiz = await async_crud.get_quiz_owned(db, quiz_id=quiz_id, user=user)
+    if not quiz:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    ok, _ = await async_crud.log_answer(db, user=user, quiz=quiz, user_answer=body.answer, image_shown=body.image_shown)
+    return {"quiz_id": quiz.id, "correct": ok, "image_shown": body.image_shown}
+
+@router.post("/quiz/answers/batch", response_model=schemas.AnswerBatchOut)
+async def answer_batch(
+    body: schemas.AnswerBatchIn,
+    db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(get_write_user),
+):
+    return {"results": await async_crud.log_answers_batch(db, user=user, items=body.items)}
+
+@router.get("/stats/summary", response_model=schemas.StatsSummary)
+async def stats_summary(request: Request, response: Response, db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_current_user)):
+    version = await async_crud.get_data_version(db, user)
+    cached = response_cache.lookup(request, user.id, version)
+    if cached is not None:
+        return cached
+    body = serialize(schemas.StatsSummaryAdapter, await async_crud.get_stats_summary(db, user=user), trusted=True)
+    return response_cache.store(request, user.id, version, body, dict(response.headers))
+
+@router.get("/stats/quizzes", response_model=List[schemas.QuizStatsOut])
+async def stats_quizzes(
+    request: Request, response: Response,
+    offset: int = 0, limit: int = Query(default=200, ge=1, le=1000),
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_current_user),
+):
+    version = await async_crud.get_data_version(db, user)
+    cached = response_cache.lookup(request, user.id, version)
+    if cached is not None:
+        return cached
+    body = serialize(schemas.QuizStatsList, await async_crud.get_quiz_stats(db, user=user, offset=offset, limit=limit), trusted=True)
+    return response_cache.store(request, user.id, version, body, dict(response.headers))
+
+@router.get("/review/next", response_model=List[schemas.ReviewItemOut])
+async def review_next(
+    limit: int = Query(default=20, ge=1, le=200),
+    include_new: bool = Query(default=False, description="期限の来たものが足りなければ未回答のクイズで埋める"),
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(get_current_user),
+):
+    return await async_crud.get_review_queue(db, user=user, limit=limit, include_new=include_new)
+
+
+def _keys(route) -> set:
+    return {(route.path, m) for m in getattr(route, "methods", None) or ()}
+
+def override(sync_router: APIRouter) -> APIRouter:
+    """sync_router のうち、ここに async 版があるルートを差し替えたルーターを返す"""
+    replaced = set().union(*(_keys(r) for r in router.routes))
+    merged = APIRouter()
+    merged.routes.extend(router.routes)
+    merged.routes.extend(r for r in sync_router.routes if not (_keys(r) & replaced))
+    return merged
@@ -3,7 +3,49 @@ from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./quiz.db")
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")  # 空なら管理者向け機能は無効
+    TOKEN_CACHE_SIZE: int = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+    TOKEN_CACHE_TTL: float = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+    USER_CLEANUP_INTERVAL: float = float(os.getenv("USER_CLEANUP_INTERVAL", "0"))  # 未使用ユーザーの掃除をサーバー内で回す間隔（秒、0 で無効）
+    USER_CLEANUP_DAYS: float = float(os.getenv("USER_CLEANUP_DAYS", "7"))          # 最後に使われてからこの日数経った、何も作らなかったユーザーを消す
     A1111_BASE_URL: str = os.getenv("A1111_BASE_URL", "http://127.0.0.1:7860")
     IMAGE_DIR: str = os.getenv("IMAGE_DIR", "static/images")
+    A1111_MAX_CONCURRENCY: int = int(os.getenv("A1111_MAX_CONCURRENCY", "1"))  # GPU 1台なので既定は直列
+    A1111_TIMEOUT: float = float(os.getenv("A1111_TIMEOUT", "120"))
+    A1111_CONNECT_TIMEOUT: float = float(os.getenv("A1111_CONNECT_TIMEOUT", "5"))
+    A1111_QUEUE_TIMEOUT: float = float(os.getenv("A1111_QUEUE_TIMEOUT", "300"))  # 空き待ちの上限
+    A1111_RETRIES: int = int(os.getenv("A1111_RETRIES", "2"))
+    A1111_BREAKER_THRESHOLD: int = int(os.getenv("A1111_BREAKER_THRESHOLD", "5"))
+    A1111_BREAKER_RESET: float = float(os.getenv("A1111_BREAKER_RESET", "30"))
+    A1111_MODEL: str = os.getenv("A1111_MODEL", "")  # 空なら A1111 側の現在のモデル
+    IMAGE_CACHE_MAX_BYTES: int = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024**3)))
+    IMAGE_VARIANT_WIDTHS: str = os.getenv("IMAGE_VARIANT_WIDTHS", "128,256,512")
+    IMAGE_VARIANT_FORMATS: str = os.getenv("IMAGE_VARIANT_FORMATS", "webp,avif")  # Pillow が対応している形式だけ作る
+    IMAGE_VARIANT_WORKERS: int = int(os.getenv("IMAGE_VARIANT_WORKERS", "1"))  # 0 で無効
+    IMAGE_JOB_WORKERS: int = int(os.getenv("IMAGE_JOB_WORKERS", "2"))
+    STORAGE_QUOTA_BYTES: int = int(os.getenv("STORAGE_QUOTA_BYTES", "0"))      # IMAGE_DIR 全体の上限（0 で無制限）
+    STORAGE_GC_INTERVAL: float = float(os.getenv("STORAGE_GC_INTERVAL", "0"))  # 孤立ファイル掃除の間隔（秒、0 で無効）
+    STORAGE_GC_GRACE: float = float(os.getenv("STORAGE_GC_GRACE", "600"))      # 更新からこの秒数以内のファイルは消さない
+    PREGEN_CONCURRENCY: int = int(os.getenv("PREGEN_CONCURRENCY", "1"))        # 一括事前生成の同時実行数
+    PREGEN_RATE_PER_MIN: float = float(os.getenv("PREGEN_RATE_PER_MIN", "30"))  # 一括事前生成の毎分の上限（0 で無制限）
+    DB_ASYNC: bool = os.getenv("DB_ASYNC", "0").lower() in ("1", "true", "yes")  # 主要ルートを AsyncSession で処理
+    ANSWER_ARCHIVE_DAYS: int = int(os.getenv("ANSWER_ARCHIVE_DAYS", "0"))             # これより古い回答を日次集計に畳んでアーカイブ（0 で無効）
+    ANSWER_COMPACT_INTERVAL: float = float(os.getenv("ANSWER_COMPACT_INTERVAL", "3600"))  # サーバー内で畳む間隔（秒、0 で無効）
+    GRADING_MAX_DISTANCE: int = int(os.getenv("GRADING_MAX_DISTANCE", "2"))  # 許す編集距離の上限（0 で完全一致のみ）
+    RESPONSE_CACHE_SIZE: int = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))  # 一覧・集計のシリアライズ済みレスポンス（0 で無効）
+    RESPONSE_CACHE_MAX_BYTES: int = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024**2)))
+    RESPONSE_COMPRESSION: bool = os.getenv("RESPONSE_COMPRESSION", "1").lower() in ("1", "true", "yes")  # gzip / brotli
+    COMPRESS_MIN_BYTES: int = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))        # これより小さい本文は圧縮しない
+    COMPRESS_GZIP_LEVEL: int = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+    COMPRESS_BROTLI_QUALITY: int = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))  # その場で圧縮するので低め（事前圧縮は 11）
+    STATIC_CACHE_MAX_BYTES: int = int(os.getenv("STATIC_CACHE_MAX_BYTES", str(32 * 1024**2)))  # index.html・静的ファイルの事前圧縮版（0 で無効）
+    METRICS_QUERY_WARN: int = int(os.getenv("METRICS_QUERY_WARN", "50"))  # 1リクエストの SQL がこれを超えたら警告（0 で無効）
+    # SQLite 高負荷モード（WAL + PRAGMA + 書き込み専用スレッドでのグループコミット）
+    SQLITE_PERF_MODE: bool = os.getenv("SQLITE_PERF_MODE", "0").lower() in ("1", "true", "yes")
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024**2)))
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+    WRITE_BATCH_MAX: int = int(os.getenv("WRITE_BATCH_MAX", "64"))
+    WRITE_BATCH_DELAY_MS: float = float(os.getenv("WRITE_BATCH_DELAY_MS", "2"))
 
 settings = Settings()
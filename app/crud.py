@@ -1,8 +1,14 @@
 from __future__ import annotations
+import base64
+from datetime import datetime, timezone
 from typing import Optional, List, Tuple, Sequence
+from uuid import uuid4
 from sqlalchemy.orm import Session
 from sqlalchemy import select, desc, asc, delete, func
+from sqlalchemy.exc import IntegrityError
 from app import models
+from app.services import stats, search, grading, review, response_cache, storage, compaction
+from app.services.write_queue import writer
 
 # ---- User ----
 def get_user_by_token(db: Session, token: str) -> Optional[models.User]:
@@ -12,20 +18,36 @@ def get_or_create_user(db: Session, token: str) -> models.User:
     u = get_user_by_token(db, token)
     if u: return u
     u = models.User(token=token)
-    db.add(u); db.commit(); db.refresh(u)
+    db.add(u)
+    try:
+        db.commit()
+    except IntegrityError:
+        # 同じトークンの初回リクエストが並行した
+        db.rollback()
+        return get_user_by_token(db, token)
+    db.refresh(u)
     return u
 
 # ---- Quiz ----
+def _insert_quiz(db: Session, user_id: int, question: str, answer: str) -> models.Quiz:
+    qz = models.Quiz(question=question, answer=answer, user_id=user_id, **grading.key_fields(answer))
+    db.add(qz); db.flush()
+    search.index_quizzes(db, [(user_id, qz.id, question, answer)])
+    stats.bump_user(db, user_id, total_quizzes=1)
+    response_cache.bump(db, user_id)
+    return qz
+
 def create_quiz(db: Session, user: models.User, question: str, answer: str) -> models.Quiz:
-    qz = models.Quiz(question=question, answer=answer, user_id=user.id)
-    db.add(qz); db.commit(); db.refresh(qz)
+    if writer.enabled:
+        return db.merge(writer.run(_insert_quiz, user.id, question, answer), load=False)
+    qz = _insert_quiz(db, user.id, question, answer)
+    db.commit(); db.refresh(qz)
     return qz
 
 def list_quizzes(db: Session, user: models.User, q: Optional[str], order: str, offset: int, limit: int) -> List[models.Quiz]:
     stmt = select(models.Quiz).where(models.Quiz.user_id == user.id)
     if q:
-        like = f"%{q}%"
-        stmt = stmt.where((models.Quiz.question.ilike(like)) | (models.Quiz.answer.ilike(like)))
+        stmt = stmt.where(search.match_condition(q, user.id))
     stmt = stmt.order_by(desc(models.Quiz.created_at) if order == "created_desc" else asc(models.Quiz.created_at))
     stmt = stmt.offset(offset).limit(limit)
     return list(db.execute(stmt).scalars())
@@ -36,10 +58,25 @@ def get_quiz_owned(db: Session, quiz_id: int, user: models.User) -> Optional[mod
     ).scalar_one_or_none()
 
 def delete_quiz_owned(db: Session, quiz_id: int, user: models.User) -> bool:
+    paths = delete_quiz_rows(db, quiz_id, user)
+    if paths is None: return False
+    storage.release(db, paths)
+    return True
+
+def delete_quiz_rows(db: Session, quiz_id: int, user: models.User) -> Optional[List[str]]:
+    """行だけ消してコミットし、画像ファイルのパスを返す（所有していなければ None）。
+    ファイルは呼び出し側がコミット後に storage.release で消す（参照が残っているものは消えない）"""
     qz = get_quiz_owned(db, quiz_id, user)
-    if not qz: return False
+    if not qz: return None
+    stats.forget_quiz(db, quiz_id=qz.id, user_id=user.id)
+    review.forget_quiz(db, quiz_id=qz.id, user_id=user.id)
+    compaction.forget_quiz(db, quiz_id=qz.id, user_id=user.id)
+    search.forget_quiz(db, qz)
+    response_cache.bump(db, user.id)
+    # 画像の行は cascade で消えるので、ファイルは消す前に控えておき、コミット後に参照が無ければ消す
+    paths = [im.file_path for im in qz.images]
     db.delete(qz); db.commit()
-    return True
+    return paths
 
 # ---- Image ----
 def list_images_by_quiz(db: Session, quiz: models.Quiz):
@@ -52,9 +89,19 @@ def delete_images_by_quiz(db: Session, quiz: models.Quiz) -> int:
     db.commit()
     return res.rowcount or 0
 
+def _insert_image(db: Session, user_id: int, quiz_id: int, file_path: str, prompt: Optional[str]) -> models.GeneratedImage:
+    im = models.GeneratedImage(quiz_id=quiz_id, file_path=file_path, prompt=prompt)
+    db.add(im)
+    response_cache.bump(db, user_id)
+    db.flush()
+    return im
+
 def add_image(db: Session, quiz: models.Quiz, file_path: str, prompt: Optional[str]) -> models.GeneratedImage:
-    im = models.GeneratedImage(quiz_id=quiz.id, file_path=file_path, prompt=prompt)
-    db.add(im); db.commit(); db.refresh(im)
+    if writer.enabled:
+        # SQLite 高負荷モード：書き込みスレッドでまとめてコミットし、結果を呼び出し側のセッションに載せ直す
+        return db.merge(writer.run(_insert_image, quiz.user_id, quiz.id, file_path, prompt), load=False)
+    im = _insert_image(db, quiz.user_id, quiz.id, file_path, prompt)
+    db.commit(); db.refresh(im)
     return im
 
 def get_latest_image_by_quiz(db: Session, quiz: models.Quiz) -> Optional[models.GeneratedImage]:
@@ -65,41 +112,245 @@ def get_latest_image_by_quiz(db: Session, quiz: models.Quiz) -> Optional[models.
         .limit(1)
     ).scalar_one_or_none()
 
-# ---- Answer / Stats ----
-def _norm(s: str) -> str:
-    try:
-        return s.strip().lower()
-    except Exception:
-        return s
+# ---- Image Job ----
+JOB_INFLIGHT = ("queued", "running")
 
-def log_answer(db: Session, user: models.User, quiz: models.Quiz, user_answer: str, image_shown: bool) -> Tuple[bool, models.AnswerLog]:
-    correct = _norm(user_answer) == _norm(quiz.answer)
+def create_image_job(db: Session, user: models.User, quiz: models.Quiz, prompt: Optional[str], force: bool) -> models.ImageJob:
+    job = models.ImageJob(id=uuid4().hex, quiz_id=quiz.id, user_id=user.id, prompt=prompt, force=force, status="queued")
+    db.add(job); db.commit(); db.refresh(job)
+    return job
+
+def find_inflight_image_job(db: Session, quiz: models.Quiz, prompt: Optional[str], force: bool = False) -> Optional[models.ImageJob]:
+    """(quiz, prompt, force) が同じ処理中ジョブ。force は描き直し・旧画像削除を伴うので通常のものとは合流させない"""
+    prompt_cond = models.ImageJob.prompt.is_(None) if prompt is None else models.ImageJob.prompt == prompt
+    return db.execute(
+        select(models.ImageJob)
+        .where(models.ImageJob.quiz_id == quiz.id, prompt_cond, func.coalesce(models.ImageJob.force, False) == force,
+               models.ImageJob.status.in_(JOB_INFLIGHT))
+        .order_by(asc(models.ImageJob.created_at))
+        .limit(1)
+    ).scalar_one_or_none()
+
+def get_image_job(db: Session, job_id: str) -> Optional[models.ImageJob]:
+    return db.get(models.ImageJob, job_id)
+
+def get_image_job_owned(db: Session, job_id: str, user: models.User) -> Optional[models.ImageJob]:
+    return db.execute(
+        select(models.ImageJob).where(models.ImageJob.id == job_id, models.ImageJob.user_id == user.id)
+    ).scalar_one_or_none()
+
+def list_inflight_image_job_ids(db: Session) -> List[str]:
+    return list(db.execute(
+        select(models.ImageJob.id).where(models.ImageJob.status.in_(JOB_INFLIGHT)).order_by(asc(models.ImageJob.created_at))
+    ).scalars())
+
+def set_image_job_status(db: Session, job: models.ImageJob, status: str, image_id: Optional[int] = None,
+                         error: Optional[str] = None, error_kind: Optional[str] = None) -> models.ImageJob:
+    job.status = status
+    job.image_id = image_id
+    job.error = error
+    job.error_kind = error_kind
+    db.commit(); db.refresh(job)
+    return job
+
+# ---- Answer / Stats ----
+def _insert_answer(db: Session, user_id: int, quiz_id: int, correct: bool, user_answer: str, image_shown: bool) -> models.AnswerLog:
     rec = models.AnswerLog(
-        user_id=user.id,
-        quiz_id=quiz.id,
+        user_id=user_id,
+        quiz_id=quiz_id,
         is_correct=correct,
         user_answer=user_answer,
         image_shown=image_shown,
+        answered_at=datetime.utcnow(),
     )
-    db.add(rec); db.commit(); db.refresh(rec)
+    db.add(rec)
+    stats.record_answer(db, user_id, quiz_id, correct, bool(image_shown), rec.answered_at)
+    review.record_answer(db, user_id, quiz_id, correct, bool(image_shown), rec.answered_at)
+    response_cache.bump(db, user_id)
+    db.flush()
+    return rec
+
+def log_answer(db: Session, user: models.User, quiz: models.Quiz, user_answer: str, image_shown: bool) -> Tuple[bool, models.AnswerLog]:
+    correct = grading.grade(user_answer, quiz)
+    if writer.enabled:
+        return correct, db.merge(writer.run(_insert_answer, user.id, quiz.id, correct, user_answer, image_shown), load=False)
+    rec = _insert_answer(db, user.id, quiz.id, correct, user_answer, image_shown)
+    db.commit(); db.refresh(rec)
     return correct, rec
 
+def _client_time(ts: Optional[datetime], now: datetime) -> datetime:
+    """クライアント時刻を naive UTC に揃える。未来の時刻はサーバー時刻で丸める"""
+    if ts is None:
+        return now
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return min(ts, now)
+
+def _plan_answers_batch(db: Session, user: models.User, items: Sequence) -> Tuple[List[dict], List[Tuple[Optional[str], dict]]]:
+    """読み取りと採点だけ。戻り値は (結果, 記録する (冪等キー, answer_logs の行) の並び)"""
+    quiz_ids = {it.quiz_id for it in items}
+    quizzes = {
+        qz.id: qz for qz in db.execute(
+            select(models.Quiz).where(models.Quiz.user_id == user.id, models.Quiz.id.in_(quiz_ids))
+        ).scalars()
+    } if quiz_ids else {}
+
+    keys = {it.idempotency_key for it in items if it.idempotency_key}
+    seen: dict = {}  # key -> correct
+    if keys:
+        seen = dict(db.execute(
+            select(models.AnswerIdempotency.key, models.AnswerLog.is_correct)
+            .join(models.AnswerLog, models.AnswerLog.id == models.AnswerIdempotency.answer_log_id)
+            .where(models.AnswerIdempotency.user_id == user.id, models.AnswerIdempotency.key.in_(keys))
+        ).all())
+
+    now = datetime.utcnow()
+    results: List[dict] = []
+    new_logs: List[Tuple[Optional[str], dict]] = []
+    for i, it in enumerate(items):
+        res = {"index": i, "quiz_id": it.quiz_id, "image_shown": it.image_shown}
+        quiz = quizzes.get(it.quiz_id)
+        if quiz is None:
+            results.append({**res, "status": "not_found", "correct": None}); continue
+        key = it.idempotency_key
+        if key and key in seen:
+            results.append({**res, "status": "duplicate", "correct": bool(seen[key])}); continue
+        correct = grading.grade(it.answer, quiz)
+        new_logs.append((key, {
+            "user_id": user.id, "quiz_id": quiz.id, "is_correct": correct, "user_answer": it.answer,
+            "image_shown": it.image_shown, "answered_at": _client_time(it.client_ts, now),
+        }))
+        if key:
+            seen[key] = correct
+        results.append({**res, "status": "ok", "correct": correct})
+    return results, new_logs
+
+def _insert_answers_batch(db: Session, user_id: int, new_logs: List[Tuple[Optional[str], dict]]) -> None:
+    # 行は dict で受けて毎回作る（書き込みスレッドが失敗したバッチを1件ずつやり直すことがある）
+    recs = [(key, models.AnswerLog(**row)) for key, row in new_logs]
+    db.add_all(rec for _, rec in recs)
+    db.flush()  # answer_logs.id を確定させる
+    db.add_all(
+        models.AnswerIdempotency(user_id=user_id, key=key, answer_log_id=rec.id)
+        for key, rec in recs if key
+    )
+    # 集計はクイズごとにまとめて加算
+    per_quiz: dict = {}
+    latest: dict = {}   # quiz_id -> 直近の回答（同時刻なら後の行 = id の大きい方）
+    for _, rec in recs:
+        d = per_quiz.setdefault(rec.quiz_id, dict.fromkeys(stats.COUNTER_COLS, 0))
+        for c, v in stats.answer_deltas(rec.is_correct, bool(rec.image_shown)).items():
+            d[c] += v
+        if rec.quiz_id not in latest or rec.answered_at >= latest[rec.quiz_id].answered_at:
+            latest[rec.quiz_id] = rec
+    total = dict.fromkeys(stats.COUNTER_COLS, 0)
+    for qid, d in per_quiz.items():
+        stats.bump_quiz(db, qid, user_id, latest=(latest[qid].answered_at, latest[qid].is_correct), **d)
+        for c in total:
+            total[c] += d[c]
+    stats.bump_user(db, user_id, **total)
+    review.record_answers(db, user_id, [rec for _, rec in recs])
+    response_cache.bump(db, user_id)
+    db.flush()
+
+def log_answers_batch(db: Session, user: models.User, items: Sequence, _retry: bool = True) -> List[dict]:
+    """まとめて採点・記録する。所有チェックも冪等キー確認も IN 1回ずつ、コミットは1回"""
+    results, new_logs = _plan_answers_batch(db, user, items)
+    if not new_logs:
+        return results
+    try:
+        if writer.enabled:
+            writer.run(_insert_answers_batch, user.id, new_logs)
+        else:
+            _insert_answers_batch(db, user.id, new_logs)
+            db.commit()
+    except IntegrityError:
+        # 同じキーの再送が並行して先にコミットされた → やり直せば duplicate になる
+        db.rollback()
+        if not _retry:
+            raise
+        return log_answers_batch(db, user, items, _retry=False)
+    return results
+
+# 回答数・直近の正誤は quiz_stats に回答のたびに反映してある（answer_rollups に畳んだ分も含む）
 def get_quiz_attempts(db: Session, user: models.User, quiz: models.Quiz) -> int:
-    return db.execute(
-        select(func.count(models.AnswerLog.id)).where(
-            models.AnswerLog.user_id == user.id,
-            models.AnswerLog.quiz_id == quiz.id
-        )
-    ).scalar_one()
+    qs = stats.get_quiz_stats(db, quiz.id, user.id)
+    return qs.attempts if qs else 0
 
 def get_quiz_last_correct(db: Session, user: models.User, quiz: models.Quiz) -> Optional[bool]:
-    row = db.execute(
-        select(models.AnswerLog.is_correct)
-        .where(models.AnswerLog.user_id == user.id, models.AnswerLog.quiz_id == quiz.id)
-        .order_by(desc(models.AnswerLog.answered_at))
-        .limit(1)
-    ).first()
-    return None if not row else bool(row[0])
+    qs = stats.get_quiz_stats(db, quiz.id, user.id)
+    return None if qs is None or qs.last_correct is None else bool(qs.last_correct)
+
+# ---- Quiz list (status 付き) ----
+# attempts / last_correct は quiz_stats（回答のたびに更新）を主キーで引くので、回答履歴は読まない。
+# ステータス絞り込みも同じ列で SQL 側で行う。
+# ページングは (created_at, id) のキーセット方式（cursor）。offset も互換のため残す。
+def encode_list_cursor(created_at: datetime, quiz_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{quiz_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_list_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, qid = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(qid)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+def list_quizzes_page(
+    db: Session,
+    user: models.User,
+    q: Optional[str],
+    order: str,
+    offset: int,
+    limit: int,
+    status_filter: str,   # "all" | "incorrect_only" | "unanswered_only"
+    cursor: Optional[str] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    qz, st = models.Quiz, models.QuizStats
+    attempts = func.coalesce(st.attempts, 0)
+
+    stmt = (
+        select(qz.id, qz.question, qz.answer, qz.created_at, attempts.label("attempts"), st.last_correct)
+        .outerjoin(st, st.quiz_id == qz.id)
+        .where(qz.user_id == user.id)
+    )
+    if q:
+        stmt = stmt.where(search.match_condition(q, user.id))
+    if status_filter == "incorrect_only":
+        stmt = stmt.where(st.last_correct == False)  # noqa: E712
+    elif status_filter == "unanswered_only":
+        stmt = stmt.where(attempts == 0)
+
+    desc_order = order == "created_desc"
+    if cursor:
+        c_at, c_id = decode_list_cursor(cursor)
+        if desc_order:
+            stmt = stmt.where((qz.created_at < c_at) | ((qz.created_at == c_at) & (qz.id < c_id)))
+        else:
+            stmt = stmt.where((qz.created_at > c_at) | ((qz.created_at == c_at) & (qz.id > c_id)))
+    if desc_order:
+        stmt = stmt.order_by(desc(qz.created_at), desc(qz.id))
+    else:
+        stmt = stmt.order_by(asc(qz.created_at), asc(qz.id))
+    if offset and not cursor:
+        stmt = stmt.offset(offset)
+    # 1件多く取って次ページの有無を判定
+    rows = db.execute(stmt.limit(limit + 1)).all()
+
+    out = [{
+        "id": r.id,
+        "question": r.question,
+        "answer": r.answer,
+        "created_at": r.created_at,
+        "attempts": int(r.attempts),
+        "last_correct": None if r.last_correct is None else bool(r.last_correct),
+    } for r in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit and out:
+        last = out[-1]
+        next_cursor = encode_list_cursor(last["created_at"], last["id"])
+    return out, next_cursor
 
 def list_quizzes_with_status(
     db: Session,
@@ -110,49 +361,49 @@ def list_quizzes_with_status(
     limit: int,
     status_filter: str,   # "all" | "incorrect_only" | "unanswered_only"
 ):
-    quizzes = list_quizzes(db, user, q, order, offset, limit)
-    out = []
-    for quiz in quizzes:
-        attempts = get_quiz_attempts(db, user, quiz)
-        last_correct = get_quiz_last_correct(db, user, quiz)
-        if status_filter == "incorrect_only" and not (attempts > 0 and last_correct is False):
-            continue
-        if status_filter == "unanswered_only" and not (attempts == 0):
-            continue
-        out.append({
-            "id": quiz.id,
-            "question": quiz.question,
-            "answer": quiz.answer,
-            "created_at": quiz.created_at,
-            "attempts": attempts,
-            "last_correct": last_correct
-        })
-    return out
+    items, _ = list_quizzes_page(db, user, q, order, offset, limit, status_filter)
+    return items
 
 def get_stats_summary(db: Session, user: models.User):
-    total_quizzes = db.execute(
-        select(func.count(models.Quiz.id)).where(models.Quiz.user_id == user.id)
-    ).scalar_one()
-
-    attempts = db.execute(
-        select(func.count(models.AnswerLog.id)).where(models.AnswerLog.user_id == user.id)
-    ).scalar_one()
-
-    correct_attempts = db.execute(
-        select(func.count(models.AnswerLog.id)).where(
-            models.AnswerLog.user_id == user.id,
-            models.AnswerLog.is_correct == True
-        )
-    ).scalar_one()
-
-    accuracy = float(correct_attempts) / attempts if attempts else 0.0
+    # user_stats を主キーで1行読むだけ（回答履歴の量に依存しない）
+    st = stats.get_user_stats(db, user.id)
+    total_quizzes = st.total_quizzes if st else 0
+    attempts = st.attempts if st else 0
+    correct_attempts = st.correct_attempts if st else 0
+    attempts_image = st.attempts_image if st else 0
+    correct_image = st.correct_image if st else 0
+
     return {
         "total_quizzes": int(total_quizzes),
         "attempts": int(attempts),
         "correct_attempts": int(correct_attempts),
-        "accuracy": accuracy
+        "accuracy": stats.ratio(correct_attempts, attempts),
+        "attempts_with_image": int(attempts_image),
+        "accuracy_with_image": stats.ratio(correct_image, attempts_image),
+        "attempts_without_image": int(attempts - attempts_image),
+        "accuracy_without_image": stats.ratio(correct_attempts - correct_image, attempts - attempts_image),
     }
 
+def get_quiz_stats(db: Session, user: models.User, offset: int = 0, limit: int = 200):
+    out = []
+    for qs, question in stats.list_quiz_stats(db, user.id, offset, limit):
+        out.append({
+            "quiz_id": qs.quiz_id,
+            "question": question,
+            "attempts": qs.attempts,
+            "correct_attempts": qs.correct_attempts,
+            "accuracy": stats.ratio(qs.correct_attempts, qs.attempts),
+            "accuracy_with_image": stats.ratio(qs.correct_image, qs.attempts_image),
+            "accuracy_without_image": stats.ratio(qs.correct_attempts - qs.correct_image, qs.attempts - qs.attempts_image),
+        })
+    return out
+
+def get_data_version(db: Session, user: models.User) -> Optional[int]:
+    return response_cache.current_version(db, user.id)
+
+def get_review_queue(db: Session, user: models.User, limit: int = 20, include_new: bool = False) -> List[dict]:
+    return review.next_due(db, user.id, limit=limit, include_new=include_new)
+
 def list_quizzes_for_user(db: Session, user_id: int, limit: int = 100, offset: int = 0) -> Sequence[models.Quiz]:
     return (db.query(models.Quiz)
               .filter(models.Quiz.user_id == user_id)
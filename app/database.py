@@ -1,6 +1,6 @@
 # app/database.py
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # .env を読み込む（未導入なら pip install python-dotenv）
@@ -21,15 +21,67 @@ if isinstance(DATABASE_URL, str) and ("render.com" in DATABASE_URL) and ("sslmod
 # ③ SQLite の時だけ connect_args を付与
 connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
 
+from .config import settings
+
 # ④ Engine / Session / Base を一度だけ定義
 engine = create_engine(DATABASE_URL, connect_args=connect_args, pool_pre_ping=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-# ⑤ 依存性（FastAPI で使う）
+# ⑤ SQLite 高負荷モード：プールの接続ごとに PRAGMA を設定
+#   WAL で読み取りと書き込みが互いを待たなくなり、synchronous=NORMAL で
+#   コミットごとの fsync を省く（WAL なら電源断でも DB は壊れない）
+SQLITE_PERF = DATABASE_URL.startswith("sqlite") and settings.SQLITE_PERF_MODE
+
+def _sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    try:
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cur.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cur.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")  # 負数は KiB 指定
+        cur.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cur.close()
+
+if SQLITE_PERF:
+    event.listen(engine, "connect", _sqlite_pragmas)
+
+# ⑥ 依存性（FastAPI で使う）
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+# ⑦ 非同期モード（DB_ASYNC=1）：主要ルートを AsyncSession で処理する（app/async_routes.py）
+#   SQLite は aiosqlite、Postgres は asyncpg。マイグレーションやバックグラウンド処理は上の同期 Engine のまま
+def async_url(url: str) -> str:
+    from sqlalchemy.engine.url import make_url
+    u = make_url(url)
+    if u.get_backend_name() == "sqlite":
+        return u.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+    if u.get_backend_name() == "postgresql":
+        # asyncpg は sslmode ではなく ssl を受け取る
+        ssl = u.query.get("sslmode")
+        u = u.set(drivername="postgresql+asyncpg").difference_update_query(["sslmode"])
+        if ssl and ssl != "disable":
+            u = u.update_query_dict({"ssl": ssl})
+        return u.render_as_string(hide_password=False)
+    return url
+
+async_engine = None
+AsyncSessionLocal = None
+if settings.DB_ASYNC:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    async_engine = create_async_engine(async_url(DATABASE_URL), pool_pre_ping=True)
+    if SQLITE_PERF:
+        event.listen(async_engine.sync_engine, "connect", _sqlite_pragmas)
+    # コミット後に属性を読み直すと暗黙の I/O になるので expire しない
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
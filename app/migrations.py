@@ -0,0 +1,430 @@
+"""スキーマのバージョン管理
+
+起動時に migrate(engine) が schema_migrations を見て未適用のものだけを順に当てる。
+各マイグレーションは何度実行しても同じ結果になるように書く（複数ワーカーが同時に
+起動しても壊れないように）。インデックスは Postgres では CONCURRENTLY で作るので
+書き込みを止めない。
+
+    python -m app.migrations upgrade       # 未適用分を適用
+    python -m app.migrations status
+    python -m app.migrations check-plans   # crud のクエリが全件走査・一時ソートになっていないか確認
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple
+
+from sqlalchemy import bindparam, create_engine, event, inspect, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from . import models
+from .database import Base
+
+log = logging.getLogger("uvicorn")
+
+
+# ---- マイグレーション本体 ----
+def _baseline(engine: Engine) -> None:
+    """存在しないテーブルを作る（create_all は既存テーブルには触らない）"""
+    Base.metadata.create_all(bind=engine)
+
+
+def create_index_online(engine: Engine, ix) -> None:
+    if engine.dialect.name == "postgresql":
+        cols = ", ".join(c.name for c in ix.columns)
+        # CONCURRENTLY はトランザクション外でしか実行できない
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {ix.name} ON {ix.table.name} ({cols})"))
+        return
+    with engine.begin() as conn:
+        conn.execute(CreateIndex(ix, if_not_exists=True))
+
+
+def drop_index_online(engine: Engine, name: str) -> None:
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+HOT_PATH_INDEXES = (
+    "ix_answer_logs_user_quiz_answered",
+    "ix_quizzes_user_created",
+    "ix_quizzes_user_question",
+    "ix_generated_images_quiz_created",
+    "ix_generated_images_file_path",
+)
+
+
+def _hot_path_indexes(engine: Engine) -> None:
+    by_name = {ix.name: ix for t in Base.metadata.sorted_tables for ix in t.indexes}
+    for name in HOT_PATH_INDEXES:
+        create_index_online(engine, by_name[name])
+
+
+def _stats_backfill(engine: Engine) -> None:
+    from .services import stats
+
+    db = sessionmaker(bind=engine)()
+    try:
+        stats.ensure_initialized(db)
+    finally:
+        db.close()
+
+
+def add_column(engine: Engine, table: str, column: str, ddl_type: str) -> None:
+    """列が無ければ足す（create_all は既存テーブルに列を足さない）"""
+    if column in {c["name"] for c in inspect(engine).get_columns(table)}:
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+def _quiz_answer_keys(engine: Engine) -> None:
+    # キーを作るのは 16（quiz_answer_alternates）。rekey は 16 で足す列を読むのでここでは呼べない
+    add_column(engine, "quizzes", "answer_key", "VARCHAR")
+    add_column(engine, "quizzes", "answer_key_version", "INTEGER")
+
+
+def _review_states(engine: Engine) -> None:
+    from .services import review
+
+    models.ReviewState.__table__.create(bind=engine, checkfirst=True)
+    db = sessionmaker(bind=engine)()
+    try:
+        review.ensure_initialized(db)
+    finally:
+        db.close()
+
+
+def _user_data_version(engine: Engine) -> None:
+    add_column(engine, "users", "data_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _pregen_tables(engine: Engine) -> None:
+    for model in (models.PregenRun, models.PregenItem):
+        model.__table__.create(bind=engine, checkfirst=True)
+
+
+def _image_file_path_indexes(engine: Engine) -> None:
+    # storage の掃除・移行が file_path で3テーブルを引く
+    for model in (models.ImageCacheEntry, models.ImageVariant):
+        for ix in model.__table__.indexes:
+            if ix.name.endswith("_file_path"):
+                create_index_online(engine, ix)
+
+
+def _answer_rollups(engine: Engine) -> None:
+    for model in (models.AnswerRollup, models.AnswerLogArchive):
+        model.__table__.create(bind=engine, checkfirst=True)
+
+
+def has_autoincrement(conn, table: str) -> bool:
+    """SQLite のテーブルが AUTOINCREMENT 付きか（SQLite 以外は常に True）"""
+    if conn.dialect.name != "sqlite":
+        return True
+    ddl = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).scalar()
+    return ddl is None or "AUTOINCREMENT" in ddl.upper()
+
+
+def rebuild_with_autoincrement(engine: Engine, model) -> bool:
+    """SQLite の AUTOINCREMENT の無い INTEGER PRIMARY KEY は、最大の行を消すとその id を再利用する。
+    テーブルを AUTOINCREMENT 付きで作り直す（作り直し → コピー → 旧テーブル削除 → 改名）。
+
+    BEGIN IMMEDIATE で書き込みロックを取ってから確認するので、同時に起動した別ワーカーは待たされ、
+    ロックが取れた時点では作り直し済みなので何もしない。Postgres の SERIAL は再利用しないので対象外。
+    """
+    if engine.dialect.name != "sqlite":
+        return False
+    t = model.__table__
+    create = str(CreateTable(t).compile(dialect=engine.dialect)).replace(
+        f"CREATE TABLE {t.name}", f"CREATE TABLE {t.name}_rebuild", 1)
+    cols = ", ".join(c.name for c in t.columns)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            if has_autoincrement(conn, t.name):
+                conn.exec_driver_sql("ROLLBACK")
+                return False
+            conn.exec_driver_sql(create)
+            conn.exec_driver_sql(f"INSERT INTO {t.name}_rebuild ({cols}) SELECT {cols} FROM {t.name}")
+            conn.exec_driver_sql(f"DROP TABLE {t.name}")
+            conn.exec_driver_sql(f"ALTER TABLE {t.name}_rebuild RENAME TO {t.name}")
+            for ix in t.indexes:
+                conn.exec_driver_sql(str(CreateIndex(ix).compile(dialect=engine.dialect)))
+            conn.exec_driver_sql("COMMIT")
+        except Exception:
+            conn.exec_driver_sql("ROLLBACK")
+            raise
+    return True
+
+
+def _answer_logs_autoincrement(engine: Engine) -> None:
+    # 古い回答をアーカイブへ移すと最大の id が消えることがあり、再利用されるとアーカイブの id とぶつかる
+    rebuild_with_autoincrement(engine, models.AnswerLog)
+
+
+def _users_last_seen(engine: Engine) -> None:
+    # 列を足してから作り直す（作り直しはモデルの列をコピーするので）
+    add_column(engine, "users", "last_seen_at", "TIMESTAMP")
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE users SET last_seen_at = created_at WHERE last_seen_at IS NULL"))
+    rebuild_with_autoincrement(engine, models.User)
+
+
+def _quiz_stats_latest(engine: Engine) -> None:
+    from .services import stats
+
+    add_column(engine, "quiz_stats", "last_answered_at", "TIMESTAMP")
+    add_column(engine, "quiz_stats", "last_correct", "BOOLEAN")
+    db = sessionmaker(bind=engine)()
+    try:
+        qs = models.QuizStats.__table__
+        rows = [{"qid": qid, "at": at, "ok": bool(ok)} for qid, at, ok in stats._latest_answers(db)]
+        if rows:
+            db.execute(
+                update(qs).where(qs.c.quiz_id == bindparam("qid"), qs.c.last_answered_at.is_(None))
+                .values(last_answered_at=bindparam("at"), last_correct=bindparam("ok")),
+                rows,
+            )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _ordered_lookup_indexes(engine: Engine) -> None:
+    # check-plans が一時ソート（USE TEMP B-TREE）を見つけた2か所。並び順までインデックスで読めるようにする
+    for model, name in ((models.ReviewState, "ix_review_states_user_due_quiz"), (models.ImageJob, "ix_image_jobs_quiz_created")):
+        create_index_online(engine, next(ix for ix in model.__table__.indexes if ix.name == name))
+    drop_index_online(engine, "ix_review_states_user_due")
+
+
+def _image_job_error_kind(engine: Engine) -> None:
+    add_column(engine, "image_jobs", "error_kind", "VARCHAR")
+
+
+def _quiz_grams(engine: Engine) -> None:
+    from .services import search
+
+    models.QuizGram.__table__.create(bind=engine, checkfirst=True)
+    db = sessionmaker(bind=engine)()
+    try:
+        search.rebuild_grams(db)
+    finally:
+        db.close()
+
+
+def _quiz_answer_alternates(engine: Engine) -> None:
+    from .services import grading
+
+    # 既存のクイズは偽のまま（"|" を含む正解の意味を変えない）。キーは新しい規則で作り直す
+    add_column(engine, "quizzes", "answer_alternates", "BOOLEAN NOT NULL DEFAULT FALSE")
+    db = sessionmaker(bind=engine)()
+    try:
+        grading.rekey_quizzes(db)
+    finally:
+        db.close()
+
+
+# (version, name, fn)。追加するときは末尾に足す。既存のものは書き換えない
+MIGRATIONS: List[Tuple[int, str, Callable[[Engine], None]]] = [
+    (1, "baseline", _baseline),
+    (2, "hot_path_composite_indexes", _hot_path_indexes),
+    (3, "stats_backfill", _stats_backfill),
+    (4, "quiz_answer_keys", _quiz_answer_keys),
+    (5, "review_states", _review_states),
+    (6, "user_data_version", _user_data_version),
+    (7, "pregen_tables", _pregen_tables),
+    (8, "image_file_path_indexes", _image_file_path_indexes),
+    (9, "answer_rollups", _answer_rollups),
+    (10, "answer_logs_autoincrement", _answer_logs_autoincrement),
+    (11, "users_last_seen", _users_last_seen),
+    (12, "quiz_stats_latest", _quiz_stats_latest),
+    (13, "ordered_lookup_indexes", _ordered_lookup_indexes),
+    (14, "image_job_error_kind", _image_job_error_kind),
+    (15, "quiz_grams", _quiz_grams),
+    (16, "quiz_answer_alternates", _quiz_answer_alternates),
+]
+
+
+# ---- 実行 ----
+def _ensure_version_table(engine: Engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"
+        ))
+
+
+def applied_versions(engine: Engine) -> set:
+    _ensure_version_table(engine)
+    with engine.connect() as conn:
+        return {r[0] for r in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+
+def migrate(engine: Engine) -> List[str]:
+    done = applied_versions(engine)
+    applied = []
+    for version, name, fn in MIGRATIONS:
+        if version in done:
+            continue
+        log.info(f"[Migrate] applying {version:04d}_{name}")
+        fn(engine)
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)"),
+                    {"v": version, "n": name, "t": datetime.utcnow()},
+                )
+        except IntegrityError:
+            pass  # 別プロセスが同時に適用済み
+        applied.append(f"{version:04d}_{name}")
+    return applied
+
+
+# ---- クエリプランの確認 ----
+def _crud_workload(db, user, quiz, image):
+    """確認対象の crud 呼び出し（ユーザー単位で使う読み取り系）"""
+    from . import crud
+    from .services import image_cache, search, storage
+
+    crud.get_user_by_token(db, user.token)
+    crud.get_quiz_owned(db, quiz.id, user)
+    for status in ("all", "incorrect_only", "unanswered_only"):
+        crud.list_quizzes_page(db, user, None, "created_desc", 0, 50, status)
+    cur = crud.encode_list_cursor(quiz.created_at, quiz.id)
+    crud.list_quizzes_page(db, user, None, "created_desc", 0, 50, "all", cursor=cur)
+    crud.list_quizzes_page(db, user, None, "created_asc", 0, 50, "all", cursor=cur)
+    crud.list_quizzes(db, user, None, "created_desc", 0, 50)
+    crud.list_images_by_quiz(db, quiz)
+    crud.get_latest_image_by_quiz(db, quiz)
+    crud.get_quiz_attempts(db, user, quiz)
+    crud.get_quiz_last_correct(db, user, quiz)
+    crud.find_inflight_image_job(db, quiz, None, force=False)
+    crud.get_stats_summary(db, user)
+    crud.get_quiz_stats(db, user)
+    crud.get_review_queue(db, user, include_new=True)
+    image_cache.ImageCache(db).ref_counts([image.file_path])
+    image_cache.ImageCache(db).releasable([image.file_path])
+    storage.referenced(db, [image.file_path])
+    search.search_quizzes(db, user, "question")
+    search.search_quizzes(db, user, "qu")                 # 3文字未満は quiz_grams
+    search.search_quizzes(db, user, "question 1")
+    crud.list_quizzes_page(db, user, "qu", "created_desc", 0, 50, "all")
+
+
+# 全件（全インデックス）走査・一時ソートの行。SEARCH（インデックスで範囲を絞る）と仮想テーブル（FTS の MATCH）は可。
+# サブクエリやビューの SCAN も対象にする（中身を一度全部作ってから読んでいる）
+_SQLITE_BAD_PLAN = re.compile(r"^(?:SCAN (?!CONSTANT ROW)(?!\S+ VIRTUAL TABLE)|USE TEMP B-TREE)")
+
+
+# 理由があって許すもの: (SQL に含まれる文字列, プランの行)
+_SQLITE_PLAN_ALLOWED = (
+    # 検索の関連度順（bm25）はインデックスにできない。並べるのは MATCH した行だけ
+    ("ORDER BY rank", "USE TEMP B-TREE FOR ORDER BY"),
+)
+
+
+def _full_scans_sqlite(conn, sql, params) -> List[str]:
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params).all()
+    allowed = {detail for marker, detail in _SQLITE_PLAN_ALLOWED if marker in sql}
+    return [r[-1] for r in rows if _SQLITE_BAD_PLAN.match(r[-1]) and r[-1] not in allowed]
+
+
+def _full_scans_pg(conn, sql, params) -> List[str]:
+    # enable_seqscan = off でも残る Seq Scan は、使えるインデックスが無いということ
+    rows = conn.exec_driver_sql("EXPLAIN " + sql, params).all()
+    return [r[0].strip() for r in rows if "Seq Scan on" in r[0]]
+
+
+def check_query_plans(url: str = "") -> List[str]:
+    """crud のクエリを実際に流し、EXPLAIN で全件走査・一時ソートになっているものを返す。
+
+    url 省略時は一時 SQLite を作る。Postgres を指定する場合は空のテスト用DBを使うこと。
+    """
+    tmpdir = None
+    if not url:
+        tmpdir = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(tmpdir, "plan_check.db")
+    engine = create_engine(url)
+    migrate(engine)
+    from .services import search
+    search.setup(engine)
+
+    Session = sessionmaker(bind=engine)
+    db = Session()
+    # 少量のデータを入れておく（空テーブルだとプランナが手を抜くことがある）
+    users = [models.User(token=f"plan-check-{i}") for i in range(3)]
+    db.add_all(users); db.flush()
+    now = datetime.utcnow()
+    for u in users:
+        for j in range(20):
+            qz = models.Quiz(user_id=u.id, question=f"question {j}", answer=f"answer {j}", created_at=now - timedelta(minutes=j))
+            db.add(qz); db.flush()
+            db.add(models.AnswerLog(user_id=u.id, quiz_id=qz.id, is_correct=bool(j % 2), user_answer="x", answered_at=now))
+            db.add(models.GeneratedImage(quiz_id=qz.id, file_path=f"static/images/plan_{qz.id}.png", created_at=now))
+    db.commit()
+    search.rebuild_grams(db)
+    user = users[0]
+    quiz = db.query(models.Quiz).filter(models.Quiz.user_id == user.id).first()
+    image = db.query(models.GeneratedImage).filter(models.GeneratedImage.quiz_id == quiz.id).first()
+
+    captured: List[Tuple[str, object]] = []
+
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", _capture)
+    try:
+        _crud_workload(db, user, quiz, image)
+    finally:
+        event.remove(engine, "before_cursor_execute", _capture)
+        db.close()
+
+    problems = []
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            conn.exec_driver_sql("SET enable_seqscan = off")
+        checker = _full_scans_pg if engine.dialect.name == "postgresql" else _full_scans_sqlite
+        for sql, params in captured:
+            for detail in checker(conn, sql, params):
+                problems.append(f"{detail}\n    {' '.join(sql.split())[:300]}")
+    engine.dispose()
+    return problems
+
+
+def main(argv=None) -> int:
+    from .database import engine
+
+    ap = argparse.ArgumentParser(prog="python -m app.migrations", description="スキーマのマイグレーション")
+    ap.add_argument("command", choices=["upgrade", "status", "check-plans"])
+    ap.add_argument("--url", default="", help="check-plans 用の DB（省略時は一時 SQLite）")
+    args = ap.parse_args(argv)
+    if args.command == "upgrade":
+        for name in migrate(engine):
+            print(f"applied {name}")
+        return 0
+    if args.command == "status":
+        done = applied_versions(engine)
+        for version, name, _ in MIGRATIONS:
+            print(f"[{'x' if version in done else ' '}] {version:04d}_{name}")
+        return 0
+    problems = check_query_plans(args.url)
+    for p in problems:
+        print("FULL SCAN:", p)
+    print("OK" if not problems else f"{len(problems)} full scan(s)")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Boolean, Index, Float, false
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -8,6 +8,13 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     token = Column(String, unique=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # 最後にトークンが使われた時刻（services/user_cache.py。キャッシュを外れたときだけ、1時間単位で更新）
+    last_seen_at = Column(DateTime, default=datetime.utcnow)
+    # データが変わるたびに 1 増える（一覧・集計の ETag。services/response_cache.py）
+    data_version = Column(Integer, nullable=False, default=0, server_default="0")
+
+    # 消したユーザーの id を新しいユーザーに使い回さない（別プロセスのキャッシュに古い対応が残りうる）
+    __table_args__ = ({"sqlite_autoincrement": True},)
 
     quizzes = relationship("Quiz", back_populates="user", cascade="all, delete")
     answer_logs = relationship("AnswerLog", back_populates="user", cascade="all, delete")
@@ -17,12 +24,32 @@ class Quiz(Base):
     id = Column(Integer, primary_key=True, index=True)
     question = Column(String, nullable=False)
     answer  = Column(String, nullable=False)
+    # 採点用に正規化した正解（別解は改行区切り）。services/grading.py の規則の版と一緒に持つ
+    answer_key = Column(String)
+    answer_key_version = Column(Integer)
+    # 正解の "|" を別解の区切りとして読むか。区切りの規則ができる前のクイズは偽（"|" も正解の一部）
+    answer_alternates = Column(Boolean, nullable=False, default=True, server_default=false())
     created_at = Column(DateTime, default=datetime.utcnow)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
+    # 一覧（user_id で絞って created_at, id 順）と、インポート時の重複チェック
+    __table_args__ = (
+        Index("ix_quizzes_user_created", "user_id", "created_at", "id"),
+        Index("ix_quizzes_user_question", "user_id", "question"),
+    )
+
     user = relationship("User", back_populates="quizzes")
     images = relationship("GeneratedImage", back_populates="quiz", cascade="all, delete")
     answer_logs = relationship("AnswerLog", back_populates="quiz", cascade="all, delete")
+    image_jobs = relationship("ImageJob", back_populates="quiz", cascade="all, delete")
+
+class QuizGram(Base):
+    """検索用の文字 1-gram / 2-gram（小文字化）。3文字未満の語は trigram の索引で引けないので、こちらを主キーで引く。
+    services/search.py がクイズの作成・インポート・削除と同じトランザクションで書く"""
+    __tablename__ = "quiz_grams"
+    user_id = Column(Integer, primary_key=True)
+    gram = Column(String, primary_key=True)
+    quiz_id = Column(Integer, primary_key=True)
 
 class GeneratedImage(Base):
     __tablename__ = "generated_images"
@@ -32,7 +59,40 @@ class GeneratedImage(Base):
     prompt = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # 最新画像の取得と、ファイルの参照カウント
+    __table_args__ = (
+        Index("ix_generated_images_quiz_created", "quiz_id", "created_at"),
+        Index("ix_generated_images_file_path", "file_path"),
+    )
+
     quiz = relationship("Quiz", back_populates="images")
+    variants = relationship("ImageVariant", back_populates="image", cascade="all, delete",
+                            order_by="ImageVariant.width")
+
+class ImageVariant(Base):
+    """サムネイル・WebP/AVIF などの派生画像（生成後にバックグラウンドで作る）"""
+    __tablename__ = "image_variants"
+    id = Column(Integer, primary_key=True, index=True)
+    image_id = Column(Integer, ForeignKey("generated_images.id", ondelete="CASCADE"), nullable=False, index=True)
+    format = Column(String, nullable=False)   # webp | avif
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    size_bytes = Column(Integer, nullable=False, default=0)
+    file_path = Column(String, nullable=False, index=True)   # 孤立ファイルの掃除で引く
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    image = relationship("GeneratedImage", back_populates="variants")
+
+class ImageCacheEntry(Base):
+    """生成パラメータのハッシュ → 内容ハッシュ名で保存した画像ファイル"""
+    __tablename__ = "image_cache"
+    param_key = Column(String, primary_key=True)        # sha256(prompt, steps, width, height, model)
+    content_hash = Column(String, nullable=False, index=True)
+    file_path = Column(String, nullable=False, index=True)   # 参照カウント・掃除で引く
+    size_bytes = Column(Integer, nullable=False, default=0)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 class AnswerLog(Base):
     __tablename__ = "answer_logs"
@@ -44,5 +104,133 @@ class AnswerLog(Base):
     image_shown = Column(Boolean, default=False)  # 画像が表示されていたか（介入有無）
     answered_at = Column(DateTime, default=datetime.utcnow)
 
+    # (user, quiz) ごとの回答履歴を answered_at 順に読む（ステータス・集計の再構築）
+    # SQLite でも id を再利用させない（古い行をアーカイブへ移すので、最大の id が消えることがある）
+    __table_args__ = (
+        Index("ix_answer_logs_user_quiz_answered", "user_id", "quiz_id", "answered_at"),
+        {"sqlite_autoincrement": True},
+    )
+
     user = relationship("User", back_populates="answer_logs")
     quiz = relationship("Quiz", back_populates="answer_logs")
+
+class AnswerRollup(Base):
+    """アーカイブ済みの回答の日次集計（services/compaction.py）。ステータス・集計は answer_logs と足して使う"""
+    __tablename__ = "answer_rollups"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)                  # answered_at の日付（UTC）
+    image_shown = Column(Boolean, primary_key=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    correct_attempts = Column(Integer, nullable=False, default=0)
+    last_answered_at = Column(DateTime, nullable=False)   # この区切りの最後の回答（直近の正誤を出すため）
+    last_correct = Column(Boolean, nullable=False)
+
+class AnswerLogArchive(Base):
+    """answer_logs から移した古い回答（id はそのまま）。再構築・再採点・エクスポートだけが読む"""
+    __tablename__ = "answer_logs_archive"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, nullable=False)
+    quiz_id = Column(Integer, nullable=False)
+    is_correct = Column(Boolean, nullable=False)
+    user_answer = Column(String)
+    image_shown = Column(Boolean, default=False)
+    answered_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_answer_logs_archive_user_quiz_answered", "user_id", "quiz_id", "answered_at"),
+    )
+
+class ImageJob(Base):
+    __tablename__ = "image_jobs"
+    id = Column(String, primary_key=True)  # uuid4 hex
+    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    prompt = Column(String)
+    force = Column(Boolean, default=False)
+    status = Column(String, nullable=False, default="queued", index=True)  # queued | running | done | failed
+    image_id = Column(Integer, ForeignKey("generated_images.id", ondelete="SET NULL"))
+    error = Column(String)
+    error_kind = Column(String)   # failed の原因: unavailable | quota | not_found | error（同期の生成ルートが HTTP ステータスに使う）
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # 同じクイズの処理中ジョブを古い順に探す（送信の合流）
+    __table_args__ = (
+        Index("ix_image_jobs_quiz_created", "quiz_id", "created_at"),
+    )
+
+    quiz = relationship("Quiz", back_populates="image_jobs")
+    image = relationship("GeneratedImage")
+
+class AnswerIdempotency(Base):
+    """クライアント発行の冪等キー。再送された回答を二重に記録しないため"""
+    __tablename__ = "answer_idempotency"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    key = Column(String, primary_key=True)
+    answer_log_id = Column(Integer, ForeignKey("answer_logs.id", ondelete="CASCADE"), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class UserStats(Base):
+    """ユーザー単位の集計（crud の書き込みと同じトランザクションで更新）"""
+    __tablename__ = "user_stats"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    total_quizzes = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    correct_attempts = Column(Integer, nullable=False, default=0)
+    attempts_image = Column(Integer, nullable=False, default=0)   # image_shown=True の回答数
+    correct_image = Column(Integer, nullable=False, default=0)
+
+class QuizStats(Base):
+    """クイズ単位の集計"""
+    __tablename__ = "quiz_stats"
+    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    correct_attempts = Column(Integer, nullable=False, default=0)
+    attempts_image = Column(Integer, nullable=False, default=0)
+    correct_image = Column(Integer, nullable=False, default=0)
+    last_answered_at = Column(DateTime)   # 直近の回答（一覧の正誤ステータス・絞り込みに使う）
+    last_correct = Column(Boolean)
+
+class ReviewState(Base):
+    """(user, quiz) ごとの復習スケジュール（SM-2。services/review.py が回答のたびに更新）"""
+    __tablename__ = "review_states"
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"), primary_key=True)
+    ease = Column(Float, nullable=False, default=2.5)
+    interval_days = Column(Integer, nullable=False, default=0)
+    repetitions = Column(Integer, nullable=False, default=0)   # 連続正解回数（不正解で 0 に戻る）
+    lapses = Column(Integer, nullable=False, default=0)        # 不正解の回数
+    due_at = Column(DateTime, nullable=False)
+    last_answered_at = Column(DateTime)
+
+    # 次に復習するクイズを (due_at, quiz_id) 順に先頭から読む
+    __table_args__ = (
+        Index("ix_review_states_user_due_quiz", "user_id", "due_at", "quiz_id"),
+    )
+
+class PregenRun(Base):
+    """画像の一括事前生成（services/pregenerate.py）。対象は作成時に pregen_items に固定する"""
+    __tablename__ = "pregen_runs"
+    id = Column(Integer, primary_key=True, index=True)
+    ordering = Column(String, nullable=False)           # most_answered | newest
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))  # None なら全ユーザー
+    status = Column(String, nullable=False, default="pending")  # pending | running | stopping | paused | done
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # 実行中は定期的に更新（生存確認）
+    finished_at = Column(DateTime)
+
+class PregenItem(Base):
+    __tablename__ = "pregen_items"
+    run_id = Column(Integer, ForeignKey("pregen_runs.id", ondelete="CASCADE"), primary_key=True)
+    seq = Column(Integer, primary_key=True)              # 処理順（1 始まり）
+    quiz_id = Column(Integer, ForeignKey("quizzes.id", ondelete="CASCADE"), nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending | done | skipped | failed
+    error = Column(String)
+
+    # 未処理分を seq 順に読む・状態ごとの件数
+    __table_args__ = (
+        Index("ix_pregen_items_run_status_seq", "run_id", "status", "seq"),
+    )
@@ -1,11 +1,20 @@
+import secrets
+from datetime import datetime
 from typing import Optional, List
 from uuid import uuid4
-from fastapi import APIRouter, Depends, HTTPException, Header, Response, Query
+from fastapi import APIRouter, Depends, HTTPException, Header, Response, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from .database import get_db
 from . import crud, schemas, models
-from .services.image_service import ImageService
+from .config import settings
+from .services.image_jobs import image_jobs
+from .services.image_variants import pick_variant
+from .services import export, quiz_import, search, pregenerate
+from .services.user_cache import resolve_user_id, token_cache, user_matches
+from .services.response_cache import response_cache, serialize
 
 router = APIRouter()
 
@@ -14,29 +23,92 @@ def get_current_user(
     db: Session = Depends(get_db),
     x_token: Optional[str] = Header(default=None, alias="X-Token"),
 ) -> models.User:
-    token = x_token or str(uuid4())
-    user = crud.get_or_create_user(db, token)
+    """読み取り用。ユーザー行は作らない（未登録なら id=None の一時オブジェクト）"""
     if x_token is None:
+        token = str(uuid4())
         response.headers["X-Token-Issued"] = token
+        return models.User(id=None, token=token)
+    return models.User(id=resolve_user_id(db, x_token), token=x_token)
+
+def get_write_user(
+    db: Session = Depends(get_db),
+    user: models.User = Depends(get_current_user),
+) -> models.User:
+    """書き込み用（削除・回答・画像生成など。行は作らない）。キャッシュの id を (id, token) で DB と照合する
+    （別プロセスで掃除されたユーザーの id をキャッシュが持ち続けていることがある）"""
+    if user.id is not None and not user_matches(db, user.id, user.token):
+        token_cache.invalidate(token=user.token)
+        user.id = resolve_user_id(db, user.token)
+    return user
+
+def get_or_create_current_user(
+    db: Session = Depends(get_db),
+    user: models.User = Depends(get_write_user),
+) -> models.User:
+    """書き込み用。ここで初めてユーザー行を作る"""
+    if user.id is None:
+        created = crud.get_or_create_user(db, user.token)
+        token_cache.put(created.token, created.id)
+        user.id = created.id
     return user
 
+def is_admin(x_admin_token: Optional[str] = Header(default=None, alias="X-Admin-Token")) -> bool:
+    return bool(settings.ADMIN_TOKEN) and x_admin_token is not None and secrets.compare_digest(x_admin_token, settings.ADMIN_TOKEN)
+
+def require_admin(admin: bool = Depends(is_admin)) -> None:
+    if not admin:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
 # ----- Quiz CRUD -----
 @router.post("/quiz/create", response_model=schemas.QuizOut)
-def create_quiz(payload: schemas.QuizCreate, db: Session = Depends(get_db), user: models.User = Depends(get_current_user)):
+def create_quiz(payload: schemas.QuizCreate, db: Session = Depends(get_db), user: models.User = Depends(get_or_create_current_user)):
     return crud.create_quiz(db, user=user, question=payload.question, answer=payload.answer)
 
+@router.post("/quiz/import", response_model=schemas.ImportResult)
+async def import_quizzes(
+    request: Request,
+    dedupe: bool = Query(default=False, description="同じ question が既にあれば追加しない"),
+    db: Session = Depends(get_db), user: models.User = Depends(get_or_create_current_user),
+):
+    """CSV（question,answer）/ NDJSON / JSON 配列を本文にそのまま送る"""
+    report = await quiz_import.import_stream(
+        db, user, request.stream(), request.headers.get("content-type", ""), dedupe, run_in_threadpool,
+    )
+    return report.as_dict()
+
 @router.get("/quiz/list", response_model=List[schemas.QuizWithStatusOut])
 def list_quizzes(
+    request: Request,
+    response: Response,
     q: Optional[str] = Query(default=None, description="部分一致検索"),
     order: str = Query(default="created_desc", pattern="^(created_desc|created_asc)$"),
     status: str = Query(default="all", pattern="^(all|incorrect_only|unanswered_only)$"),
-    offset: int = 0, limit: int = 200,
+    offset: int = 0, limit: int = Query(default=200, ge=1, le=1000),
+    cursor: Optional[str] = Query(default=None, description="前ページの X-Next-Cursor"),
     db: Session = Depends(get_db), user: models.User = Depends(get_current_user),
 ):
-    return crud.list_quizzes_with_status(db, user, q, order, offset, limit, status)
+    version = crud.get_data_version(db, user)
+    cached = response_cache.lookup(request, user.id, version)
+    if cached is not None:
+        return cached
+    try:
+        items, next_cursor = crud.list_quizzes_page(db, user, q, order, offset, limit, status, cursor=cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response_cache.store(request, user.id, version, serialize(schemas.QuizWithStatusList, items, trusted=True), dict(response.headers))
+
+@router.get("/quiz/search", response_model=List[schemas.QuizSearchOut])
+def search_quizzes(
+    q: str = Query(min_length=1, max_length=200),
+    offset: int = 0, limit: int = Query(default=50, ge=1, le=200),
+    db: Session = Depends(get_db), user: models.User = Depends(get_current_user),
+):
+    return search.search_quizzes(db, user, q, offset=offset, limit=limit)
 
 @router.delete("/quiz/{quiz_id}", status_code=204)
-def delete_quiz(quiz_id: int, db: Session = Depends(get_db), user: models.User = Depends(get_current_user)):
+def delete_quiz(quiz_id: int, db: Session = Depends(get_db), user: models.User = Depends(get_write_user)):
     ok = crud.delete_quiz_owned(db, quiz_id=quiz_id, user=user)
     if not ok:
         raise HTTPException(status_code=404, detail="Quiz not found")
@@ -44,34 +116,102 @@ def delete_quiz(quiz_id: int, db: Session = Depends(get_db), user: models.User =
 
 # ----- Image -----
 @router.get("/quiz/{quiz_id}/images/latest", response_model=Optional[schemas.ImageOut])
-def latest_image(quiz_id: int, db: Session = Depends(get_db), user: models.User = Depends(get_current_user)):
+def latest_image(
+    quiz_id: int,
+    w: Optional[int] = Query(default=None, ge=1, le=4096, description="表示幅(px)。url にこれ以上で最小の派生画像を返す"),
+    fmt: str = Query(default="webp", pattern="^(webp|avif|png)$"),
+    db: Session = Depends(get_db), user: models.User = Depends(get_current_user),
+):
     quiz = crud.get_quiz_owned(db, quiz_id=quiz_id, user=user)
     if not quiz:
         raise HTTPException(status_code=404, detail="Quiz not found")
-    return crud.get_latest_image_by_quiz(db, quiz=quiz)
+    im = crud.get_latest_image_by_quiz(db, quiz=quiz)
+    if im is None:
+        return None
+    out = schemas.ImageOut.model_validate(im)
+    out.url = pick_variant(im, w, fmt)
+    return out
+
+# 同期の生成ルートが待つ上限（A1111 の空き待ち + リトライ込みの生成時間。以前ルート内で直接生成していたときと同じ）
+GENERATE_WAIT = settings.A1111_QUEUE_TIMEOUT + settings.A1111_TIMEOUT * (settings.A1111_RETRIES + 1)
+JOB_ERROR_STATUS = {"unavailable": 503, "quota": 507, "not_found": 404}
 
 @router.post("/quiz/image/generate", response_model=schemas.ImageOut)
-def generate_image(
+async def generate_image(
     body: schemas.ImageGenerateIn,
     force: bool = Query(default=False, description="旧画像を全削除してから生成"),
     db: Session = Depends(get_db),
-    user: models.User = Depends(get_current_user),
+    user: models.User = Depends(get_write_user),
+):
+    """ジョブキューに入れて完了まで待つ（/quiz/image/jobs + long-poll と同じ経路）。待つ間は DB 接続を持たない"""
+    job_id = await run_in_threadpool(_submit_image_job, db, body, force, user)
+    if job_id is None:
+        raise HTTPException(status_code=404, detail="Quiz not found")
+    await image_jobs.wait_finished_async(job_id, GENERATE_WAIT)
+    status, image, kind, error = await run_in_threadpool(_load_job_result, db, job_id)
+    if status == "done" and image is not None:
+        return image
+    if status in crud.JOB_INFLIGHT:
+        raise HTTPException(status_code=504, detail=f"Image generation still running: poll /quiz/image/jobs/{job_id}")
+    if kind == "unavailable":
+        error = f"Image backend unavailable: {error}"
+    raise HTTPException(status_code=JOB_ERROR_STATUS.get(kind, 500), detail=error or "Image generation failed")
+
+def _submit_image_job(db: Session, body: schemas.ImageGenerateIn, force: bool, user: models.User) -> Optional[str]:
+    try:
+        quiz = crud.get_quiz_owned(db, quiz_id=body.quiz_id, user=user)
+        if not quiz:
+            return None
+        return image_jobs.submit(db, user=user, quiz=quiz, prompt=body.prompt, force=force).id
+    finally:
+        db.close()
+
+def _load_job_result(db: Session, job_id: str):
+    """(status, ImageOut, error_kind, error) を読んで close する"""
+    try:
+        job = crud.get_image_job(db, job_id)
+        if job is None:   # 待っている間にクイズごと消された
+            return "failed", None, "not_found", "Quiz not found"
+        image = schemas.ImageOut.model_validate(job.image) if job.image is not None else None
+        return job.status, image, job.error_kind, job.error
+    finally:
+        db.close()
+
+@router.post("/quiz/image/jobs", response_model=schemas.ImageJobOut, status_code=202)
+def submit_image_job(
+    body: schemas.ImageGenerateIn,
+    force: bool = Query(default=False, description="旧画像を全削除してから生成"),
+    db: Session = Depends(get_db),
+    user: models.User = Depends(get_write_user),
 ):
     quiz = crud.get_quiz_owned(db, quiz_id=body.quiz_id, user=user)
     if not quiz:
         raise HTTPException(status_code=404, detail="Quiz not found")
+    return image_jobs.submit(db, user=user, quiz=quiz, prompt=body.prompt, force=force)
 
-    service = ImageService()
-
-    if force:
-        imgs = crud.list_images_by_quiz(db, quiz=quiz)
-        # 旧画像ファイル削除
-        service.delete_files([im.file_path for im in imgs])
-        # DBレコード削除
-        crud.delete_images_by_quiz(db, quiz=quiz)
+@router.get("/quiz/image/jobs/{job_id}", response_model=schemas.ImageJobOut)
+async def get_image_job(
+    job_id: str,
+    wait: float = Query(default=0, ge=0, le=30, description="完了まで最大 wait 秒待つ（long-poll）"),
+    db: Session = Depends(get_db),
+    user: models.User = Depends(get_current_user),
+):
+    job = await run_in_threadpool(_load_image_job, db, job_id, user)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if wait and job.status in crud.JOB_INFLIGHT:
+        # 待っている間は DB の接続を持たない（long-poll が並ぶとプールを使い切って他のルートが止まる）
+        await image_jobs.wait_async(job_id, wait)
+        job = await run_in_threadpool(_load_image_job, db, job_id, user)
+    return job
 
-    rel_path = service.generate_image_for_quiz(quiz_id=quiz.id, prompt=body.prompt, force_delete_before=False)
-    return crud.add_image(db, quiz=quiz, file_path=rel_path, prompt=body.prompt)
+def _load_image_job(db: Session, job_id: str, user: models.User) -> Optional[schemas.ImageJobOut]:
+    """読んでレスポンスの形にしてから close し、接続をプールに返す（db はこのあとも使える）"""
+    try:
+        job = crud.get_image_job_owned(db, job_id, user)
+        return schemas.ImageJobOut.model_validate(job) if job else None
+    finally:
+        db.close()
 
 # ----- Answer & Stats -----
 @router.post("/quiz/{quiz_id}/answer", response_model=schemas.AnswerResultOut)
@@ -79,7 +219,7 @@ def answer_quiz(
     quiz_id: int,
     body: schemas.AnswerIn,
     db: Session = Depends(get_db),
-    user: models.User = Depends(get_current_user),
+    user: models.User = Depends(get_write_user),
 ):
     quiz = crud.get_quiz_owned(db, quiz_id=quiz_id, user=user)
     if not quiz:
@@ -87,6 +227,103 @@ def answer_quiz(
     ok, _ = crud.log_answer(db, user=user, quiz=quiz, user_answer=body.answer, image_shown=body.image_shown)
     return {"quiz_id": quiz.id, "correct": ok, "image_shown": body.image_shown}
 
+@router.post("/quiz/answers/batch", response_model=schemas.AnswerBatchOut)
+def answer_batch(
+    body: schemas.AnswerBatchIn,
+    db: Session = Depends(get_db),
+    user: models.User = Depends(get_write_user),
+):
+    return {"results": crud.log_answers_batch(db, user=user, items=body.items)}
+
 @router.get("/stats/summary", response_model=schemas.StatsSummary)
-def stats_summary(db: Session = Depends(get_db), user: models.User = Depends(get_current_user)):
-    return crud.get_stats_summary(db, user=user)
+def stats_summary(request: Request, response: Response, db: Session = Depends(get_db), user: models.User = Depends(get_current_user)):
+    version = crud.get_data_version(db, user)
+    cached = response_cache.lookup(request, user.id, version)
+    if cached is not None:
+        return cached
+    body = serialize(schemas.StatsSummaryAdapter, crud.get_stats_summary(db, user=user), trusted=True)
+    return response_cache.store(request, user.id, version, body, dict(response.headers))
+
+@router.get("/stats/quizzes", response_model=List[schemas.QuizStatsOut])
+def stats_quizzes(
+    request: Request, response: Response,
+    offset: int = 0, limit: int = Query(default=200, ge=1, le=1000),
+    db: Session = Depends(get_db), user: models.User = Depends(get_current_user),
+):
+    version = crud.get_data_version(db, user)
+    cached = response_cache.lookup(request, user.id, version)
+    if cached is not None:
+        return cached
+    body = serialize(schemas.QuizStatsList, crud.get_quiz_stats(db, user=user, offset=offset, limit=limit), trusted=True)
+    return response_cache.store(request, user.id, version, body, dict(response.headers))
+
+@router.get("/review/next", response_model=List[schemas.ReviewItemOut])
+def review_next(
+    limit: int = Query(default=20, ge=1, le=200),
+    include_new: bool = Query(default=False, description="期限の来たものが足りなければ未回答のクイズで埋める"),
+    db: Session = Depends(get_db), user: models.User = Depends(get_current_user),
+):
+    return crud.get_review_queue(db, user=user, limit=limit, include_new=include_new)
+
+# ----- Export -----
+@router.get("/export/answers")
+def export_answers(
+    format: str = Query(default="csv", pattern="^(csv|ndjson)$"),
+    since: Optional[datetime] = Query(default=None, description="answered_at >= since"),
+    until: Optional[datetime] = Query(default=None, description="answered_at < until"),
+    after_id: Optional[int] = Query(default=None, description="この id より後から再開"),
+    user_id: Optional[int] = Query(default=None, description="管理者のみ。省略時は全ユーザー"),
+    admin: bool = Depends(is_admin),
+    user: models.User = Depends(get_current_user),
+):
+    # 一般ユーザーは自分の回答だけ。管理者は user_id 指定（省略で全員分）
+    if admin:
+        body = export.stream_export(format, user_id=user_id, since=since, until=until, after_id=after_id)
+    elif user.id is None:
+        body = export.ENCODERS[format](iter(()))  # 未登録ユーザー：ヘッダのみ
+    else:
+        body = export.stream_export(format, user_id=user.id, since=since, until=until, after_id=after_id)
+    return StreamingResponse(body, media_type=export.MEDIA_TYPES[format], headers={
+        "Content-Disposition": f'attachment; filename="answer_logs.{format}"',
+    })
+
+# ----- Admin: 画像の一括事前生成 -----
+def _pregen_run_or_404(db: Session, run_id: int) -> models.PregenRun:
+    run = db.get(models.PregenRun, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
+
+@router.post("/admin/images/pregenerate", response_model=schemas.PregenRunOut, status_code=202, dependencies=[Depends(require_admin)])
+def start_pregenerate(body: schemas.PregenStartIn, db: Session = Depends(get_db)):
+    run = pregenerate.create_run(db, order=body.order, user_id=body.user_id, limit=body.limit)
+    pregenerate.pregenerator.start(
+        run.id,
+        concurrency=body.concurrency or settings.PREGEN_CONCURRENCY,
+        rate_per_min=settings.PREGEN_RATE_PER_MIN if body.rate_per_min is None else body.rate_per_min,
+    )
+    db.refresh(run)
+    return pregenerate.progress(db, run)
+
+@router.get("/admin/images/pregenerate/{run_id}", response_model=schemas.PregenRunOut, dependencies=[Depends(require_admin)])
+def pregenerate_status(run_id: int, db: Session = Depends(get_db)):
+    return pregenerate.progress(db, _pregen_run_or_404(db, run_id))
+
+@router.post("/admin/images/pregenerate/{run_id}/stop", response_model=schemas.PregenRunOut, dependencies=[Depends(require_admin)])
+def stop_pregenerate(run_id: int, db: Session = Depends(get_db)):
+    run = pregenerate.request_stop(db, _pregen_run_or_404(db, run_id))
+    pregenerate.pregenerator.stop(run_id)
+    return pregenerate.progress(db, run)
+
+@router.post("/admin/images/pregenerate/{run_id}/resume", response_model=schemas.PregenRunOut, dependencies=[Depends(require_admin)])
+def resume_pregenerate(
+    run_id: int,
+    concurrency: int = Query(default=settings.PREGEN_CONCURRENCY, ge=1, le=16),
+    rate_per_min: float = Query(default=settings.PREGEN_RATE_PER_MIN, ge=0),
+    db: Session = Depends(get_db),
+):
+    run = _pregen_run_or_404(db, run_id)
+    if not pregenerate.pregenerator.start(run.id, concurrency=concurrency, rate_per_min=rate_per_min):
+        raise HTTPException(status_code=409, detail="Run is finished or already running")
+    db.refresh(run)
+    return pregenerate.progress(db, run)
@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import Optional, List
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, TypeAdapter
 
 # ==== Quiz ====
 class QuizCreate(BaseModel):
@@ -29,17 +29,55 @@ class QuizWithStatusOut(QuizOut):
     attempts: int                 # 回答試行回数
     last_correct: Optional[bool]  # 直近の正誤（未回答なら None）
 
+class QuizSearchOut(QuizOut):
+    score: float               # 大きいほど関連度が高い（ILIKE フォールバック時は 0）
+    question_highlight: str    # HTML エスケープ済み。一致部分を <mark> で囲む
+    answer_highlight: str
+
+class ImportRowError(BaseModel):
+    row: int      # CSV / NDJSON は行番号、JSON 配列は要素番号（1 始まり）
+    error: str
+
+class ImportResult(BaseModel):
+    inserted: int
+    skipped: int                  # dedupe で飛ばした件数
+    error_count: int
+    errors: List[ImportRowError]  # 先頭 1000 件まで
+
 # ==== Image ====
 class ImageGenerateIn(BaseModel):
     quiz_id: int
     prompt: Optional[str] = None
 
+class ImageVariantOut(BaseModel):
+    format: str
+    width: int
+    height: int
+    size_bytes: int
+    file_path: str
+    class Config:
+        from_attributes = True
+
 class ImageOut(BaseModel):
     id: int
     quiz_id: int
     file_path: str
     prompt: Optional[str] = None
     created_at: datetime
+    url: Optional[str] = None                  # 表示サイズに合った派生画像（なければ元画像）
+    variants: List[ImageVariantOut] = []
+    class Config:
+        from_attributes = True
+
+class ImageJobOut(BaseModel):
+    id: str
+    quiz_id: int
+    status: str                     # queued | running | done | failed
+    prompt: Optional[str] = None
+    image: Optional[ImageOut] = None  # done のときのみ
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
     class Config:
         from_attributes = True
 
@@ -53,9 +91,82 @@ class AnswerResultOut(BaseModel):
     correct: bool
     image_shown: bool
 
+class AnswerBatchItem(BaseModel):
+    quiz_id: int
+    answer: str
+    image_shown: bool
+    client_ts: Optional[datetime] = None         # クライアント側の回答時刻（オフライン送信用）
+    idempotency_key: Optional[str] = Field(default=None, max_length=128)  # 再送時の二重記録防止
+
+class AnswerBatchIn(BaseModel):
+    items: List[AnswerBatchItem] = Field(max_length=1000)
+
+class AnswerBatchResultItem(BaseModel):
+    index: int
+    quiz_id: int
+    status: str                    # ok | duplicate | not_found
+    correct: Optional[bool] = None
+    image_shown: bool
+
+class AnswerBatchOut(BaseModel):
+    results: List[AnswerBatchResultItem]
+
 # ==== Stats ====
 class StatsSummary(BaseModel):
     total_quizzes: int
     attempts: int
     correct_attempts: int
     accuracy: float  # 0.0 - 1.0
+    # 画像表示あり／なしの比較（実験の主目的）
+    attempts_with_image: int = 0
+    accuracy_with_image: float = 0.0
+    attempts_without_image: int = 0
+    accuracy_without_image: float = 0.0
+
+class QuizStatsOut(BaseModel):
+    quiz_id: int
+    question: str
+    attempts: int
+    correct_attempts: int
+    accuracy: float
+    accuracy_with_image: float
+    accuracy_without_image: float
+
+# ==== Review ====
+class ReviewItemOut(BaseModel):
+    quiz_id: int
+    question: str
+    due_at: Optional[datetime] = None   # 未回答（is_new）のときは None
+    ease: float
+    interval_days: int
+    repetitions: int
+    lapses: int
+    is_new: bool = False
+
+# ==== Admin: 画像の一括事前生成 ====
+class PregenStartIn(BaseModel):
+    order: str = Field(default="most_answered", pattern="^(most_answered|newest)$")
+    user_id: Optional[int] = None      # 省略時は全ユーザー
+    limit: Optional[int] = Field(default=None, ge=1)
+    concurrency: Optional[int] = Field(default=None, ge=1, le=16)
+    rate_per_min: Optional[float] = Field(default=None, ge=0)
+
+class PregenRunOut(BaseModel):
+    id: int
+    ordering: str
+    user_id: Optional[int] = None
+    status: str                        # pending | running | stopping | paused | done
+    error: Optional[str] = None
+    total: int
+    pending: int
+    done: int
+    skipped: int
+    failed: int
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+# ==== シリアライズ済みで返すレスポンス（services/response_cache.py） ====
+QuizWithStatusList = TypeAdapter(List[QuizWithStatusOut])
+StatsSummaryAdapter = TypeAdapter(StatsSummary)
+QuizStatsList = TypeAdapter(List[QuizStatsOut])
@@ -0,0 +1,181 @@
+"""A1111 (Stable Diffusion WebUI) への共有クライアント
+
+- keep-alive のコネクションプールをプロセス内で使い回す
+- GPU は1台なので同時リクエスト数をセマフォで制限する（A1111_MAX_CONCURRENCY）
+- 5xx / タイムアウト / 接続エラーはジッター付き指数バックオフでリトライ
+- 連続して失敗したらサーキットブレーカーを開き、一定時間は即座に失敗させる
+"""
+import random
+import threading
+import time
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ..config import settings
+
+TXT2IMG_PATH = "/sdapi/v1/txt2img"
+
+
+class A1111Unavailable(Exception):
+    """A1111 が落ちている／混んでいて今は処理できない"""
+
+
+class A1111RetryableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """closed → (連続 threshold 回失敗) → open → (reset_after 秒) → half-open → 成功で closed"""
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_after:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            # half-open: 様子見のリクエストは1本だけ通す
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release_probe(self) -> None:
+        """様子見のリクエストが成否の分からないまま終わった（キャンセルなど）。次の1本を通せるようにする"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._opened_at is not None or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 8.0) -> float:
+    """full jitter: [0, min(cap, base * 2^attempt))"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class A1111Client:
+    def __init__(
+        self,
+        base_url: str,
+        max_concurrency: int = settings.A1111_MAX_CONCURRENCY,
+        timeout: float = settings.A1111_TIMEOUT,
+        connect_timeout: float = settings.A1111_CONNECT_TIMEOUT,
+        retries: int = settings.A1111_RETRIES,
+        queue_timeout: float = settings.A1111_QUEUE_TIMEOUT,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.queue_timeout = queue_timeout
+        self.breaker = breaker or CircuitBreaker(settings.A1111_BREAKER_THRESHOLD, settings.A1111_BREAKER_RESET)
+        self._sem = threading.BoundedSemaphore(self.max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def txt2img(self, payload: dict) -> dict:
+        if self.breaker.state == "open":
+            raise A1111Unavailable("A1111 circuit is open")
+        if not self._sem.acquire(timeout=self.queue_timeout):
+            raise A1111Unavailable("A1111 is busy")
+        try:
+            if not self.breaker.allow():
+                raise A1111Unavailable("A1111 circuit is open")
+            return self._post_with_retry(TXT2IMG_PATH, payload)
+        finally:
+            self._sem.release()
+
+    def _post_with_retry(self, path: str, payload: dict) -> dict:
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.post(url, json=payload, timeout=self.timeout)
+                if r.status_code >= 500:
+                    raise A1111RetryableError(f"A1111 returned {r.status_code}")
+                r.raise_for_status()
+                data = r.json()
+            except requests.HTTPError:
+                # 4xx はリクエスト側の問題。A1111 自体は生きている
+                self.breaker.record_success()
+                raise
+            except (requests.Timeout, requests.ConnectionError, A1111RetryableError) as e:
+                self.breaker.record_failure()
+                if attempt >= self.retries or not self.breaker.allow():
+                    raise A1111Unavailable(str(e)) from e
+                time.sleep(backoff_delay(attempt))
+                continue
+            except Exception:
+                # JSON でない 200・途中で切れた本文（ChunkedEncodingError）など。ここで記録しないと
+                # half-open の様子見が終わったことにならず、ブレーカーが開いたままになる
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            return data
+        raise A1111Unavailable("retries exhausted")  # pragma: no cover
+
+    def close(self) -> None:
+        self.session.close()
+
+
+# ---- プロセス共有のインスタンス ----
+_clients: dict[str, A1111Client] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+_lock = threading.Lock()
+
+
+def _breaker_for(base_url: str) -> CircuitBreaker:
+    b = _breakers.get(base_url)
+    if b is None:
+        b = _breakers[base_url] = CircuitBreaker(settings.A1111_BREAKER_THRESHOLD, settings.A1111_BREAKER_RESET)
+    return b
+
+
+def get_client(base_url: Optional[str] = None) -> A1111Client:
+    base_url = (base_url or settings.A1111_BASE_URL).rstrip("/")
+    with _lock:
+        c = _clients.get(base_url)
+        if c is None:
+            c = _clients[base_url] = A1111Client(base_url, breaker=_breaker_for(base_url))
+        return c
+
+
+def close_clients() -> None:
+    with _lock:
+        for c in _clients.values():
+            c.close()
+        _clients.clear()
@@ -0,0 +1,245 @@
+"""回答履歴の日次ロールアップとアーカイブ
+
+answer_logs は回答1件ごとに1行増え続ける。ANSWER_ARCHIVE_DAYS 日より前（UTC の日付単位）の行を
+
+- answer_rollups: (user, quiz, 日付, image_shown) ごとの回答数・正答数と、その区切りの最後の回答の正誤
+- answer_logs_archive: 元の行そのまま（id も同じ）
+
+に移す。1バッチ分の「answer_logs から削除・アーカイブへ追加・ロールアップへ加算」は1トランザクション。
+一覧のステータス（回答数・直近の正誤）と集計の作り直しは answer_logs と answer_rollups を足して読むので、
+畳む前後で結果は変わらない。user_stats / quiz_stats / review_states は回答のたびに更新済みなので触らない。
+畳んだ回答の冪等キーは消す（再送を重複として弾けるのは ANSWER_ARCHIVE_DAYS 日まで）。
+
+    python -m app.services.compaction run [--days 90] [--dry-run]
+    python -m app.services.compaction verify    # answer_rollups とアーカイブの突き合わせ
+    python -m app.services.compaction rebuild   # アーカイブから answer_rollups を作り直す
+
+ANSWER_COMPACT_INTERVAL を設定すると、サーバー内でも定期的に run する。
+"""
+import argparse
+import logging
+import sys
+import threading
+from datetime import datetime, time, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, delete, insert
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..database import SessionLocal
+from ..migrations import has_autoincrement
+
+log = logging.getLogger("uvicorn")
+
+RAW_COLS = ("id", "user_id", "quiz_id", "is_correct", "user_answer", "image_shown", "answered_at")
+ROLLUP_COLS = ("attempts", "correct_attempts", "last_answered_at", "last_correct")
+
+BucketKey = Tuple[int, int, object, bool]   # (user_id, quiz_id, day, image_shown)
+
+
+def cutoff_for(days: int, now: Optional[datetime] = None) -> datetime:
+    """これより前の回答を畳む（日の途中で切ると同じ日の区切りが2回に分かれるので 0 時に揃える）"""
+    now = now or datetime.utcnow()
+    return datetime.combine((now - timedelta(days=days)).date(), time.min)
+
+
+def aggregate(rows: Iterable, into: Optional[Dict[BucketKey, dict]] = None) -> Dict[BucketKey, dict]:
+    """id 順の回答を区切りごとに数える。同時刻なら後の id を「最後の回答」にする（一覧の並びと同じ）"""
+    out: Dict[BucketKey, dict] = {} if into is None else into
+    for r in rows:
+        k = (r.user_id, r.quiz_id, r.answered_at.date(), bool(r.image_shown))
+        b = out.get(k)
+        if b is None:
+            b = out[k] = {"attempts": 0, "correct_attempts": 0, "last_answered_at": r.answered_at, "last_correct": bool(r.is_correct)}
+        b["attempts"] += 1
+        if r.is_correct:
+            b["correct_attempts"] += 1
+        if r.answered_at >= b["last_answered_at"]:
+            b["last_answered_at"], b["last_correct"] = r.answered_at, bool(r.is_correct)
+    return out
+
+
+def _merge(db: Session, buckets: Dict[BucketKey, dict]) -> None:
+    """既存の区切りには足し込み、無ければ作る（遅れて届いた古い回答は既存の区切りに入る）"""
+    ar = models.AnswerRollup
+    users = {k[0] for k in buckets}
+    quizzes = {k[1] for k in buckets}
+    days = {k[2] for k in buckets}
+    existing = {
+        (r.user_id, r.quiz_id, r.day, r.image_shown): r for r in db.execute(
+            select(ar).where(ar.user_id.in_(users), ar.quiz_id.in_(quizzes), ar.day.in_(days))
+        ).scalars()
+    }
+    for k, b in buckets.items():
+        r = existing.get(k)
+        if r is None:
+            db.add(ar(user_id=k[0], quiz_id=k[1], day=k[2], image_shown=k[3], **b))
+            continue
+        r.attempts += b["attempts"]
+        r.correct_attempts += b["correct_attempts"]
+        if b["last_answered_at"] >= r.last_answered_at:
+            r.last_answered_at, r.last_correct = b["last_answered_at"], b["last_correct"]
+
+
+def compact(db: Session, days: Optional[int] = None, batch: int = 2000, dry_run: bool = False,
+            now: Optional[datetime] = None) -> dict:
+    days = settings.ANSWER_ARCHIVE_DAYS if days is None else days
+    out = {"archived": 0, "buckets": 0, "cutoff": None}
+    if days <= 0:
+        return out
+    cutoff = out["cutoff"] = cutoff_for(days, now)
+    if not dry_run and not has_autoincrement(db.connection(), "answer_logs"):
+        # 作り直しはマイグレーション 10（起動時）。稼働中にテーブルを作り直すことはしない
+        raise RuntimeError("answer_logs has no AUTOINCREMENT yet; run `python -m app.migrations upgrade` first")
+    al = models.AnswerLog
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(*(getattr(al, c) for c in RAW_COLS))
+            .where(al.answered_at < cutoff, al.id > last_id)
+            .order_by(al.id).limit(batch)
+        ).all()
+        if not rows:
+            break
+        buckets = aggregate(rows)
+        if dry_run:
+            last_id = rows[-1].id
+            out["archived"] += len(rows)
+            out["buckets"] += len(buckets)
+            continue
+        ids = [r.id for r in rows]
+        ik = models.AnswerIdempotency
+        db.execute(delete(ik).where(ik.user_id.in_({r.user_id for r in rows}), ik.answer_log_id.in_(ids)))
+        if db.execute(delete(al).where(al.id.in_(ids))).rowcount != len(ids):
+            # 読んだあとにクイズごと消された行がある → このバッチを読み直す
+            db.rollback()
+            continue
+        db.execute(insert(models.AnswerLogArchive), [r._asdict() for r in rows])
+        _merge(db, buckets)
+        db.commit()
+        last_id = ids[-1]
+        out["archived"] += len(rows)
+        out["buckets"] += len(buckets)
+    return out
+
+
+def forget_quiz(db: Session, quiz_id: int, user_id: int) -> None:
+    """クイズ削除時（answer_logs は cascade で消えるが、こちらは ORM の関連が無いので明示的に消す）"""
+    ar, arc = models.AnswerRollup, models.AnswerLogArchive
+    db.execute(delete(ar).where(ar.user_id == user_id, ar.quiz_id == quiz_id))
+    db.execute(delete(arc).where(arc.user_id == user_id, arc.quiz_id == quiz_id))
+
+
+# ---- 作り直し / 検証 ----
+def compute_expected(db: Session) -> Dict[BucketKey, dict]:
+    arc = models.AnswerLogArchive
+    rows = db.execute(
+        select(arc.id, arc.user_id, arc.quiz_id, arc.is_correct, arc.image_shown, arc.answered_at)
+        .order_by(arc.id)
+        .execution_options(yield_per=5000)
+    )
+    return aggregate(rows)
+
+
+def rebuild(db: Session, batch: int = 5000) -> int:
+    """アーカイブから answer_rollups を作り直す（アーカイブ分を再採点したあとなど）"""
+    rows = [
+        {"user_id": k[0], "quiz_id": k[1], "day": k[2], "image_shown": k[3], **b}
+        for k, b in compute_expected(db).items()
+    ]
+    db.execute(delete(models.AnswerRollup))
+    for i in range(0, len(rows), batch):
+        db.execute(insert(models.AnswerRollup), rows[i:i + batch])
+    db.commit()
+    return len(rows)
+
+
+def verify(db: Session) -> List[str]:
+    expected = compute_expected(db)
+    actual = {
+        (r.user_id, r.quiz_id, r.day, r.image_shown): {c: getattr(r, c) for c in ROLLUP_COLS}
+        for r in db.execute(select(models.AnswerRollup)).scalars()
+    }
+    diffs = []
+    for key in sorted(set(expected) | set(actual)):
+        exp, act = expected.get(key), actual.get(key)
+        label = f"user {key[0]} quiz {key[1]} {key[2]} image_shown={key[3]}"
+        if exp is None or act is None:
+            diffs.append(f"{label}: {'missing' if act is None else 'unexpected'} rollup")
+            continue
+        for c in ROLLUP_COLS:
+            if act[c] != exp[c]:
+                diffs.append(f"{label} {c}: stored={act[c]} expected={exp[c]}")
+    return diffs
+
+
+# ---- 定期実行 ----
+class Compactor:
+    def __init__(self, interval: float = settings.ANSWER_COMPACT_INTERVAL, session_factory: Callable[[], Session] = SessionLocal):
+        self.interval = interval
+        self.session_factory = session_factory
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or settings.ANSWER_ARCHIVE_DAYS <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="answer-compact", daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            db = self.session_factory()
+            try:
+                out = compact(db)
+                if out["archived"]:
+                    log.info(f"[Compact] archived {out['archived']} answer(s) before {out['cutoff']:%Y-%m-%d}")
+            except Exception:
+                db.rollback()
+                log.exception("[Compact] failed")
+            finally:
+                db.close()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._thread = None
+
+
+compactor = Compactor()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.services.compaction", description="answer_logs の日次集計・アーカイブ")
+    ap.add_argument("command", choices=["run", "verify", "rebuild"])
+    ap.add_argument("--days", type=int, default=None, help="run: これより前の日の回答を畳む（既定 ANSWER_ARCHIVE_DAYS）")
+    ap.add_argument("--batch", type=int, default=2000)
+    ap.add_argument("--dry-run", action="store_true", help="run: 畳む件数だけ数える")
+    args = ap.parse_args(argv)
+    db = SessionLocal()
+    try:
+        if args.command == "run":
+            days = settings.ANSWER_ARCHIVE_DAYS if args.days is None else args.days
+            if days <= 0:
+                print("ANSWER_ARCHIVE_DAYS is 0; pass --days", file=sys.stderr)
+                return 2
+            r = compact(db, days=days, batch=args.batch, dry_run=args.dry_run)
+            print(f"{'would archive' if args.dry_run else 'archived'} {r['archived']} answer(s) "
+                  f"into {r['buckets']} bucket update(s) before {r['cutoff']:%Y-%m-%d}")
+            return 0
+        if args.command == "rebuild":
+            print(f"rebuilt answer_rollups={rebuild(db)}")
+            return 0
+        diffs = verify(db)
+        for d in diffs[:100]:
+            print(d)
+        print("OK" if not diffs else f"{len(diffs)} mismatch(es)")
+        return 0 if not diffs else 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
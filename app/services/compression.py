@@ -0,0 +1,166 @@
+"""レスポンスの圧縮（gzip / brotli を Accept-Encoding で選ぶ）
+
+- CompressionMiddleware: API のレスポンスをその場で圧縮する素の ASGI ミドルウェア。JSON・テキストなど
+  圧縮の効く Content-Type で、COMPRESS_MIN_BYTES 以上のものだけ。ストリーミング（エクスポート）は
+  チャンクごとに圧縮して流す。既に Content-Encoding の付いたもの（static_cache の事前圧縮版）は触らない
+- encode(): static_cache が事前圧縮に使う
+
+brotli は `pip install brotli` があるときだけ使う（無ければ gzip のみ）。
+"""
+import zlib
+from typing import Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from ..config import settings
+
+try:
+    import brotli
+except ImportError:   # 任意依存
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/x-ndjson", "application/javascript",
+    "application/xml", "image/svg+xml",
+)
+
+
+def available() -> List[str]:
+    """優先順（同じ q なら前のもの）"""
+    return (["br"] if brotli is not None else []) + ["gzip"]
+
+
+def negotiate(accept_encoding: Optional[str], offered: Optional[List[str]] = None) -> Optional[str]:
+    """Accept-Encoding から使う符号化を選ぶ。圧縮しないなら None"""
+    if not accept_encoding:
+        return None
+    offered = available() if offered is None else offered
+    qs: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            qs[name] = q
+    best, best_q = None, 0.0
+    for enc in offered:
+        q = qs.get(enc, qs.get("*", 0.0))
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def encode(data: bytes, encoding: str, gzip_level: int = 9, brotli_quality: int = 11) -> bytes:
+    """まとめて圧縮する（事前圧縮用なので既定は最大圧縮）"""
+    if encoding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    c = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)   # wbits=31 → gzip 形式
+    return c.compress(data) + c.flush()
+
+
+class _Compressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._c = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._c = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        """途中のチャンク。受け手がすぐ展開できるよう毎回フラッシュする"""
+        if self.encoding == "br":
+            return self._c.process(data) + self._c.flush()
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        if self.encoding == "br":
+            return self._c.process(data) + self._c.finish()
+        return self._c.compress(data) + self._c.flush()
+
+
+class CompressionMiddleware:
+    """素の ASGI ミドルウェア。response.start を最初の本文まで保留して、圧縮するかを決める"""
+
+    def __init__(self, app, minimum_size: int = settings.COMPRESS_MIN_BYTES,
+                 gzip_level: int = settings.COMPRESS_GZIP_LEVEL, brotli_quality: int = settings.COMPRESS_BROTLI_QUALITY):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start = None                       # 保留中の http.response.start
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def _send(message):
+            nonlocal start, compressor, passthrough
+            if passthrough:
+                return await send(message)
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                passthrough = True
+                if start is not None:
+                    await send(start)
+                    start = None
+                return await send(message)
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                if not self._should_compress(start["status"], headers, body, more):
+                    passthrough = True
+                    await send(start)
+                    start = None
+                    return await send(message)
+                compressor = _Compressor(encoding, self.gzip_level, self.brotli_quality)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    headers["ETag"] = "W/" + etag   # 本文のバイト列が変わるので弱い ETag にする
+                if more:
+                    del headers["Content-Length"]
+                    await send(start)
+                    start = None
+                    return await send({"type": "http.response.body", "body": compressor.chunk(body), "more_body": True})
+                data = compressor.finish(body)
+                headers["Content-Length"] = str(len(data))
+                await send(start)
+                start = None
+                return await send({"type": "http.response.body", "body": data, "more_body": False})
+
+            data = compressor.chunk(body) if more else compressor.finish(body)
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, _send)
+        if start is not None:   # 本文なしで終わった
+            await send(start)
+
+    def _should_compress(self, status: int, headers: MutableHeaders, body: bytes, more: bool) -> bool:
+        if status < 200 or status in (204, 304) or "content-encoding" in headers:
+            return False
+        if "no-transform" in headers.get("cache-control", ""):
+            return False
+        if not is_compressible(headers.get("content-type")):
+            return False
+        return more or len(body) >= self.minimum_size
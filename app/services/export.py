@@ -0,0 +1,140 @@
+"""answer_logs（+ quizzes）のストリーミングエクスポート
+
+サーバーサイドカーソル（yield_per）で一定件数ずつ取り出し、CSV / NDJSON のバイト列として
+少しずつ返すので、件数が増えてもメモリ使用量は一定。id 昇順で出力するので、途中で
+切れたら最後に受け取った id を after_id に渡して続きから取れる。answer_logs_archive に
+移した古い回答も、answer_logs と id 順に突き合わせて（マージして）一緒に出す。
+
+    python -m app.services.export --format csv --since 2025-01-01 -o answers.csv
+    python -m app.services.export --format ndjson --user-id 3 --after-id 120000
+"""
+import argparse
+import csv
+import heapq
+import io
+import itertools
+import json
+import sys
+from datetime import datetime
+from typing import Callable, Iterator, Optional
+
+from sqlalchemy import select, asc
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..database import SessionLocal
+
+FIELDS = ("id", "user_id", "quiz_id", "question", "correct_answer", "user_answer", "is_correct", "image_shown", "answered_at")
+CHUNK_ROWS = 1000
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+
+def answer_rows_stmt(
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after_id: Optional[int] = None,
+    model=models.AnswerLog,
+):
+    al, qz = model, models.Quiz
+    stmt = (
+        select(al.id, al.user_id, al.quiz_id, qz.question, qz.answer.label("correct_answer"),
+               al.user_answer, al.is_correct, al.image_shown, al.answered_at)
+        .join(qz, qz.id == al.quiz_id)
+    )
+    if user_id is not None:
+        stmt = stmt.where(al.user_id == user_id)
+    if since is not None:
+        stmt = stmt.where(al.answered_at >= since)
+    if until is not None:
+        stmt = stmt.where(al.answered_at < until)
+    if after_id is not None:
+        stmt = stmt.where(al.id > after_id)
+    return stmt.order_by(asc(al.id))
+
+
+def iter_answer_rows(db: Session, chunk_rows: int = CHUNK_ROWS, **filters) -> Iterator[list]:
+    """chunk_rows 件ずつ Row のリストを返す"""
+    results = [
+        db.execute(answer_rows_stmt(model=m, **filters).execution_options(yield_per=chunk_rows, stream_results=True))
+        for m in (models.AnswerLogArchive, models.AnswerLog)
+    ]
+    merged = heapq.merge(*results, key=lambda r: r.id)
+    while True:
+        part = list(itertools.islice(merged, chunk_rows))
+        if not part:
+            break
+        yield part
+
+
+def _row_dict(r) -> dict:
+    return {
+        "id": r.id,
+        "user_id": r.user_id,
+        "quiz_id": r.quiz_id,
+        "question": r.question,
+        "correct_answer": r.correct_answer,
+        "user_answer": r.user_answer,
+        "is_correct": bool(r.is_correct),
+        "image_shown": bool(r.image_shown),
+        "answered_at": r.answered_at.isoformat() if r.answered_at else None,
+    }
+
+
+def encode_csv(chunks: Iterator[list]) -> Iterator[bytes]:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    # Excel で開いても文字化けしないよう BOM 付き
+    yield ("\ufeff" + ",".join(FIELDS) + "\r\n").encode("utf-8")
+    for part in chunks:
+        for r in part:
+            d = _row_dict(r)
+            w.writerow([d[f] for f in FIELDS])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0); buf.truncate()
+
+
+def encode_ndjson(chunks: Iterator[list]) -> Iterator[bytes]:
+    for part in chunks:
+        yield "".join(json.dumps(_row_dict(r), ensure_ascii=False) + "\n" for r in part).encode("utf-8")
+
+
+ENCODERS = {"csv": encode_csv, "ndjson": encode_ndjson}
+
+
+def stream_export(fmt: str, session_factory: Callable[[], Session] = SessionLocal, **filters) -> Iterator[bytes]:
+    """StreamingResponse 用。リクエストのセッションとは別に自前で開いて最後に閉じる"""
+    db = session_factory()
+    try:
+        yield from ENCODERS[fmt](iter_answer_rows(db, **filters))
+    finally:
+        db.close()
+
+
+def _parse_dt(s: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(s) if s else None
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.services.export", description="answer_logs を CSV / NDJSON で出力")
+    ap.add_argument("--format", choices=sorted(ENCODERS), default="csv")
+    ap.add_argument("--user-id", type=int)
+    ap.add_argument("--since", help="ISO 8601（この時刻を含む）")
+    ap.add_argument("--until", help="ISO 8601（この時刻を含まない）")
+    ap.add_argument("--after-id", type=int, help="この id より後から再開")
+    ap.add_argument("-o", "--output", help="出力ファイル（省略時は標準出力）")
+    args = ap.parse_args(argv)
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for b in stream_export(args.format, user_id=args.user_id, since=_parse_dt(args.since),
+                               until=_parse_dt(args.until), after_id=args.after_id):
+            out.write(b)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""採点
+
+正解・回答の両方を同じ規則で正規化して比べる:
+
+- NFKC（全角英数・半角カナを揃える）→ casefold
+- カタカナをひらがなに寄せる
+- 空白・句読点・記号類（Unicode の P*/Z* カテゴリ）を除く。ただし数字に隣接する "-" "." "/" は
+  符号・小数点・分数なので残す（"-5" と "5"、"1/2" と "12" を区別する）
+- 正解は "|" 区切りで別解を書ける（例: "東京|とうきょう|Tokyo"）。"|" そのものは "\\|" と書く。
+  別解の書き方は quizzes.answer_alternates が真のクイズ（この規則ができてから作ったもの）だけで、
+  それより前のクイズの "|" は正解の一部としてそのまま比べる
+- 長めの正解は編集距離 1〜2 までの書き間違いを許す。数字を含む部分は許さない
+  （回答と正解で数字の並びが違えば不正解。"1991年" と "1990年"、"answer1" と "answer0"）。
+  かなだけの正解は1文字の違いで別の語になる（"ちゅうごく" と "ちゅうこく"）ので、短いものは完全一致のみ
+
+正解側の正規化結果（answer_key）はクイズ作成時に保存しておくので、採点時に正規化するのは
+回答だけ。規則を変えたら RULES_VERSION を上げ、次のコマンドで保存済みのキーと過去の採点を
+作り直す:
+
+    python -m app.services.grading rekey     # answer_key の再計算だけ
+    python -m app.services.grading regrade   # rekey + answer_logs（とアーカイブ）の再採点 + 集計・復習スケジュールの再構築
+"""
+import argparse
+import re
+import sys
+import unicodedata
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, update, or_
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+
+RULES_VERSION = 3
+ALT_SEP = "|"
+ALT_ESCAPE = "\\" + ALT_SEP
+_ALT_SPLIT = re.compile(r"(?<!\\)" + re.escape(ALT_SEP))
+KEY_SEP = "\n"   # 正規化後の文字列には改行が残らないので区切りに使う
+
+# カタカナ → ひらがな（ァ..ヶ, ヽヾ）
+_KANA_FOLD = {c: c - 0x60 for c in range(0x30A1, 0x30F7)}
+_KANA_FOLD.update({0x30FD: 0x309D, 0x30FE: 0x309E})
+
+
+_NUMERIC_PUNCT = frozenset("-./")   # NFKC 後なので全角の "－．／" もこれになる
+
+
+def _drop(s: str, i: int) -> bool:
+    ch = s[i]
+    if ch in _NUMERIC_PUNCT and ((i > 0 and s[i - 1].isdigit()) or (i + 1 < len(s) and s[i + 1].isdigit())):
+        return False
+    cat = unicodedata.category(ch)
+    return cat[0] in ("P", "Z") or ch.isspace()
+
+
+def normalize(s: Optional[str]) -> str:
+    if not s:
+        return ""
+    s = unicodedata.normalize("NFKC", s).casefold().translate(_KANA_FOLD)
+    # 記号だけの正解（"?" など）は消すと何とも一致しなくなるので、そのときは空白だけ除く
+    return "".join(ch for i, ch in enumerate(s) if not _drop(s, i)) or "".join(s.split())
+
+
+def _numbers(s: str) -> str:
+    """数字と、normalize で残した符号・小数点・分数の並び"""
+    return "".join(ch for ch in s if ch.isdigit() or ch in _NUMERIC_PUNCT)
+
+
+def alternates(answer: str, enabled: bool = True) -> List[str]:
+    """正解を別解に分ける。"\\|" は区切りでなく "|" という文字"""
+    # NFKC 後に分けるので全角の "｜" も区切りとして扱える
+    s = unicodedata.normalize("NFKC", answer or "")
+    if not enabled:
+        return [s]
+    return [alt.replace(ALT_ESCAPE, ALT_SEP) for alt in _ALT_SPLIT.split(s)]
+
+
+def answer_key(answer: str, alternates_enabled: bool = True) -> str:
+    """保存用の正解キー（別解ごとに正規化し、重複を除いて改行でつなぐ）"""
+    keys: List[str] = []
+    for alt in alternates(answer, alternates_enabled):
+        k = normalize(alt)
+        if k and k not in keys:
+            keys.append(k)
+    return KEY_SEP.join(keys)
+
+
+def key_fields(answer: str) -> dict:
+    """新しく作るクイズの quizzes の列（INSERT 用）"""
+    return {"answer_key": answer_key(answer), "answer_key_version": RULES_VERSION, "answer_alternates": True}
+
+
+_KANA_MIN_FUZZY = 8   # かなは1文字が1音なので、ラテン文字より長くないと書き間違いとみなさない
+
+
+def _kana_only(key: str) -> bool:
+    return all("\u3041" <= ch <= "\u309f" or ch == "ー" for ch in key)
+
+
+def allowed_distance(key: str, max_distance: int = settings.GRADING_MAX_DISTANCE) -> int:
+    if max_distance <= 0 or key.isdigit():
+        return 0
+    if _kana_only(key):
+        return min(max_distance, len(key) // _KANA_MIN_FUZZY)   # 8文字未満は完全一致のみ
+    return min(max_distance, len(key) // 4)   # 4文字未満は完全一致のみ
+
+
+def within_distance(a: str, b: str, limit: int) -> bool:
+    """Levenshtein 距離 <= limit か（幅 limit の帯だけ計算し、超えた時点で打ち切る）"""
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > limit:
+        return False
+    if limit == 0:
+        return False
+    big = limit + 1
+    prev = [j if j <= limit else big for j in range(lb + 1)]
+    for i in range(1, la + 1):
+        lo, hi = max(1, i - limit), min(lb, i + limit)
+        cur = [big] * (lb + 1)
+        cur[0] = i if i <= limit else big
+        ca = a[i - 1]
+        row_min = cur[0]
+        for j in range(lo, hi + 1):
+            cost = 0 if ca == b[j - 1] else 1
+            v = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            cur[j] = v if v <= limit else big
+            if cur[j] < row_min:
+                row_min = cur[j]
+        if row_min > limit:
+            return False
+        prev = cur
+    return prev[lb] <= limit
+
+
+def grade_normalized(norm_answer: str, key: str) -> bool:
+    if not norm_answer:
+        return False
+    alts = key.split(KEY_SEP) if key else []
+    if norm_answer in alts:
+        return True
+    # 書き間違いを許すのは文字の部分だけ（年号・数量の違いは別の答え）
+    nums = _numbers(norm_answer)
+    return any(within_distance(norm_answer, k, allowed_distance(k)) for k in alts if k and _numbers(k) == nums)
+
+
+def quiz_key(quiz: models.Quiz) -> str:
+    """保存済みキーが今の規則のものならそれを使い、古ければその場で作る"""
+    if quiz.answer_key is not None and quiz.answer_key_version == RULES_VERSION:
+        return quiz.answer_key
+    return answer_key(quiz.answer, bool(quiz.answer_alternates))
+
+
+def grade(user_answer: str, quiz: models.Quiz) -> bool:
+    return grade_normalized(normalize(user_answer), quiz_key(quiz))
+
+
+# ---- 一括処理 ----
+def rekey_quizzes(db: Session, batch: int = 1000) -> int:
+    """answer_key が無い／古いクイズのキーを作り直す"""
+    qz = models.Quiz
+    stale = or_(qz.answer_key_version.is_(None), qz.answer_key_version != RULES_VERSION)
+    done, last_id = 0, 0
+    while True:
+        rows = db.execute(
+            select(qz.id, qz.answer, qz.answer_alternates).where(stale, qz.id > last_id).order_by(qz.id).limit(batch)
+        ).all()
+        if not rows:
+            break
+        db.execute(update(qz), [{"id": r.id, "answer_key": answer_key(r.answer, bool(r.answer_alternates)),
+                                 "answer_key_version": RULES_VERSION} for r in rows])
+        db.commit()
+        done += len(rows)
+        last_id = rows[-1].id
+    return done
+
+
+def regrade_answers(db: Session, batch: int = 5000, dry_run: bool = False, model=models.AnswerLog) -> Tuple[int, int]:
+    """answer_logs（model=AnswerLogArchive ならアーカイブ）を id 順に読み、採点結果が変わった行だけ更新する。
+    戻り値は (scanned, changed)"""
+    al, qz = model, models.Quiz
+    scanned = changed = 0
+    last_id = 0
+    memo: dict = {}   # (quiz_id, user_answer) -> correct（同じ回答の繰り返しが多い）
+    keys: dict = {}   # quiz_id -> key（dry-run では古いキーが残っているので作り直す）
+    while True:
+        rows = db.execute(
+            select(al.id, al.quiz_id, al.user_answer, al.is_correct,
+                   qz.answer, qz.answer_alternates, qz.answer_key, qz.answer_key_version)
+            .join(qz, qz.id == al.quiz_id)
+            .where(al.id > last_id)
+            .order_by(al.id)
+            .limit(batch)
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for r in rows:
+            m = (r.quiz_id, r.user_answer)
+            correct = memo.get(m)
+            if correct is None:
+                key = keys.get(r.quiz_id)
+                if key is None:
+                    fresh = r.answer_key is not None and r.answer_key_version == RULES_VERSION
+                    key = keys[r.quiz_id] = r.answer_key if fresh else answer_key(r.answer, bool(r.answer_alternates))
+                correct = memo[m] = grade_normalized(normalize(r.user_answer), key)
+            if bool(r.is_correct) != correct:
+                updates.append({"id": r.id, "is_correct": correct})
+        if updates and not dry_run:
+            db.execute(update(al), updates)
+            db.commit()
+        scanned += len(rows)
+        changed += len(updates)
+        last_id = rows[-1].id
+        if len(memo) > 100_000:
+            memo.clear(); keys.clear()
+    return scanned, changed
+
+
+def regrade(db: Session, batch: int = 5000, dry_run: bool = False) -> dict:
+    from . import stats, review, response_cache, compaction
+
+    rekeyed = rekey_quizzes(db) if not dry_run else 0
+    scanned, changed = regrade_answers(db, batch=batch, dry_run=dry_run)
+    a_scanned, a_changed = regrade_answers(db, batch=batch, dry_run=dry_run, model=models.AnswerLogArchive)
+    scanned, changed = scanned + a_scanned, changed + a_changed
+    if a_changed and not dry_run:
+        compaction.rebuild(db)   # 畳んだ分の正答数も変わる
+    if changed and not dry_run:
+        stats.rebuild(db)   # 正答数が変わるので集計と復習スケジュールを作り直す
+        review.rebuild(db)
+        response_cache.bump_all(db)   # 一覧の正誤・集計が変わるので ETag を無効にする
+        db.commit()
+    return {"rekeyed": rekeyed, "scanned": scanned, "changed": changed}
+
+
+def main(argv=None) -> int:
+    from ..database import SessionLocal
+
+    ap = argparse.ArgumentParser(prog="python -m app.services.grading", description="正解キーの再計算と再採点")
+    ap.add_argument("command", choices=["rekey", "regrade"])
+    ap.add_argument("--batch", type=int, default=5000)
+    ap.add_argument("--dry-run", action="store_true", help="regrade: 変わる件数だけ数える")
+    args = ap.parse_args(argv)
+    db = SessionLocal()
+    try:
+        if args.command == "rekey":
+            print(f"rekeyed {rekey_quizzes(db)} quiz(zes)")
+        else:
+            r = regrade(db, batch=args.batch, dry_run=args.dry_run)
+            print(f"rekeyed {r['rekeyed']} quiz(zes); scanned {r['scanned']} answer(s), "
+                  f"{'would change' if args.dry_run else 'changed'} {r['changed']}")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""生成画像のコンテンツアドレス型キャッシュ
+
+- キー: sha256(prompt, steps, width, height, model)。同じ条件なら A1111 を呼ばずに再利用する
+- ファイル: {IMAGE_DIR}/cas/{h[0:2]}/{h[2:4]}/{h}.png（h は内容の sha256）。同じ画像は1ファイルだけ持つ
+- 参照カウント: generated_images.file_path の件数。参照中のファイルは消さない
+- 追い出し: 合計サイズが IMAGE_CACHE_MAX_BYTES を超えたら、未参照のものを LRU 順に削除
+"""
+import base64
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import select, func, asc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+
+log = logging.getLogger("uvicorn")
+
+# ヒット直後〜 add_image までの間に追い出されないための猶予
+EVICT_GRACE = timedelta(minutes=10)
+
+
+def param_key(prompt: str, steps: int, width: int, height: int, model: str) -> str:
+    raw = json.dumps([prompt, steps, width, height, model or ""], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def content_path(content_hash: str, output_dir: Optional[str] = None) -> str:
+    """内容ハッシュの先頭2+2文字で2段にシャードする（1ディレクトリのファイル数を抑える）"""
+    h = content_hash
+    return os.path.join(output_dir or settings.IMAGE_DIR, "cas", h[:2], h[2:4], f"{h}.png").replace("\\", "/")
+
+
+def write_atomic(abs_path: str, data: bytes) -> None:
+    """一時ファイルに書いてから rename（途中で落ちても壊れたファイルを残さない）"""
+    d = os.path.dirname(abs_path)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, abs_path)
+    except BaseException:
+        _remove_quietly(tmp)
+        raise
+
+
+B64_CHUNK = 64 * 1024  # 4 の倍数
+
+
+def decode_b64_to_tmp(b64: str, dir_path: str) -> Tuple[str, str, int]:
+    """base64 をチャンクごとにデコードして一時ファイルへ書く。
+
+    デコード済みバイト列を丸ごとメモリに持たない。(tmp_path, sha256, size) を返す。
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dir_path, suffix=".tmp")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for i in range(0, len(b64), B64_CHUNK):
+                chunk = base64.b64decode(b64[i:i + B64_CHUNK])
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        _remove_quietly(tmp)
+        raise
+    return tmp, h.hexdigest(), size
+
+
+class ImageCache:
+    def __init__(self, db: Session, output_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.db = db
+        self.output_dir = output_dir or settings.IMAGE_DIR
+        self.max_bytes = settings.IMAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    def content_path(self, content_hash: str) -> str:
+        return content_path(content_hash, self.output_dir)
+
+    # ---- lookup / store ----
+    def lookup(self, key: str) -> Optional[str]:
+        e = self.db.get(models.ImageCacheEntry, key)
+        if e is None:
+            return None
+        if not os.path.exists(e.file_path):
+            self.db.delete(e); self.db.commit()
+            return None
+        e.hits = (e.hits or 0) + 1
+        e.last_used_at = datetime.utcnow()
+        self.db.commit()
+        return e.file_path
+
+    def store(self, key: str, img_bytes: bytes) -> str:
+        """内容ハッシュ名で保存して rel path を返す。キーが登録済みなら対応付けは変えない"""
+        from . import storage
+
+        chash = hashlib.sha256(img_bytes).hexdigest()
+        rel_path = self.content_path(chash)
+        if os.path.exists(rel_path):
+            storage.touch(rel_path)
+        else:
+            write_atomic(os.path.abspath(rel_path), img_bytes)
+            storage.usage.add(len(img_bytes))
+        return self._register(key, chash, rel_path, len(img_bytes))
+
+    def store_b64(self, key: Optional[str], b64: str) -> str:
+        """A1111 の base64 をストリームデコードして格納（key=None ならキャッシュ登録しない）"""
+        from . import storage
+
+        tmp, chash, size = decode_b64_to_tmp(b64, os.path.abspath(os.path.join(self.output_dir, "cas")))
+        rel_path = storage.place(tmp, chash, size, self.output_dir)
+        if key is None:
+            return rel_path
+        return self._register(key, chash, rel_path, size)
+
+    def _register(self, key: str, chash: str, rel_path: str, size: int) -> str:
+        if self.db.get(models.ImageCacheEntry, key) is None:
+            self.db.add(models.ImageCacheEntry(
+                param_key=key, content_hash=chash, file_path=rel_path, size_bytes=size,
+            ))
+            try:
+                self.db.commit()
+            except IntegrityError:
+                # 同じキーを別ワーカーが先に登録した → こちらはキャッシュ外の1ファイルとして使う
+                self.db.rollback()
+        self.evict()
+        return rel_path
+
+    # ---- 参照カウント ----
+    def ref_counts(self, file_paths: Iterable[str]) -> dict:
+        paths = list(set(file_paths))
+        if not paths:
+            return {}
+        rows = self.db.execute(
+            select(models.GeneratedImage.file_path, func.count(models.GeneratedImage.id))
+            .where(models.GeneratedImage.file_path.in_(paths))
+            .group_by(models.GeneratedImage.file_path)
+        ).all()
+        counts = {p: 0 for p in paths}
+        counts.update({p: int(n) for p, n in rows})
+        return counts
+
+    def is_cached(self, file_paths: Iterable[str]) -> set:
+        paths = list(set(file_paths))
+        if not paths:
+            return set()
+        return set(self.db.execute(
+            select(models.ImageCacheEntry.file_path).where(models.ImageCacheEntry.file_path.in_(paths))
+        ).scalars())
+
+    def releasable(self, file_paths: Iterable[str]) -> list:
+        """どの generated_images からも参照されず、キャッシュにも載っていないファイル"""
+        paths = list(file_paths)
+        refs = self.ref_counts(paths)
+        cached = self.is_cached(paths)
+        return [p for p in dict.fromkeys(paths) if refs.get(p, 0) == 0 and p not in cached]
+
+    # ---- 追い出し ----
+    def total_bytes(self) -> int:
+        return int(self.db.execute(select(func.coalesce(func.sum(models.ImageCacheEntry.size_bytes), 0))).scalar_one())
+
+    def evict(self) -> int:
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return 0
+        cutoff = datetime.utcnow() - EVICT_GRACE
+        candidates = self.db.execute(
+            select(models.ImageCacheEntry)
+            .where(models.ImageCacheEntry.last_used_at < cutoff)
+            .order_by(asc(models.ImageCacheEntry.last_used_at))
+        ).scalars().all()
+        removed = 0
+        for batch in _chunks(candidates, 200):
+            refs = self.ref_counts(e.file_path for e in batch)
+            for e in batch:
+                if total <= self.max_bytes:
+                    break
+                # 参照中のファイルはキャッシュから外せても容量は減らないので残す
+                if refs.get(e.file_path, 0) > 0:
+                    continue
+                remove_with_variants(e.file_path)
+                total -= e.size_bytes or 0
+                self.db.delete(e)
+                removed += 1
+            if total <= self.max_bytes:
+                break
+        self.db.commit()
+        return removed
+
+
+def _chunks(it, n):
+    buf = []
+    for x in it:
+        buf.append(x)
+        if len(buf) >= n:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def variant_glob(src_path: str) -> str:
+    """派生画像（サムネイル等）は元ファイルの隣に {stem}.w{幅}.{拡張子} で置く"""
+    stem, _ = os.path.splitext(src_path)
+    return f"{glob.escape(stem)}.w*.*"
+
+
+def remove_with_variants(src_path: str) -> bool:
+    """元画像と派生画像を消す。消せなかったものはログに残して False（既に無いのは成功扱い）"""
+    ok = True
+    for p in [src_path, *glob.glob(variant_glob(src_path))]:
+        try:
+            _remove_quietly(p)
+        except OSError as e:
+            log.warning(f"[Storage] failed to delete {p}: {e}")
+            ok = False
+    return ok
@@ -0,0 +1,191 @@
+"""画像生成ジョブキュー
+
+POST はジョブIDを即返し、A1111 との通信は固定サイズのワーカープールで行う。
+ジョブの状態は image_jobs テーブルに保存するので、再起動時に queued / running の
+ものを拾い直せる。同じ quiz + prompt + force の処理中ジョブがあれば新規に作らずそれを返す。
+
+同期の POST /quiz/image/generate もここにジョブを入れて完了を待つだけなので、A1111 へ同時に
+投げる数はワーカー数で決まる（ルートのスレッドで直接生成しない）。
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from sqlalchemy.orm import Session
+
+from .. import crud, models
+from ..config import settings
+from ..database import SessionLocal
+from .a1111_client import A1111Unavailable
+from .image_service import ImageService
+from .image_variants import variant_builder
+from .storage import StorageQuotaExceeded
+
+log = logging.getLogger("uvicorn")
+
+
+def generate_and_store(db: Session, service: ImageService, quiz: models.Quiz, prompt: Optional[str], force: bool) -> models.GeneratedImage:
+    """画像を生成して generated_images に登録する（ジョブのワーカーと一括事前生成で共通）
+
+    force のときはキャッシュを使わず描き直し、旧レコードを消してから
+    どこからも参照されなくなったファイルだけを削除する。
+    """
+    rel_path = service.generate_image_for_quiz(quiz_id=quiz.id, prompt=prompt, force_delete_before=False, use_cache=not force)
+    if force:
+        old_paths = [im.file_path for im in crud.list_images_by_quiz(db, quiz=quiz)]
+        crud.delete_images_by_quiz(db, quiz=quiz)
+    im = crud.add_image(db, quiz=quiz, file_path=rel_path, prompt=prompt)
+    if force:
+        service.delete_files([p for p in old_paths if p != rel_path])
+    # サムネイル・WebP/AVIF はプロセスプールで後から作る
+    variant_builder.schedule(im.id, rel_path)
+    return im
+
+
+def error_kind(e: Exception) -> str:
+    if isinstance(e, A1111Unavailable):
+        return "unavailable"
+    if isinstance(e, StorageQuotaExceeded):
+        return "quota"
+    return "error"
+
+
+class ImageJobQueue:
+    def __init__(
+        self,
+        session_factory: Callable[[], Session] = SessionLocal,
+        service_factory: Callable[[Session], ImageService] = ImageService,
+        workers: int = settings.IMAGE_JOB_WORKERS,
+    ):
+        self.session_factory = session_factory
+        self.service_factory = service_factory
+        self.workers = max(1, workers)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._waiters: dict[str, list] = {}   # job_id -> [(loop, future) | threading.Event]
+
+    # ---- lifecycle ----
+    def start(self):
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-job")
+        # 再起動前に残っていたジョブを再投入（running は中断扱いでやり直す）
+        db = self.session_factory()
+        try:
+            ids = crud.list_inflight_image_job_ids(db)
+        finally:
+            db.close()
+        for job_id in ids:
+            self._executor.submit(self._run, job_id)
+        if ids:
+            log.info(f"[ImageJob] requeued {len(ids)} job(s)")
+
+    def shutdown(self, wait: bool = False):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
+            self._executor = None
+
+    # ---- submit / wait ----
+    def submit(self, db: Session, user: models.User, quiz: models.Quiz, prompt: Optional[str], force: bool = False) -> models.ImageJob:
+        self.start()
+        with self._lock:
+            job = crud.find_inflight_image_job(db, quiz=quiz, prompt=prompt, force=force)
+            if job:
+                return job
+            job = crud.create_image_job(db, user=user, quiz=quiz, prompt=prompt, force=force)
+        self._executor.submit(self._run, job.id)
+        return job
+
+    def wait(self, job_id: str, timeout: float) -> None:
+        """スレッドから使う待機（CLI / テスト用）"""
+        ev = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(job_id, []).append(ev)
+        if not self._is_finished(job_id):
+            ev.wait(timeout)
+        self._discard_waiter(job_id, ev)
+
+    async def wait_async(self, job_id: str, timeout: float) -> None:
+        """long-poll 用。イベントループもスレッドプールも塞がない"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        entry = (loop, fut)
+        with self._lock:
+            self._waiters.setdefault(job_id, []).append(entry)
+        try:
+            # 登録前に終わっていた場合の取りこぼし防止
+            if await asyncio.to_thread(self._is_finished, job_id):
+                return
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._discard_waiter(job_id, entry)
+
+    async def wait_finished_async(self, job_id: str, timeout: float, recheck: float = 5.0) -> None:
+        """終わるまで（最大 timeout 秒）待つ。合流先のジョブを別プロセスのワーカーが処理していると
+        通知が来ないので、recheck 秒ごとに DB も見る"""
+        deadline = time.monotonic() + timeout
+        while not await asyncio.to_thread(self._is_finished, job_id):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await self.wait_async(job_id, min(recheck, remaining))
+
+    def _discard_waiter(self, job_id: str, entry) -> None:
+        with self._lock:
+            lst = self._waiters.get(job_id)
+            if lst and entry in lst:
+                lst.remove(entry)
+            if lst == []:
+                self._waiters.pop(job_id, None)
+
+    def _notify(self, job_id: str) -> None:
+        with self._lock:
+            entries = self._waiters.pop(job_id, [])
+        for e in entries:
+            if isinstance(e, threading.Event):
+                e.set()
+            else:
+                loop, fut = e
+                loop.call_soon_threadsafe(lambda f=fut: f.done() or f.set_result(None))
+
+    def _is_finished(self, job_id: str) -> bool:
+        db = self.session_factory()
+        try:
+            job = crud.get_image_job(db, job_id)
+            return job is None or job.status not in crud.JOB_INFLIGHT
+        finally:
+            db.close()
+
+    # ---- worker ----
+    def _run(self, job_id: str) -> None:
+        db = self.session_factory()
+        try:
+            job = crud.get_image_job(db, job_id)
+            if job is None or job.status not in crud.JOB_INFLIGHT:
+                return
+            crud.set_image_job_status(db, job, "running")
+            quiz = db.get(models.Quiz, job.quiz_id)
+            if quiz is None:
+                crud.set_image_job_status(db, job, "failed", error="Quiz not found", error_kind="not_found")
+                return
+            try:
+                im = generate_and_store(db, self.service_factory(db), quiz, job.prompt, bool(job.force))
+            except Exception as e:
+                db.rollback()
+                log.warning(f"[ImageJob] {job_id} failed: {e}")
+                crud.set_image_job_status(db, job, "failed", error=str(e)[:500], error_kind=error_kind(e))
+                return
+            crud.set_image_job_status(db, job, "done", image_id=im.id)
+        except Exception:
+            log.exception(f"[ImageJob] {job_id} crashed")
+        finally:
+            db.close()
+            self._notify(job_id)
+
+
+image_jobs = ImageJobQueue()
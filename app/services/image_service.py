@@ -1,36 +1,70 @@
-import os, requests, base64, datetime
+import os, time, logging
+from sqlalchemy.orm import Session
 from ..config import settings
+from .image_cache import ImageCache, param_key, decode_b64_to_tmp, remove_with_variants
+from .a1111_client import get_client, A1111Unavailable
+from . import metrics, storage
+
+log = logging.getLogger("uvicorn")
 
 class ImageService:
-    def __init__(self):
-        self.base_url = settings.A1111_BASE_URL
+    def __init__(self, db: Session | None = None, base_url: str | None = None):
+        self.base_url = base_url or settings.A1111_BASE_URL
         self.output_dir = settings.IMAGE_DIR
         os.makedirs(self.output_dir, exist_ok=True)
+        # db を渡したときだけキャッシュ・参照カウントを使う
+        self.cache = ImageCache(db, self.output_dir) if db is not None else None
 
     def _request(self, payload: dict):
-        url = f"{self.base_url}/sdapi/v1/txt2img"
-        r = requests.post(url, json=payload, timeout=120)
-        r.raise_for_status()
-        return r.json()
+        # 共有クライアント（プール・同時実行制限・リトライ・ブレーカー込み）
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            data = get_client(self.base_url).txt2img(payload)
+            outcome = "ok"
+            return data
+        except A1111Unavailable:
+            outcome = "unavailable"
+            raise
+        finally:
+            metrics.observe_a1111(outcome, time.perf_counter() - t0)
 
-    def generate_image_for_quiz(self, quiz_id: int, prompt: str | None, force_delete_before=False) -> str:
+    def build_payload(self, prompt: str | None) -> dict:
         prompt = prompt or f"Educational illustration of the quiz concept, clear and simple, no humans"
         payload = {"prompt": prompt, "steps": 20, "width": 512, "height": 512}
+        if settings.A1111_MODEL:
+            payload["override_settings"] = {"sd_model_checkpoint": settings.A1111_MODEL}
+        return payload
+
+    def generate_image_for_quiz(self, quiz_id: int, prompt: str | None, force_delete_before=False, use_cache: bool = True) -> str:
+        payload = self.build_payload(prompt)
+        key = None
+        if self.cache is not None:
+            key = param_key(payload["prompt"], payload["steps"], payload["width"], payload["height"], settings.A1111_MODEL)
+            if use_cache:
+                hit = self.cache.lookup(key)
+                if hit:
+                    return hit
+
+        # 容量超過なら A1111 を呼ぶ前に断る（キャッシュヒットは容量を増やさないので通す）
+        storage.check_quota()
         data = self._request(payload)
+        # JSON 本体はここで手放し、base64 はチャンクごとにデコードしてファイルへ
         img_b64 = data["images"][0]
-        img_bytes = base64.b64decode(img_b64)
+        del data
+
+        if self.cache is not None:
+            return self.cache.store_b64(key, img_b64)
 
-        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_name = f"quiz_{quiz_id}_{ts}.png"
-        rel_path = os.path.join(self.output_dir, file_name)
-        abs_path = os.path.abspath(rel_path)
-        with open(abs_path, "wb") as f:
-            f.write(img_bytes)
-        return rel_path.replace("\\", "/")
+        # キャッシュ無しでも置き場所は内容ハッシュで決める（掃除・移行が同じ規則で扱える）
+        tmp, chash, size = decode_b64_to_tmp(img_b64, os.path.abspath(os.path.join(self.output_dir, "cas")))
+        return storage.place(tmp, chash, size, self.output_dir)
 
     def delete_files(self, file_paths: list[str]):
-        for p in file_paths:
-            try:
-                os.remove(p)
-            except Exception:
-                pass
+        # 他のクイズが同じファイルを参照している／キャッシュ中なら消さない
+        if self.cache is not None:
+            file_paths = self.cache.releasable(file_paths)
+        failed = [p for p in file_paths if not remove_with_variants(p)]
+        if failed:
+            # 残ったファイルは storage の定期掃除で拾う
+            log.warning(f"[Storage] {len(failed)} file(s) left on disk after delete")
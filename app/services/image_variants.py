@@ -0,0 +1,157 @@
+"""生成画像の派生物（WebP/AVIF・サムネイル）を作る後処理
+
+リクエストの処理経路から外し、プロセスプールで変換する（Pillow のエンコードは CPU を食うため）。
+出力は元ファイルの隣に {stem}.w{幅}.{形式} で原子的に書き、結果を image_variants に記録する。
+Pillow が入っていない／形式に対応していない場合は何もしない。
+"""
+import contextlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..database import SessionLocal
+
+log = logging.getLogger("uvicorn")
+
+QUALITY = {"webp": 80, "avif": 55}
+
+
+def _parse_list(s: str) -> List[str]:
+    return [x.strip().lower() for x in (s or "").split(",") if x.strip()]
+
+
+def supported_formats(wanted: List[str]) -> List[str]:
+    try:
+        from PIL import features
+    except ImportError:
+        return []
+    return [f for f in wanted if f in QUALITY and features.check(f)]
+
+
+def variant_path(src_path: str, width: int, fmt: str) -> str:
+    stem, _ = os.path.splitext(src_path)
+    return f"{stem}.w{width}.{fmt}"
+
+
+def build_variants(src_path: str, widths: List[int], formats: List[str]) -> List[dict]:
+    """子プロセスで実行。既にあるファイルは作り直さない（同一内容の画像は共有されるため）"""
+    from PIL import Image
+
+    out = []
+    with Image.open(src_path) as im:
+        im.load()
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGB")
+        src_w, src_h = im.size
+        for w in sorted(set(widths)):
+            w = min(w, src_w)
+            h = max(1, round(src_h * w / src_w))
+            resized = None
+            for fmt in formats:
+                path = variant_path(src_path, w, fmt)
+                if not os.path.exists(path):
+                    if resized is None:
+                        resized = im if w == src_w else im.resize((w, h), Image.LANCZOS)
+                    tmp = f"{path}.{os.getpid()}.tmp"
+                    try:
+                        resized.save(tmp, format=fmt.upper(), quality=QUALITY[fmt])
+                        os.replace(tmp, path)
+                    finally:
+                        # エンコード途中で失敗したら書きかけを残さない（成功時は replace 済みで無い）
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(tmp)
+                out.append({
+                    "format": fmt, "width": w, "height": h,
+                    "size_bytes": os.path.getsize(path), "file_path": path.replace("\\", "/"),
+                })
+    return out
+
+
+def pick_variant(image: models.GeneratedImage, width: Optional[int], fmt: str) -> str:
+    """width 以上で最小の派生画像の path。該当がなければ最大のもの、派生がなければ元画像"""
+    cands = [v for v in image.variants if v.format == fmt] if fmt != "png" else []
+    if not cands:
+        return image.file_path
+    cands.sort(key=lambda v: v.width)
+    if width:
+        for v in cands:
+            if v.width >= width:
+                return v.file_path
+    return cands[-1].file_path
+
+
+def _worker_init() -> None:
+    # Ctrl-C はプロセスグループ全体に届く。止めるのは親の shutdown に任せる
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class VariantBuilder:
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal, workers: int = settings.IMAGE_VARIANT_WORKERS):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.widths = [int(w) for w in _parse_list(settings.IMAGE_VARIANT_WIDTHS)]
+        self.formats = supported_formats(_parse_list(settings.IMAGE_VARIANT_FORMATS))
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0 and bool(self.widths) and bool(self.formats)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # fork だと親のスレッド（書き込みスレッド・ジョブワーカー）が握っていたロックや
+                # DB 接続・uvicorn のシグナルハンドラを子が引き継ぐので、spawn で起動する
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_worker_init,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def schedule(self, image_id: int, src_path: str) -> None:
+        if not self.enabled:
+            return
+        fut = self._get_pool().submit(build_variants, src_path, self.widths, self.formats)
+        fut.add_done_callback(lambda f: self._record(image_id, f))
+
+    def _record(self, image_id: int, fut) -> None:
+        if fut.cancelled():
+            return  # shutdown で未着手のまま取り消された
+        try:
+            variants = fut.result()
+        except Exception as e:
+            log.warning(f"[ImageVariant] image={image_id} failed: {e}")
+            return
+        db = self.session_factory()
+        try:
+            if db.get(models.GeneratedImage, image_id) is None:
+                return  # 変換中に削除された
+            have = set(db.execute(
+                select(models.ImageVariant.file_path).where(models.ImageVariant.image_id == image_id)
+            ).scalars())
+            db.add_all(models.ImageVariant(image_id=image_id, **v) for v in variants if v["file_path"] not in have)
+            db.commit()
+        except Exception:
+            db.rollback()
+            log.exception(f"[ImageVariant] image={image_id} record failed")
+        finally:
+            db.close()
+
+    def shutdown(self, wait: bool = False) -> None:
+        with self._lock:
+            if self._pool is not None:
+                # wait=False でも実行中の1件は待ってワーカーを終了させる（待たないと孤児プロセスが残る）
+                self._pool.shutdown(wait=True, cancel_futures=not wait)
+                self._pool = None
+
+
+variant_builder = VariantBuilder()
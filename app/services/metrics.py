@@ -0,0 +1,221 @@
+"""計測（Prometheus テキスト形式で /metrics に出す）
+
+- http_*: ルート（/quiz/{quiz_id}/answer のようなテンプレート）ごとの件数・レイテンシ・処理中件数
+- db_*: リクエストごとの SQL 発行数と所要時間。METRICS_QUERY_WARN 件を超えたら警告ログ
+- a1111_*: ImageService._request の呼び出し回数と所要時間（結果別）
+
+ホットパスでやるのはロック1回の加算だけ。依存ライブラリは使わない。
+"""
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event
+
+from ..config import settings
+
+log = logging.getLogger("uvicorn")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+A1111_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(v: float) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def header(self) -> str:
+        return f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> str:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + "".join(f"{self.name}{_fmt_labels(self.labels, k)} {_num(v)}\n" for k, v in items)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values: Dict[tuple, list] = {}   # labels -> [bucket counts..., +Inf, sum]
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    def render(self) -> str:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        out = [self.header()]
+        for k, row in items:
+            acc = 0
+            for b, n in zip(self.buckets + (float("inf"),), row):
+                acc += n
+                le = 'le="+Inf"' if b == float("inf") else f'le="{_num(b)}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le)} {acc}\n")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_num(row[-1])}\n")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {acc}\n")
+        return "".join(out)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, m):
+        self._metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        return "".join(m.render() for m in self._metrics)
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter("http_requests_total", "HTTP requests", ("method", "route", "status")))
+http_latency = registry.register(Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route")))
+http_inflight = registry.register(Gauge("http_requests_in_flight", "HTTP requests being processed", ("method",)))
+db_queries = registry.register(Counter("db_queries_total", "SQL statements executed during requests", ("route",)))
+db_seconds = registry.register(Counter("db_query_seconds_total", "Time spent in SQL during requests", ("route",)))
+db_per_request = registry.register(Histogram("http_request_db_queries", "SQL statements per request", ("route",), QUERY_BUCKETS))
+db_heavy = registry.register(Counter("http_requests_query_heavy_total", "Requests over the query warning threshold", ("route",)))
+a1111_calls = registry.register(Counter("a1111_requests_total", "txt2img calls", ("outcome",)))
+a1111_latency = registry.register(Histogram("a1111_request_duration_seconds", "txt2img latency", ("outcome",), A1111_BUCKETS))
+
+
+# ---- SQL の計数 ----
+class _RequestStats:
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+# スレッドプールにも引き継がれる（run_in_threadpool / run_sync はコンテキストをコピーする）
+_current: contextvars.ContextVar[Optional[_RequestStats]] = contextvars.ContextVar("request_db_stats", default=None)
+
+
+def _before_cursor(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor(conn, cursor, statement, parameters, context, executemany):
+    st = _current.get()
+    if st is None:
+        return
+    stack = conn.info.get("query_start")
+    if stack:
+        st.seconds += time.perf_counter() - stack.pop()
+    st.queries += 1
+
+
+def instrument_engine(engine) -> None:
+    """同期 Engine か AsyncEngine.sync_engine に SQL の計数フックを付ける"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor):
+        event.listen(engine, "before_cursor_execute", _before_cursor)
+        event.listen(engine, "after_cursor_execute", _after_cursor)
+
+
+# ---- HTTP ----
+class MetricsMiddleware:
+    """素の ASGI ミドルウェア（BaseHTTPMiddleware より軽い）"""
+
+    def __init__(self, app, query_warn: int = settings.METRICS_QUERY_WARN):
+        self.app = app
+        self.query_warn = query_warn
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        status = 500
+        st = _RequestStats()
+        token = _current.set(st)
+
+        async def _send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_inflight.inc(method)
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            elapsed = time.perf_counter() - t0
+            http_inflight.dec(method)
+            _current.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            if route != "/metrics":
+                http_requests.inc(method, route, str(status))
+                http_latency.observe(elapsed, method, route)
+                db_per_request.observe(st.queries, route)
+                if st.queries:
+                    db_queries.inc(route, amount=st.queries)
+                    db_seconds.inc(route, amount=st.seconds)
+                if self.query_warn and st.queries > self.query_warn:
+                    db_heavy.inc(route)
+                    log.warning(f"[Metrics] {method} {route} issued {st.queries} queries ({st.seconds * 1000:.1f}ms in SQL)")
+
+
+# ---- A1111 ----
+def observe_a1111(outcome: str, seconds: float) -> None:
+    a1111_calls.inc(outcome)
+    a1111_latency.observe(seconds, outcome)
+
+
+def render() -> str:
+    return registry.render()
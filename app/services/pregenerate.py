@@ -0,0 +1,434 @@
+"""画像の一括事前生成
+
+インポートしただけのデッキは、学習者が最初に開いたときに A1111 を待たせることになる。
+画像が1枚も無いクイズを拾って先に描いておく:
+
+- 対象は run 作成時に pregen_items へ順番付きで固定する（most_answered: 回答数の多い順 /
+  newest: 新しい順）。処理済みかどうかは行ごとに持つので、止めても続きから再開できる
+- 同時実行数（concurrency）と毎分の件数（rate、トークンバケット）で A1111 への負荷を抑える。
+  画面からの生成も同じ A1111_MAX_CONCURRENCY の枠を使うので、既定は 1 並列
+- A1111 が落ちている（ブレーカーが開いている）間は失敗扱いにせず、待ってから同じ項目をやり直す
+- 停止要求は pregen_runs.status で伝えるので、別プロセス（CLI / 別ワーカー）からも止められる
+
+    python -m app.services.pregenerate start --order most_answered --concurrency 1 --rate 30
+    python -m app.services.pregenerate status [RUN_ID]
+    python -m app.services.pregenerate resume RUN_ID
+    python -m app.services.pregenerate stop RUN_ID
+
+GPU なしで試すときは tools/fake_a1111.py を立てて --a1111-url で向ける。
+"""
+import argparse
+import logging
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select, insert, update, func, desc, exists, literal
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..database import SessionLocal
+from .a1111_client import A1111Unavailable
+from .storage import StorageQuotaExceeded
+from .image_jobs import generate_and_store
+from .image_service import ImageService
+
+log = logging.getLogger("uvicorn")
+
+ORDERS = ("most_answered", "newest")
+RUN_ACTIVE = ("running", "stopping")
+HEARTBEAT = 15.0                     # 実行中は updated_at をこの間隔で進め、停止要求を確認する
+STALE_AFTER = timedelta(minutes=2)   # 実行中の run の updated_at がこれより古ければ落ちたとみなす
+FETCH = 200
+MAX_UNAVAILABLE = 3                  # A1111 に続けてこの回数つながらなければ paused にする
+
+
+def default_prompt(quiz: models.Quiz) -> str:
+    """index.html の buildDefaultPrompt と同じ文面（あとで画面から生成しても同じキャッシュキーになる）"""
+    a = f' (answer: "{quiz.answer}")' if quiz.answer else ""
+    return f'A simple, clean illustration that helps remember the word "{quiz.question}"{a}. No text, one main object, plain background.'
+
+
+# ---- run の作成・状態 ----
+def create_run(db: Session, order: str = "most_answered", user_id: Optional[int] = None, limit: Optional[int] = None) -> models.PregenRun:
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}")
+    run = models.PregenRun(ordering=order, user_id=user_id, status="pending")
+    db.add(run); db.flush()
+
+    qz = models.Quiz
+    src = select(qz.id)
+    if order == "most_answered":
+        qs = models.QuizStats
+        src = src.outerjoin(qs, qs.quiz_id == qz.id)
+        keys = (desc(func.coalesce(qs.attempts, 0)), desc(qz.created_at), desc(qz.id))
+    else:
+        keys = (desc(qz.created_at), desc(qz.id))
+    src = src.where(~exists().where(models.GeneratedImage.quiz_id == qz.id))
+    if user_id is not None:
+        src = src.where(qz.user_id == user_id)
+    ranked = src.add_columns(func.row_number().over(order_by=keys).label("seq")).order_by(*keys)
+    if limit:
+        ranked = ranked.limit(limit)
+    ranked = ranked.subquery()
+    it = models.PregenItem
+    db.execute(insert(it).from_select(
+        ["run_id", "seq", "quiz_id"], select(literal(run.id), ranked.c.seq, ranked.c.id)
+    ))
+    db.commit(); db.refresh(run)
+    return run
+
+
+def progress(db: Session, run: models.PregenRun) -> dict:
+    it = models.PregenItem
+    counts = dict(db.execute(select(it.status, func.count()).where(it.run_id == run.id).group_by(it.status)).all())
+    return {
+        "id": run.id, "ordering": run.ordering, "user_id": run.user_id, "status": run.status, "error": run.error,
+        "total": sum(counts.values()),
+        **{k: counts.get(k, 0) for k in ("pending", "done", "skipped", "failed")},
+        "created_at": run.created_at, "updated_at": run.updated_at, "finished_at": run.finished_at,
+    }
+
+
+def is_stale(run: models.PregenRun) -> bool:
+    return run.status in RUN_ACTIVE and (run.updated_at or run.created_at) < datetime.utcnow() - STALE_AFTER
+
+
+def request_stop(db: Session, run: models.PregenRun) -> models.PregenRun:
+    """実行中なら stopping にする（処理中の分が終わった時点でランナーが paused にする）"""
+    if run.status == "running" and not is_stale(run):
+        run.status = "stopping"
+    elif run.status in ("pending", "running", "stopping"):
+        run.status = "paused"
+    db.commit(); db.refresh(run)
+    return run
+
+
+def claim(db: Session, run_id: int) -> Optional[models.PregenRun]:
+    """この run を実行してよければ running にして返す（別プロセスで実行中なら None）"""
+    run = db.get(models.PregenRun, run_id)
+    if run is None or run.status == "done" or (run.status in RUN_ACTIVE and not is_stale(run)):
+        return None
+    res = db.execute(
+        update(models.PregenRun)
+        .where(models.PregenRun.id == run_id, models.PregenRun.status == run.status,
+               models.PregenRun.updated_at == run.updated_at)
+        .values(status="running", error=None, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    if res.rowcount != 1:
+        return None   # 同時に別プロセスが取った
+    db.refresh(run)
+    return run
+
+
+# ---- 実行 ----
+class RateBudget:
+    """毎分 rate_per_min 件のトークンバケット（burst 件まで貯まる）。0 以下なら無制限"""
+
+    def __init__(self, rate_per_min: float, burst: int = 1):
+        self.rate = rate_per_min / 60.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, stop: threading.Event) -> bool:
+        if self.rate <= 0:
+            return not stop.is_set()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if stop.wait(wait):
+                return False
+
+
+class PregenRunner:
+    def __init__(
+        self,
+        run_id: int,
+        concurrency: int = settings.PREGEN_CONCURRENCY,
+        rate_per_min: float = settings.PREGEN_RATE_PER_MIN,
+        session_factory: Callable[[], Session] = SessionLocal,
+        base_url: Optional[str] = None,
+    ):
+        self.run_id = run_id
+        self.concurrency = max(1, concurrency)
+        self.budget = RateBudget(rate_per_min, burst=self.concurrency)
+        self.session_factory = session_factory
+        self.base_url = base_url
+        self._stop = threading.Event()
+        self._backoff_until = 0.0
+        self._unavailable = 0   # 連続して A1111 につながらなかった回数
+        self._quota_full = False
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _one(self, seq: int, quiz_id: int) -> str:
+        db = self.session_factory()
+        try:
+            quiz = db.get(models.Quiz, quiz_id)
+            error = None
+            if quiz is None or db.execute(select(exists().where(models.GeneratedImage.quiz_id == quiz_id))).scalar():
+                status = "skipped"   # 削除された／その後に画面から生成された
+            else:
+                try:
+                    generate_and_store(db, ImageService(db, base_url=self.base_url), quiz, default_prompt(quiz), force=False)
+                    status = "done"
+                    self._unavailable = 0
+                except A1111Unavailable as e:
+                    db.rollback()
+                    log.warning(f"[Pregen] run {self.run_id}: A1111 unavailable ({e}); backing off")
+                    self._backoff_until = time.monotonic() + settings.A1111_BREAKER_RESET
+                    self._unavailable += 1
+                    if self._unavailable >= MAX_UNAVAILABLE:
+                        self._stop.set()
+                    return "unavailable"
+                except StorageQuotaExceeded as e:
+                    # 残りも同じ理由で失敗するので、項目は pending のまま止める
+                    db.rollback()
+                    log.warning(f"[Pregen] run {self.run_id}: {e}; pausing")
+                    self._quota_full = True
+                    self._stop.set()
+                    return "quota"
+                except Exception as e:
+                    db.rollback()
+                    log.warning(f"[Pregen] run {self.run_id} quiz {quiz_id} failed: {e}")
+                    status, error = "failed", str(e)[:500]
+            it = models.PregenItem
+            db.execute(update(it).where(it.run_id == self.run_id, it.seq == seq).values(status=status, error=error))
+            db.commit()
+            return status
+        finally:
+            db.close()
+
+    def _heartbeat(self, done: threading.Event) -> None:
+        """updated_at を進め、stopping になっていたら止める（待ち時間中も動くよう別スレッド）"""
+        pr = models.PregenRun
+        while not done.wait(HEARTBEAT):
+            db = self.session_factory()
+            try:
+                res = db.execute(
+                    update(pr).where(pr.id == self.run_id, pr.status == "running")
+                    .values(updated_at=datetime.utcnow()).execution_options(synchronize_session=False)
+                )
+                db.commit()
+                if res.rowcount != 1:
+                    log.info(f"[Pregen] run {self.run_id}: stop requested")
+                    self._stop.set()
+                    return
+            except Exception:
+                log.exception(f"[Pregen] run {self.run_id}: heartbeat failed")
+            finally:
+                db.close()
+
+    def _pending(self, db: Session, after_seq: int) -> List[tuple]:
+        it = models.PregenItem
+        return db.execute(
+            select(it.seq, it.quiz_id)
+            .where(it.run_id == self.run_id, it.status == "pending", it.seq > after_seq)
+            .order_by(it.seq).limit(FETCH)
+        ).all()
+
+    def _wait_backoff(self) -> bool:
+        while not self._stop.is_set():
+            left = self._backoff_until - time.monotonic()
+            if left <= 0:
+                return True
+            self._stop.wait(min(left, 5.0))
+        return False
+
+    def run(self) -> dict:
+        """pending の項目を処理し終えるか止められるまでブロックする。claim 済みであること"""
+        db = self.session_factory()
+        slots = threading.BoundedSemaphore(self.concurrency)
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(done,), name=f"pregen-hb-{self.run_id}", daemon=True).start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"pregen-{self.run_id}") as ex:
+                while not self._stop.is_set():
+                    # 1周して何も進まなければ（A1111 がずっと落ちている等）いったん止める
+                    before = self._pending_count(db)
+                    last_seq = 0
+                    while not self._stop.is_set():
+                        batch = self._pending(db, last_seq)
+                        if not batch:
+                            break
+                        for seq, quiz_id in batch:
+                            if not self._wait_backoff() or not self.budget.acquire(self._stop):
+                                break
+                            slots.acquire()
+                            if self._stop.is_set():
+                                slots.release(); break
+                            ex.submit(self._one, seq, quiz_id).add_done_callback(lambda _f: slots.release())
+                            last_seq = seq
+                    # 処理中の分が終わるのを待ってから残りを数える
+                    for _ in range(self.concurrency):
+                        slots.acquire()
+                    for _ in range(self.concurrency):
+                        slots.release()
+                    after = self._pending_count(db)
+                    if after == 0 or after == before:
+                        break
+            return self._finish(db)
+        finally:
+            done.set()
+            db.close()
+
+    def _pending_count(self, db: Session) -> int:
+        it = models.PregenItem
+        return db.execute(select(func.count()).where(it.run_id == self.run_id, it.status == "pending")).scalar_one()
+
+    def _finish(self, db: Session) -> dict:
+        run = db.get(models.PregenRun, self.run_id)
+        db.refresh(run)
+        if self._pending_count(db) == 0:
+            run.status, run.finished_at = "done", datetime.utcnow()
+        else:
+            run.status = "paused"
+            if self._quota_full:
+                run.error = "image storage over quota; free space (python -m app.services.storage gc) and resume"
+            elif self._unavailable:
+                run.error = "A1111 unavailable; resume later"
+        db.commit()
+        out = progress(db, run)
+        log.info(f"[Pregen] run {self.run_id} {run.status}: done={out['done']} skipped={out['skipped']} "
+                 f"failed={out['failed']} pending={out['pending']}")
+        return out
+
+
+class Pregenerator:
+    """管理 API から起動した run をバックグラウンドスレッドで回す（プロセス内）"""
+
+    def __init__(self, session_factory: Callable[[], Session] = SessionLocal):
+        self.session_factory = session_factory
+        self._runners: Dict[int, tuple] = {}   # run_id -> (runner, thread)
+        self._lock = threading.Lock()
+
+    def start(self, run_id: int, concurrency: int = settings.PREGEN_CONCURRENCY, rate_per_min: float = settings.PREGEN_RATE_PER_MIN) -> bool:
+        with self._lock:
+            cur = self._runners.get(run_id)
+            if cur is not None and cur[1].is_alive():
+                return False
+            db = self.session_factory()
+            try:
+                if claim(db, run_id) is None:
+                    return False
+            finally:
+                db.close()
+            runner = PregenRunner(run_id, concurrency, rate_per_min, self.session_factory)
+            th = threading.Thread(target=self._run, args=(runner,), name=f"pregen-run-{run_id}", daemon=True)
+            self._runners[run_id] = (runner, th)
+            th.start()
+            return True
+
+    def stop(self, run_id: int) -> None:
+        """このプロセスで回していればすぐ止める（他プロセスの分はハートビートで stopping に気づく）"""
+        with self._lock:
+            cur = self._runners.get(run_id)
+        if cur is not None:
+            cur[0].stop()
+
+    def _run(self, runner: PregenRunner) -> None:
+        try:
+            runner.run()
+        except Exception:
+            log.exception(f"[Pregen] run {runner.run_id} crashed")
+        finally:
+            with self._lock:
+                self._runners.pop(runner.run_id, None)
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        with self._lock:
+            items = list(self._runners.values())
+        for runner, _ in items:
+            runner.stop()
+        for _, th in items:
+            th.join(timeout)
+
+
+pregenerator = Pregenerator()
+
+
+def main(argv=None) -> int:
+    from .a1111_client import close_clients
+    from .image_variants import variant_builder
+
+    ap = argparse.ArgumentParser(prog="python -m app.services.pregenerate", description="画像の無いクイズの一括事前生成")
+    sub = ap.add_subparsers(dest="command", required=True)
+    p_start = sub.add_parser("start", help="対象を固定して新しい run を作り、実行する")
+    p_start.add_argument("--order", choices=ORDERS, default="most_answered")
+    p_start.add_argument("--user-id", type=int, default=None, help="このユーザーのクイズだけ")
+    p_start.add_argument("--limit", type=int, default=None, help="対象の最大件数")
+    p_start.add_argument("--dry-run", action="store_true", help="run を作って件数を表示するだけ（実行しない）")
+    p_resume = sub.add_parser("resume", help="止めた run を続きから実行する")
+    p_resume.add_argument("run_id", type=int)
+    for p in (p_start, p_resume):
+        p.add_argument("--concurrency", type=int, default=settings.PREGEN_CONCURRENCY)
+        p.add_argument("--rate", type=float, default=settings.PREGEN_RATE_PER_MIN, help="毎分の生成件数の上限（0 で無制限）")
+        p.add_argument("--a1111-url", default=None, help="省略時は A1111_BASE_URL")
+    p_status = sub.add_parser("status")
+    p_status.add_argument("run_id", type=int, nargs="?")
+    p_stop = sub.add_parser("stop")
+    p_stop.add_argument("run_id", type=int)
+    args = ap.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        if args.command == "status":
+            q = select(models.PregenRun).order_by(desc(models.PregenRun.id))
+            q = q.where(models.PregenRun.id == args.run_id) if args.run_id else q.limit(20)
+            for run in db.execute(q).scalars():
+                p = progress(db, run)
+                print(f"run {p['id']} [{p['status']}{' (stale)' if is_stale(run) else ''}] order={p['ordering']} "
+                      f"total={p['total']} done={p['done']} skipped={p['skipped']} failed={p['failed']} pending={p['pending']}"
+                      + (f" error={p['error']}" if p["error"] else ""))
+            return 0
+        if args.command == "stop":
+            run = db.get(models.PregenRun, args.run_id)
+            if run is None:
+                print(f"run {args.run_id} not found", file=sys.stderr); return 1
+            print(f"run {run.id} -> {request_stop(db, run).status}")
+            return 0
+        if args.command == "start":
+            run = create_run(db, order=args.order, user_id=args.user_id, limit=args.limit)
+            print(f"created run {run.id}: {progress(db, run)['total']} quiz(zes)")
+            if args.dry_run:
+                return 0
+            run_id = run.id
+        else:
+            run_id = args.run_id
+        if claim(db, run_id) is None:
+            print(f"run {run_id} is missing, finished or running elsewhere", file=sys.stderr)
+            return 1
+    finally:
+        db.close()
+
+    runner = PregenRunner(run_id, args.concurrency, args.rate, base_url=args.a1111_url)
+    # Ctrl-C / SIGTERM: 処理中の分を書き終えてから paused にする
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: runner.stop())
+    try:
+        out = runner.run()
+    finally:
+        variant_builder.shutdown(wait=True)
+        close_clients()
+    print(f"run {run_id} {out['status']}: done={out['done']} skipped={out['skipped']} failed={out['failed']} pending={out['pending']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
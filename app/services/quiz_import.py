@@ -0,0 +1,301 @@
+"""クイズの一括インポート
+
+アップロードをストリームのまま1レコードずつ読み、QuizCreate で検証して BATCH_SIZE 件ごとに
+executemany で INSERT する（1バッチ1コミット。書き込みスレッドが有効ならそちらでコミットする）。不正な行はエラーとして記録して読み進める。
+dedupe=True なら (user, question) が既にあるものは飛ばすので、同じファイルを何度入れても増えない。
+
+対応形式:
+- CSV（text/csv）: ヘッダ行に question, answer（任意で prompt）。引用符で囲んだセル内の改行も可
+- NDJSON（application/x-ndjson）: 1行1オブジェクト
+- JSON 配列（application/json）: 要素ごとに読み進める（全体は読み込まない）
+
+どの形式も1レコードは MAX_RECORD_CHARS まで。
+"""
+import codecs
+import csv
+import json
+import re
+from collections import deque
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from pydantic import ValidationError
+from sqlalchemy import select, insert
+from sqlalchemy.orm import Session
+
+from .. import models, schemas
+from . import stats, grading, response_cache, search
+from .write_queue import writer
+
+BATCH_SIZE = 500
+MAX_ERRORS = 1000  # レスポンスに載せるエラーの上限（件数自体は error_count で返す）
+MAX_RECORD_CHARS = 1024 * 1024  # 1レコード（CSV の複数行セルを含む1行・JSON 配列の1要素）の上限
+
+
+async def iter_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    async for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    pending = ""
+    async for text in iter_text(chunks):
+        pending += text
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    if pending:
+        yield pending.rstrip("\r")
+
+
+async def iter_records(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[Tuple[int, object]]:
+    """(行番号, dict または例外) を返す。行番号は 1 始まり（CSV はヘッダを 1 行目と数え、
+    複数行にまたがるレコードはその開始行。JSON 配列は要素の番号）"""
+    ctype = (content_type or "").split(";")[0].strip().lower()
+    if ctype in ("application/json", "text/json"):
+        records = _iter_json_array(chunks)
+    elif ctype in ("text/csv", "application/csv"):
+        records = _iter_csv(chunks)
+    else:
+        records = _iter_ndjson(chunks)
+    async for rec in records:
+        yield rec
+
+
+async def _iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    lineno = 0
+    async for line in iter_lines(chunks):
+        lineno += 1
+        if not line.strip():
+            continue
+        try:
+            yield lineno, json.loads(line)
+        except ValueError as e:
+            yield lineno, e
+
+
+async def _iter_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    """1つの csv.reader に1レコード分ずつ渡す。引用符の数が奇数のあいだはセル内改行とみなして次の行をつなぐ"""
+    feed: deque = deque()
+    reader = csv.reader(iter(feed.popleft, None))
+    header: Optional[List[str]] = None
+    parts: List[str] = []
+    start = lineno = quotes = size = 0
+    async for line in iter_lines(chunks):
+        lineno += 1
+        if not parts:
+            if not line.strip():
+                continue
+            start = lineno
+        parts.append(line)
+        quotes += line.count('"')
+        size += len(line) + 1
+        if quotes % 2:
+            if size > MAX_RECORD_CHARS:
+                yield start, ValueError(f"record too large (> {MAX_RECORD_CHARS} chars) or unterminated quote")
+                parts, quotes, size = [], 0, 0
+            continue
+        feed.append("\n".join(parts))
+        parts, quotes, size = [], 0, 0
+        try:
+            cells = next(reader)
+        except csv.Error as e:
+            yield start, e
+            continue
+        if header is None:
+            header = [c.strip().lower() for c in cells]
+            continue
+        yield start, dict(zip(header, cells))
+    if parts:
+        yield start, ValueError("unterminated quoted field")
+
+
+_WS = re.compile(r"[ \t\r\n]*")
+
+
+async def _iter_json_array(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    """JSON 配列を要素ごとに読む（全体をメモリに載せない）。1要素は MAX_RECORD_CHARS まで。
+    配列の区切りが壊れていたらそこで打ち切る（以降の要素の位置が分からないため）"""
+    decoder = json.JSONDecoder()
+    texts = iter_text(chunks).__aiter__()
+    buf, pos, done = "", 0, False
+
+    async def fill() -> bool:
+        nonlocal buf, pos, done
+        if done:
+            return False
+        try:
+            text = await texts.__anext__()
+        except StopAsyncIteration:
+            done = True
+            return False
+        buf, pos = buf[pos:] + text, 0
+        return True
+
+    async def next_char() -> Optional[str]:
+        nonlocal pos
+        while True:
+            pos = _WS.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not await fill():
+                return None
+
+    first = await next_char()
+    if first is None:
+        return
+    if first != "[":   # 配列でなければ1件として扱う
+        while await fill():
+            if len(buf) - pos > MAX_RECORD_CHARS:
+                yield 1, ValueError(f"record too large (> {MAX_RECORD_CHARS} chars)")
+                return
+        try:
+            yield 1, json.loads(buf[pos:])
+        except ValueError as e:
+            yield 1, e
+        return
+    pos += 1
+    index = 0
+    if await next_char() == "]":
+        return
+    while True:
+        if await next_char() is None:
+            yield index + 1, ValueError("unterminated JSON array")
+            return
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError as e:
+                obj, end = e, None
+            # 末尾ちょうどで終わった値（数値など）は続きがあるかもしれないので読み足して確かめる
+            if end is not None and (end < len(buf) or done):
+                break
+            if len(buf) - pos > MAX_RECORD_CHARS:
+                yield index + 1, ValueError(f"record too large (> {MAX_RECORD_CHARS} chars)")
+                return
+            if not await fill() and end is None:
+                yield index + 1, obj
+                return
+        index += 1
+        yield index, obj
+        pos = end
+        sep = await next_char()
+        if sep == "]":
+            return
+        if sep != ",":
+            yield index + 1, ValueError("expected ',' or ']' in JSON array")
+            return
+        pos += 1
+
+
+def validate(obj) -> schemas.QuizCreate:
+    if isinstance(obj, Exception):
+        raise obj
+    if not isinstance(obj, dict):
+        raise ValueError("row must be an object")
+    return schemas.QuizCreate.model_validate(obj)
+
+
+def insert_batch(db: Session, user_id: int, rows: List[Tuple[int, schemas.QuizCreate]], dedupe: bool) -> Tuple[int, int]:
+    """1トランザクションで挿入。戻り値は (inserted, skipped)"""
+    if dedupe:
+        questions = list({r.question for _, r in rows})
+        existing = set(db.execute(
+            select(models.Quiz.question).where(models.Quiz.user_id == user_id, models.Quiz.question.in_(questions))
+        ).scalars())
+    values, skipped = [], 0
+    for _, r in rows:
+        if dedupe:
+            if r.question in existing:
+                skipped += 1
+                continue
+            existing.add(r.question)
+        values.append({"user_id": user_id, "question": r.question, "answer": r.answer, **grading.key_fields(r.answer)})
+    if values:
+        if writer.enabled:
+            writer.run(_insert_quizzes, user_id, values)
+        else:
+            _insert_quizzes(db, user_id, values)
+    db.commit()
+    return len(values), skipped
+
+
+def _insert_quizzes(db: Session, user_id: int, values: List[dict]) -> None:
+    qz = models.Quiz
+    ids = db.execute(insert(qz).returning(qz.id, sort_by_parameter_order=True), values).scalars().all()
+    search.index_quizzes(db, [(user_id, qid, v["question"], v["answer"]) for qid, v in zip(ids, values)])
+    stats.bump_user(db, user_id, total_quizzes=len(values))
+    response_cache.bump(db, user_id)
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors: List[dict] = []
+
+    def add_error(self, row: int, err: Exception) -> None:
+        self.error_count += 1
+        if len(self.errors) >= MAX_ERRORS:
+            return
+        if isinstance(err, ValidationError):
+            msg = "; ".join(f"{'.'.join(str(x) for x in e['loc'])}: {e['msg']}" for e in err.errors())
+        else:
+            msg = str(err)
+        self.errors.append({"row": row, "error": msg})
+
+    def as_dict(self) -> dict:
+        return {"inserted": self.inserted, "skipped": self.skipped, "error_count": self.error_count, "errors": self.errors}
+
+
+def _flush(db: Session, user_id: int, batch, dedupe: bool, report: ImportReport) -> None:
+    try:
+        ins, skip = insert_batch(db, user_id, batch, dedupe)
+        report.inserted += ins
+        report.skipped += skip
+    except Exception as e:
+        db.rollback()
+        for row, _ in batch:
+            report.add_error(row, e)
+
+
+async def import_stream(db: Session, user: models.User, chunks: AsyncIterator[bytes], content_type: str, dedupe: bool, run_sync) -> ImportReport:
+    """run_sync: DB 処理をスレッドで実行する関数（fastapi.concurrency.run_in_threadpool）"""
+    report = ImportReport()
+    batch: List[Tuple[int, schemas.QuizCreate]] = []
+    async for row, obj in iter_records(chunks, content_type):
+        try:
+            batch.append((row, validate(obj)))
+        except Exception as e:
+            report.add_error(row, e)
+            continue
+        if len(batch) >= BATCH_SIZE:
+            await run_sync(_flush, db, user.id, batch, dedupe, report)
+            batch = []
+    if batch:
+        await run_sync(_flush, db, user.id, batch, dedupe, report)
+    return report
+
+
+def import_rows(db: Session, user: models.User, objs: Iterable[Tuple[int, object]], dedupe: bool) -> ImportReport:
+    """同期版（スクリプト・テスト用）"""
+    report = ImportReport()
+    batch = []
+    for row, obj in objs:
+        try:
+            batch.append((row, validate(obj)))
+        except Exception as e:
+            report.add_error(row, e)
+            continue
+        if len(batch) >= BATCH_SIZE:
+            _flush(db, user.id, batch, dedupe, report)
+            batch = []
+    if batch:
+        _flush(db, user.id, batch, dedupe, report)
+    return report
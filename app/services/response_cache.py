@@ -0,0 +1,149 @@
+"""一覧・集計レスポンスの条件付き GET とプロセス内キャッシュ
+
+users.data_version はそのユーザーのデータが変わるたびに crud の書き込みと同じトランザクションで
+1 増える（クイズの作成・削除・インポート、回答、画像の追加）。読み取り側は:
+
+1. data_version を主キーで読む（複数ワーカーでも DB が正なので食い違わない）
+2. If-None-Match が W/"<user_id>.<version>" と一致すれば 304
+3. (user, パス, クエリ) の組でシリアライズ済みの本文がこの版のものならそれを返す
+4. なければクエリを流してシリアライズし、キャッシュに入れて返す
+
+版は本文を読む前に取るので、キャッシュの中身がその版より古くなることはない。
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+
+try:
+    import orjson
+except ImportError:   # 任意依存（無ければ常に pydantic で書く）
+    orjson = None
+
+MEDIA_TYPE = "application/json"
+
+
+# ---- データの版（crud の書き込みから呼ぶ） ----
+def bump(db: Session, user_id: int) -> None:
+    u = models.User
+    db.execute(
+        update(u).where(u.id == user_id).values(data_version=u.data_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def bump_all(db: Session) -> None:
+    """集計の作り直し・再採点など、全ユーザーの結果が変わりうる処理のあとに呼ぶ"""
+    u = models.User
+    db.execute(update(u).values(data_version=u.data_version + 1).execution_options(synchronize_session=False))
+
+
+def version_stmt(user_id: int):
+    return select(models.User.data_version).where(models.User.id == user_id)
+
+
+def current_version(db: Session, user_id: Optional[int]) -> Optional[int]:
+    if user_id is None:
+        return None
+    return db.execute(version_stmt(user_id)).scalar_one_or_none()
+
+
+def serialize(adapter: TypeAdapter, data, trusted: bool = False) -> bytes:
+    """response_model と同じ検証・変換をして JSON にする。
+
+    trusted=True は crud が SQL の行から型を揃えて組んだ dict（int / bool / str / None / float /
+    naive datetime）のリストで、検証しても何も変わらないもの。orjson があれば検証とモデルの組み立てを
+    飛ばしてそのまま書く（出力のバイト列は pydantic と同じ）。書けない値が混じっていれば pydantic に戻す。
+    """
+    if trusted and orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_UTC_Z)
+        except TypeError:   # orjson.JSONEncodeError
+            pass
+    return adapter.dump_json(adapter.validate_python(data))
+
+
+def etag(user_id: int, version: int) -> str:
+    # 圧縮の有無で本文のバイト列は変わるので弱い ETag にする
+    return f'W/"{user_id}.{version}"'
+
+
+def _matches(if_none_match: Optional[str], tag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(t.strip() in (tag, "*") for t in if_none_match.split(","))
+
+
+# ---- シリアライズ済み本文のキャッシュ ----
+class ResponseCache:
+    def __init__(self, maxsize: int = settings.RESPONSE_CACHE_SIZE, max_bytes: int = settings.RESPONSE_CACHE_MAX_BYTES):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[tuple, Tuple[int, bytes, Dict[str, str]]]" = OrderedDict()  # key -> (version, body, headers)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(request: Request, user_id: int) -> tuple:
+        return (user_id, request.url.path, tuple(sorted(request.query_params.multi_items())))
+
+    def get(self, key: tuple, version: int) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None or hit[0] != version:
+                return None
+            self._data.move_to_end(key)
+            return hit[1], hit[2]
+
+    def put(self, key: tuple, version: int, body: bytes, headers: Dict[str, str]) -> None:
+        if self.maxsize <= 0 or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._data[key] = (version, body, headers)
+            self._bytes += len(body)
+            while len(self._data) > self.maxsize or self._bytes > self.max_bytes:
+                _, (_, b, _) = self._data.popitem(last=False)
+                self._bytes -= len(b)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    # ---- ルートから使う ----
+    def lookup(self, request: Request, user_id: Optional[int], version: Optional[int]) -> Optional[Response]:
+        """304 かキャッシュ済みの 200 を返す。どちらでもなければ None（呼び出し側で作って store する）"""
+        if user_id is None or version is None:
+            return None
+        tag = etag(user_id, version)
+        if _matches(request.headers.get("if-none-match"), tag):
+            return Response(status_code=304, headers=_cache_headers(tag))
+        hit = self.get(self.key(request, user_id), version)
+        if hit is None:
+            return None
+        body, headers = hit
+        return Response(body, media_type=MEDIA_TYPE, headers={**headers, **_cache_headers(tag)})
+
+    def store(self, request: Request, user_id: Optional[int], version: Optional[int], body: bytes, headers: Dict[str, str]) -> Response:
+        if user_id is None or version is None:
+            return Response(body, media_type=MEDIA_TYPE, headers=headers)
+        self.put(self.key(request, user_id), version, body, headers)
+        return Response(body, media_type=MEDIA_TYPE, headers={**headers, **_cache_headers(etag(user_id, version))})
+
+
+def _cache_headers(tag: str) -> Dict[str, str]:
+    # ブラウザには毎回問い合わせさせる（ユーザーごとに X-Token で中身が変わる）
+    return {"ETag": tag, "Cache-Control": "private, no-cache", "Vary": "X-Token"}
+
+
+response_cache = ResponseCache()
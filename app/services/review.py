@@ -0,0 +1,253 @@
+"""復習スケジュール（SM-2）
+
+(user, quiz) ごとに review_states の1行を持ち、crud が回答を記録するのと同じトランザクションで
+次の出題日時 due_at を更新する。「次に復習するクイズ」は (user_id, due_at) の索引を先頭から
+limit 件読むだけなので、クイズ数や回答履歴の量に依存しない。
+
+SM-2 の評価 q（0〜5）は正誤と画像の有無から決める:
+
+- 不正解 → 2。連続正解を 0 に戻し、RELEARN_DELAY 後にもう一度出す
+- 画像ありで正解 → 3（ヒントを見て正解）
+- 画像なしで正解 → 4
+
+期限前に正解しても間隔は伸ばさない（同じ日に何度も解いて間隔が跳ね上がらないように）。
+
+ずれた場合の確認・作り直し（answer_logs とそのアーカイブを answered_at 順に再生する）:
+
+    python -m app.services.review verify
+    python -m app.services.review rebuild
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select, delete, insert, exists, union_all
+from sqlalchemy.orm import Session
+
+from .. import models
+
+INITIAL_EASE = 2.5
+MIN_EASE = 1.3
+RELEARN_DELAY = timedelta(minutes=10)
+QUALITY_WRONG, QUALITY_WITH_IMAGE, QUALITY_CORRECT = 2, 3, 4
+
+STATE_COLS = ("ease", "interval_days", "repetitions", "lapses", "due_at", "last_answered_at")
+
+
+def quality(correct: bool, image_shown: bool) -> int:
+    if not correct:
+        return QUALITY_WRONG
+    return QUALITY_WITH_IMAGE if image_shown else QUALITY_CORRECT
+
+
+def new_state(user_id: int, quiz_id: int) -> models.ReviewState:
+    return models.ReviewState(user_id=user_id, quiz_id=quiz_id, ease=INITIAL_EASE,
+                              interval_days=0, repetitions=0, lapses=0)
+
+
+def apply(st: models.ReviewState, correct: bool, image_shown: bool, at: datetime) -> models.ReviewState:
+    """1回分の回答で st を進める（DB には触らない）"""
+    q = quality(correct, image_shown)
+    if q >= 3 and st.due_at is not None and at < st.due_at:
+        st.last_answered_at = max(at, st.last_answered_at or at)
+        return st
+    if q >= 3:
+        if st.repetitions == 0:
+            interval = 1
+        elif st.repetitions == 1:
+            interval = 6
+        else:
+            interval = max(1, round(st.interval_days * st.ease))
+        st.repetitions += 1
+        st.due_at = at + timedelta(days=interval)
+    else:
+        interval = 1
+        st.repetitions = 0
+        st.lapses += 1
+        st.due_at = at + RELEARN_DELAY
+    st.interval_days = interval
+    st.ease = max(MIN_EASE, round(st.ease + 0.1 - (5 - q) * (0.08 + (5 - q) * 0.02), 2))
+    st.last_answered_at = at
+    return st
+
+
+# ---- 書き込み（crud から同じトランザクションで呼ぶ） ----
+def _ensure_states(db: Session, user_id: int, quiz_ids: Sequence[int], at: datetime) -> Dict[int, models.ReviewState]:
+    """行が無ければ初期状態で作り、ロックして読む。
+
+    読んでから db.add() すると、同じ新しいクイズへの回答が同時に来たとき両方が「行なし」と見て
+    後のコミットが主キー違反になる。先に ON CONFLICT DO NOTHING で作っておけば、後の方は先の行を
+    （Postgres では FOR UPDATE で待ってから）読んで続きを適用する。due_at は apply で上書きされる。
+    """
+    rs = models.ReviewState
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        rows = [{"user_id": user_id, "quiz_id": qid, "ease": INITIAL_EASE, "interval_days": 0,
+                 "repetitions": 0, "lapses": 0, "due_at": at} for qid in quiz_ids]
+        db.execute(dialect_insert(rs).on_conflict_do_nothing(index_elements=["user_id", "quiz_id"]), rows)
+    states = {
+        st.quiz_id: st for st in db.execute(
+            select(rs).where(rs.user_id == user_id, rs.quiz_id.in_(quiz_ids))
+            .with_for_update().execution_options(populate_existing=True)
+        ).scalars()
+    }
+    for qid in quiz_ids:
+        if qid not in states:   # 上の INSERT が使えない DB
+            states[qid] = new_state(user_id, qid)
+            db.add(states[qid])
+    return states
+
+
+def record_answer(db: Session, user_id: int, quiz_id: int, correct: bool, image_shown: bool, at: datetime) -> None:
+    st = _ensure_states(db, user_id, [quiz_id], at)[quiz_id]
+    apply(st, correct, image_shown, at)
+
+
+def record_answers(db: Session, user_id: int, logs: Sequence[models.AnswerLog]) -> None:
+    """まとめて記録された回答を反映する。状態の作成・読み出しは IN 1回ずつ"""
+    quiz_ids = sorted({r.quiz_id for r in logs})
+    if not quiz_ids:
+        return
+    states = _ensure_states(db, user_id, quiz_ids, min(r.answered_at for r in logs))
+    for r in sorted(logs, key=lambda r: r.answered_at):
+        apply(states[r.quiz_id], r.is_correct, bool(r.image_shown), r.answered_at)
+
+
+def forget_quiz(db: Session, quiz_id: int, user_id: int) -> None:
+    db.execute(delete(models.ReviewState).where(
+        models.ReviewState.user_id == user_id, models.ReviewState.quiz_id == quiz_id
+    ))
+
+
+# ---- 読み出し ----
+def _item(st: Optional[models.ReviewState], quiz_id: int, question: str) -> dict:
+    if st is None:
+        return {"quiz_id": quiz_id, "question": question, "due_at": None, "ease": INITIAL_EASE,
+                "interval_days": 0, "repetitions": 0, "lapses": 0, "is_new": True}
+    return {"quiz_id": quiz_id, "question": question, "due_at": st.due_at, "ease": st.ease,
+            "interval_days": st.interval_days, "repetitions": st.repetitions, "lapses": st.lapses, "is_new": False}
+
+
+def next_due(db: Session, user_id: Optional[int], limit: int = 20, include_new: bool = False,
+             now: Optional[datetime] = None) -> List[dict]:
+    """期限の来たクイズを due_at の古い順に返す。
+
+    include_new のときは足りない分を未回答のクイズ（作成順）で埋める。こちらは
+    ix_quizzes_user_created を順に読んで状態の無いものを拾うので、回答済みが多いほど読む量が増える。
+    """
+    if user_id is None:
+        return []
+    now = now or datetime.utcnow()
+    rs, qz = models.ReviewState, models.Quiz
+    items = [
+        _item(st, st.quiz_id, question) for st, question in db.execute(
+            select(rs, qz.question)
+            .join(qz, qz.id == rs.quiz_id)
+            .where(rs.user_id == user_id, rs.due_at <= now)
+            .order_by(rs.due_at, rs.quiz_id)
+            .limit(limit)
+        ).all()
+    ]
+    if include_new and len(items) < limit:
+        answered = exists().where(rs.user_id == user_id, rs.quiz_id == qz.id)
+        items.extend(
+            _item(None, qid, question) for qid, question in db.execute(
+                select(qz.id, qz.question)
+                .where(qz.user_id == user_id, ~answered)
+                .order_by(qz.created_at, qz.id)
+                .limit(limit - len(items))
+            ).all()
+        )
+    return items
+
+
+# ---- 作り直し / 検証 ----
+def replay(db: Session, include_archive: bool = True) -> Iterator[models.ReviewState]:
+    """answer_logs（+ answer_logs_archive）を (user, quiz, answered_at) 順に読み、各 (user, quiz) の最終状態を返す"""
+    parts = [
+        select(m.user_id, m.quiz_id, m.is_correct, m.image_shown, m.answered_at, m.id)
+        for m in ((models.AnswerLogArchive,) if include_archive else ()) + (models.AnswerLog,)
+    ]
+    al = union_all(*parts).subquery("answers")
+    st = None
+    rows = db.execute(
+        select(al.c.user_id, al.c.quiz_id, al.c.is_correct, al.c.image_shown, al.c.answered_at)
+        .order_by(al.c.user_id, al.c.quiz_id, al.c.answered_at, al.c.id)
+        .execution_options(yield_per=5000)
+    )
+    for uid, qid, correct, image_shown, at in rows:
+        if st is None or (st.user_id, st.quiz_id) != (uid, qid):
+            if st is not None:
+                yield st
+            st = new_state(uid, qid)
+        apply(st, correct, bool(image_shown), at)
+    if st is not None:
+        yield st
+
+
+def _as_row(st: models.ReviewState) -> dict:
+    return {"user_id": st.user_id, "quiz_id": st.quiz_id, **{c: getattr(st, c) for c in STATE_COLS}}
+
+
+def rebuild(db: Session, batch: int = 5000, include_archive: bool = True) -> int:
+    # replay はカーソルを開いたまま読むので、書き込みは読み終えてからまとめて行う
+    rows = [_as_row(st) for st in replay(db, include_archive)]
+    db.execute(delete(models.ReviewState))
+    for i in range(0, len(rows), batch):
+        db.execute(insert(models.ReviewState), rows[i:i + batch])
+    db.commit()
+    return len(rows)
+
+
+def verify(db: Session) -> List[str]:
+    expected: Dict[Tuple[int, int], dict] = {(st.user_id, st.quiz_id): _as_row(st) for st in replay(db)}
+    actual = {(st.user_id, st.quiz_id): _as_row(st) for st in db.execute(select(models.ReviewState)).scalars()}
+    diffs = []
+    for key in sorted(set(expected) | set(actual)):
+        exp, act = expected.get(key), actual.get(key)
+        if exp is None or act is None:
+            diffs.append(f"user {key[0]} quiz {key[1]}: {'missing' if act is None else 'unexpected'} review state")
+            continue
+        for c in STATE_COLS:
+            if act[c] != exp[c]:
+                diffs.append(f"user {key[0]} quiz {key[1]} {c}: stored={act[c]} expected={exp[c]}")
+    return diffs
+
+
+def ensure_initialized(db: Session) -> bool:
+    """review_states 導入前のDBなら一度だけ作り直す（マイグレーションから呼ぶ）"""
+    has_states = db.execute(select(models.ReviewState.user_id).limit(1)).first() is not None
+    has_answers = db.execute(select(models.AnswerLog.id).limit(1)).first() is not None
+    if has_states or not has_answers:
+        return False
+    rebuild(db, include_archive=False)   # マイグレーション 5 の時点ではアーカイブはまだ無い
+    return True
+
+
+def main(argv=None) -> int:
+    from ..database import SessionLocal
+
+    ap = argparse.ArgumentParser(prog="python -m app.services.review", description="review_states の検証・再構築")
+    ap.add_argument("command", choices=["verify", "rebuild"])
+    args = ap.parse_args(argv)
+    db = SessionLocal()
+    try:
+        if args.command == "rebuild":
+            print(f"rebuilt review_states={rebuild(db)}")
+            return 0
+        diffs = verify(db)
+        for d in diffs[:100]:
+            print(d)
+        print("OK" if not diffs else f"{len(diffs)} mismatch(es)")
+        return 0 if not diffs else 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""クイズの全文検索
+
+DB ごとに使える仕組みを起動時に選ぶ:
+
+- SQLite: FTS5 の trigram トークナイザ（文字3-gram なので分かち書き不要で日本語も引ける）。
+  quizzes_fts は quizzes を content にした外部コンテンツテーブルで、トリガーで同期する
+- Postgres: pg_trgm の GIN インデックス。ILIKE がインデックスを使い、similarity で並べる
+- どちらも無い: ILIKE（そのユーザーのクイズを走査）
+- 3文字未満の語（trigram では引けない）: quiz_grams（文字 1-gram / 2-gram の表。DB によらない）を
+  (user_id, gram) の主キーで引いて候補を絞り、ILIKE で確かめる。表はクイズの作成・インポート・削除で
+  index_quizzes / forget_quiz が更新する。直接 INSERT した行は rebuild_grams で取り込む
+
+ハイライトは HTML エスケープ済みで、一致部分だけ <mark> で囲んで返す。
+"""
+import html
+import logging
+import re
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import text, select, desc, func, literal_column, and_, delete, insert, Integer, String, DateTime, Float
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .. import models
+
+log = logging.getLogger("uvicorn")
+
+MIN_TRIGRAM = 3
+GRAM_CHUNK = 500
+# FTS5 の highlight に渡す印（本文に出てこない制御文字）。後で <mark> に置き換える
+_OPEN, _CLOSE = "\x02", "\x03"
+
+backend = "like"   # "fts5" | "pg_trgm" | "like"
+
+_SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS quizzes_fts USING fts5(
+        question, answer, content='quizzes', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS quizzes_fts_ai AFTER INSERT ON quizzes BEGIN
+        INSERT INTO quizzes_fts(rowid, question, answer) VALUES (new.id, new.question, new.answer);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS quizzes_fts_ad AFTER DELETE ON quizzes BEGIN
+        INSERT INTO quizzes_fts(quizzes_fts, rowid, question, answer) VALUES ('delete', old.id, old.question, old.answer);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS quizzes_fts_au AFTER UPDATE OF question, answer ON quizzes BEGIN
+        INSERT INTO quizzes_fts(quizzes_fts, rowid, question, answer) VALUES ('delete', old.id, old.question, old.answer);
+        INSERT INTO quizzes_fts(rowid, question, answer) VALUES (new.id, new.question, new.answer);
+    END""",
+]
+
+_PG_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_quizzes_question_trgm ON quizzes USING gin (question gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_quizzes_answer_trgm ON quizzes USING gin (answer gin_trgm_ops)",
+]
+
+
+def setup(engine: Engine) -> str:
+    """検索インデックスを用意して使うバックエンド名を返す（何度呼んでもよい）"""
+    global backend
+    dialect = engine.dialect.name
+    try:
+        if dialect == "sqlite":
+            with engine.begin() as conn:
+                existed = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name='quizzes_fts'"
+                )).first() is not None
+                for ddl in _SQLITE_DDL:
+                    conn.execute(text(ddl))
+                if not existed:
+                    # 既存のクイズを取り込む
+                    conn.execute(text("INSERT INTO quizzes_fts(quizzes_fts) VALUES ('rebuild')"))
+            backend = "fts5"
+        elif dialect == "postgresql":
+            with engine.begin() as conn:
+                for ddl in _PG_DDL:
+                    conn.execute(text(ddl))
+            backend = "pg_trgm"
+        else:
+            backend = "like"
+    except Exception as e:
+        # FTS5 / trigram 非対応の SQLite、拡張を作る権限がない Postgres など
+        log.warning(f"[Search] full-text index unavailable ({e}); falling back to ILIKE")
+        backend = "like"
+    return backend
+
+
+def terms(q: str) -> List[str]:
+    return [t for t in re.split(r"[\s　]+", q.strip()) if t]
+
+
+def _fts_query(ts: List[str]) -> str:
+    # 各語をフレーズとして AND（FTS5 の演算子や記号をそのまま解釈させない）
+    return " AND ".join('"' + t.replace('"', '""') + '"' for t in ts)
+
+
+def _use_index(ts: List[str]) -> bool:
+    return backend != "like" and bool(ts) and all(len(t) >= MIN_TRIGRAM for t in ts)
+
+
+# ---- 短い語用の quiz_grams ----
+def grams(*texts: Optional[str]) -> set:
+    """文字 1-gram と 2-gram（小文字化）。1〜2文字の語はどれかと完全に一致する"""
+    out = set()
+    for t in texts:
+        t = (t or "").lower()
+        out.update(t)
+        out.update(t[i:i + 2] for i in range(len(t) - 1))
+    return out
+
+
+def index_quizzes(db: Session, rows: Iterable[Tuple[int, int, str, str]]) -> None:
+    """(user_id, quiz_id, question, answer) の gram を足す（コミットは呼び出し側）"""
+    values = [{"user_id": uid, "gram": g, "quiz_id": qid} for uid, qid, question, answer in rows for g in grams(question, answer)]
+    for i in range(0, len(values), GRAM_CHUNK * 10):
+        db.execute(insert(models.QuizGram), values[i:i + GRAM_CHUNK * 10])
+
+
+def forget_quiz(db: Session, quiz: models.Quiz) -> None:
+    g = models.QuizGram
+    gs = sorted(grams(quiz.question, quiz.answer))
+    for i in range(0, len(gs), GRAM_CHUNK):   # 主キーで消す（quiz_id だけの索引は持たない）
+        db.execute(delete(g).where(g.user_id == quiz.user_id, g.quiz_id == quiz.id, g.gram.in_(gs[i:i + GRAM_CHUNK])))
+
+
+def rebuild_grams(db: Session) -> int:
+    """quiz_grams を作り直す（マイグレーション・直接 INSERT したデータの取り込み用）。クイズ数を返す"""
+    qz = models.Quiz
+    db.execute(delete(models.QuizGram))
+    n, batch = 0, []
+    for row in db.execute(select(qz.user_id, qz.id, qz.question, qz.answer).execution_options(yield_per=GRAM_CHUNK)):
+        batch.append(tuple(row))
+        if len(batch) >= GRAM_CHUNK:
+            index_quizzes(db, batch); n += len(batch); batch = []
+    index_quizzes(db, batch)
+    db.commit()
+    return n + len(batch)
+
+
+def _gram_quiz_ids(user_id: Optional[int], term: str):
+    g = models.QuizGram
+    return select(g.quiz_id).where(g.user_id == user_id, g.gram == term.lower())
+
+
+def match_condition(q: str, user_id: Optional[int]):
+    """quizzes に対する WHERE 条件（一覧の q 絞り込み用）"""
+    qz = models.Quiz
+    ts = terms(q) or [q]
+    short = [t for t in ts if len(t) < MIN_TRIGRAM]
+    conds = [qz.id.in_(_gram_quiz_ids(user_id, t)) for t in short]
+    if backend == "fts5" and len(short) < len(ts):
+        sub = select(literal_column("rowid")).select_from(text("quizzes_fts")).where(
+            text("quizzes_fts MATCH :fts_q").bindparams(fts_q=_fts_query([t for t in ts if len(t) >= MIN_TRIGRAM]))
+        )
+        conds.append(qz.id.in_(sub))
+        recheck = short            # MATCH は正確なので長い語は確かめ直さない
+    else:
+        recheck = ts               # pg_trgm では長い語の ILIKE が GIN を使う
+    for t in recheck:
+        like = f"%{t}%"
+        conds.append(qz.question.ilike(like) | qz.answer.ilike(like))
+    return and_(*conds)
+
+
+def highlight(s: Optional[str], ts: List[str]) -> str:
+    """Python 側のハイライト（pg_trgm / ILIKE 用）"""
+    s = s or ""
+    if not ts:
+        return html.escape(s)
+    pat = re.compile("|".join(re.escape(t) for t in sorted(ts, key=len, reverse=True)), re.IGNORECASE)
+    out, pos = [], 0
+    for m in pat.finditer(s):
+        out.append(html.escape(s[pos:m.start()]))
+        out.append("<mark>" + html.escape(m.group(0)) + "</mark>")
+        pos = m.end()
+    out.append(html.escape(s[pos:]))
+    return "".join(out)
+
+
+def _marks_to_html(s: Optional[str]) -> str:
+    return html.escape(s or "").replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>")
+
+
+def search_quizzes(db: Session, user: models.User, q: str, offset: int = 0, limit: int = 50) -> List[dict]:
+    ts = terms(q)
+    if not ts:
+        return []
+    qz = models.Quiz
+    rows: List[Tuple] = []
+    if backend == "fts5" and _use_index(ts):
+        rows = db.execute(
+            text(
+                "SELECT q.id, q.question, q.answer, q.created_at, bm25(quizzes_fts) AS rank, "
+                "highlight(quizzes_fts, 0, :o, :c) AS hq, highlight(quizzes_fts, 1, :o, :c) AS ha "
+                "FROM quizzes_fts JOIN quizzes q ON q.id = quizzes_fts.rowid "
+                "WHERE quizzes_fts MATCH :m AND q.user_id = :uid "
+                "ORDER BY rank LIMIT :limit OFFSET :offset"
+            ).columns(id=Integer, question=String, answer=String, created_at=DateTime, rank=Float, hq=String, ha=String),
+            {"o": _OPEN, "c": _CLOSE, "m": _fts_query(ts), "uid": user.id, "limit": limit, "offset": offset},
+        ).all()
+        return [{
+            "id": r.id, "question": r.question, "answer": r.answer,
+            "created_at": r.created_at,
+            "score": -float(r.rank),   # bm25 は小さいほど良いので符号を反転
+            "question_highlight": _marks_to_html(r.hq),
+            "answer_highlight": _marks_to_html(r.ha),
+        } for r in rows]
+
+    stmt = select(qz.id, qz.question, qz.answer, qz.created_at).where(qz.user_id == user.id, match_condition(q, user.id))
+    if backend == "pg_trgm":
+        score = func.greatest(func.similarity(qz.question, q), func.similarity(qz.answer, q))
+        stmt = stmt.add_columns(score.label("score")).order_by(desc("score"), desc(qz.created_at))
+    else:
+        stmt = stmt.order_by(desc(qz.created_at))
+    rows = db.execute(stmt.offset(offset).limit(limit)).all()
+    return [{
+        "id": r.id, "question": r.question, "answer": r.answer, "created_at": r.created_at,
+        "score": float(getattr(r, "score", 0.0) or 0.0),
+        "question_highlight": highlight(r.question, ts),
+        "answer_highlight": highlight(r.answer, ts),
+    } for r in rows]
+
@@ -0,0 +1,129 @@
+"""index.html と静的ファイル（テキスト系）の事前圧縮版をメモリに持つ
+
+初回のリクエストでファイルを読み、gzip（レベル 9）と brotli（品質 11、入っていれば）で一度だけ圧縮して
+おく。以降は Accept-Encoding に合う版をそのまま返すので、リクエストごとの圧縮もディスク読みも無い。
+
+- ETag は内容の sha256 から作る強い ETag。符号化ごとに別の値（"<hash>" / "<hash>-gzip" / "<hash>-br"）
+- If-None-Match がどれかと一致すれば 304
+- 毎回 stat して mtime・サイズが変わっていれば読み直す（デプロイで差し替えても再起動は要らない）
+- 画像など圧縮の効かない型と、大きすぎるファイルは従来どおり FileResponse
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Dict, Iterable, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+from ..config import settings
+from . import compression
+
+INDEX_CACHE_CONTROL = "no-cache"
+STATIC_CACHE_CONTROL = "public, no-cache"   # ファイル名にハッシュが無いので毎回 ETag で確認させる
+
+
+class Asset:
+    __slots__ = ("stamp", "media_type", "bodies", "etags", "last_modified", "nbytes")
+
+    def __init__(self, path: str, st: os.stat_result):
+        with open(path, "rb") as f:
+            raw = f.read()
+        self.stamp: Tuple[int, int] = (st.st_mtime_ns, st.st_size)
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.bodies: Dict[str, bytes] = {"identity": raw}
+        for enc in compression.available():
+            data = compression.encode(raw, enc)
+            if len(data) < len(raw):   # 小さくならないものは持たない
+                self.bodies[enc] = data
+        digest = hashlib.sha256(raw).hexdigest()[:20]
+        self.etags = {enc: f'"{digest}"' if enc == "identity" else f'"{digest}-{enc}"' for enc in self.bodies}
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.nbytes = sum(len(b) for b in self.bodies.values())
+
+
+def _matches(if_none_match: Optional[str], tags: Iterable[str]) -> bool:
+    if not if_none_match:
+        return False
+    tags = set(tags)
+    # If-None-Match は弱い比較（W/ を外して比べる）
+    return any(t.strip() == "*" or t.strip().removeprefix("W/") in tags for t in if_none_match.split(","))
+
+
+class AssetCache:
+    def __init__(self, max_bytes: int = settings.STATIC_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, Asset]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, path: str, st: Optional[os.stat_result] = None) -> Optional[Asset]:
+        """キャッシュしない（できない）ファイルなら None"""
+        if self.max_bytes <= 0:
+            return None
+        try:
+            st = st or os.stat(path)
+        except OSError:
+            return None
+        key = os.path.abspath(path)
+        with self._lock:
+            asset = self._data.get(key)
+            if asset is not None and asset.stamp == (st.st_mtime_ns, st.st_size):
+                self._data.move_to_end(key)
+                return asset
+        if st.st_size > self.max_bytes // 4:
+            return None
+        try:
+            asset = Asset(path, st)   # 圧縮はロックの外で（同時に読み直しても同じ内容になるだけ）
+        except OSError:
+            return None
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._data[key] = asset
+            self._bytes += asset.nbytes
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return asset
+
+    def response(self, path: str, request_headers: Headers, cache_control: str,
+                 st: Optional[os.stat_result] = None) -> Optional[Response]:
+        asset = self.get(path, st)
+        if asset is None:
+            return None
+        offered = [e for e in compression.available() if e in asset.bodies]
+        enc = compression.negotiate(request_headers.get("accept-encoding"), offered) or "identity"
+        headers = {
+            "ETag": asset.etags[enc], "Last-Modified": asset.last_modified,
+            "Cache-Control": cache_control, "Vary": "Accept-Encoding",
+        }
+        if _matches(request_headers.get("if-none-match"), asset.etags.values()):
+            return Response(status_code=304, headers=headers)
+        if enc != "identity":
+            headers["Content-Encoding"] = enc
+        return Response(asset.bodies[enc], media_type=asset.media_type, headers=headers)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+
+assets = AssetCache()
+
+
+class CachedStaticFiles(StaticFiles):
+    """テキスト系のファイルだけ assets から返す StaticFiles"""
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        if status_code == 200 and compression.is_compressible(mimetypes.guess_type(str(full_path))[0]):
+            response = assets.response(str(full_path), Headers(scope=scope), STATIC_CACHE_CONTROL, st=stat_result)
+            if response is not None:
+                return response
+        return super().file_response(full_path, stat_result, scope, status_code)
@@ -0,0 +1,270 @@
+"""回答統計の集計テーブル（user_stats / quiz_stats）
+
+crud の create_quiz / log_answer / delete_quiz_owned が同じトランザクション内で
+bump_* を呼んで差分を足し込む。/stats/* はここを主キーで読むだけなので履歴の量に依存しない。
+quiz_stats は直近の回答（last_answered_at / last_correct）も持ち、クイズ一覧のステータスと
+絞り込みはこれを主キーで引く。
+
+ずれた場合の確認・作り直し:
+
+    python -m app.services.stats verify
+    python -m app.services.stats rebuild
+"""
+import argparse
+import sys
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, func, case, delete, update, insert, or_, desc, literal, union_all
+from sqlalchemy.orm import Session
+
+from .. import models
+from . import response_cache
+
+COUNTER_COLS = ("attempts", "correct_attempts", "attempts_image", "correct_image")
+LATEST_COLS = ("last_answered_at", "last_correct")   # quiz_stats のみ
+
+
+def answer_deltas(correct: bool, image_shown: bool, n: int = 1) -> dict:
+    return {
+        "attempts": n,
+        "correct_attempts": n if correct else 0,
+        "attempts_image": n if image_shown else 0,
+        "correct_image": n if (correct and image_shown) else 0,
+    }
+
+
+def _latest_values(table, latest: Optional[Tuple[datetime, bool]]) -> dict:
+    """(answered_at, correct) が保存済みの直近以降なら last_* を置き換える式（同時刻は後から来た方）"""
+    if latest is None:
+        return {}
+    at, correct = latest
+    newer = or_(table.c.last_answered_at.is_(None), table.c.last_answered_at <= at)
+    return {
+        "last_answered_at": case((newer, at), else_=table.c.last_answered_at),
+        "last_correct": case((newer, correct), else_=table.c.last_correct),
+    }
+
+
+def _upsert_increment(db: Session, model, keys: dict, deltas: dict,
+                      latest: Optional[Tuple[datetime, bool]] = None) -> None:
+    """keys の行に deltas を足す。行がなければ deltas で作る。latest は quiz_stats の直近の回答"""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    table = model.__table__
+    initial = {"last_answered_at": latest[0], "last_correct": latest[1]} if latest is not None else {}
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table).values({**keys, **{c: 0 for c in _counter_cols(model)}, **deltas, **initial})
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns.keys()),
+            set_={**{k: table.c[k] + v for k, v in deltas.items()}, **_latest_values(table, latest)},
+        )
+        db.execute(stmt)
+        return
+    pk = [table.c[k] == v for k, v in keys.items()]
+    res = db.execute(update(table).where(*pk).values(
+        {**{k: table.c[k] + v for k, v in deltas.items()}, **_latest_values(table, latest)}
+    ))
+    if not res.rowcount:
+        db.execute(insert(table).values({**keys, **{c: 0 for c in _counter_cols(model)}, **deltas, **initial}))
+
+
+def _counter_cols(model) -> Tuple[str, ...]:
+    return ("total_quizzes",) + COUNTER_COLS if model is models.UserStats else COUNTER_COLS
+
+
+def bump_user(db: Session, user_id: int, **deltas) -> None:
+    _upsert_increment(db, models.UserStats, {"user_id": user_id}, deltas)
+
+
+def bump_quiz(db: Session, quiz_id: int, user_id: int, latest: Optional[Tuple[datetime, bool]] = None, **deltas) -> None:
+    """latest=(answered_at, correct) を渡すと、それが直近なら last_answered_at / last_correct も更新する"""
+    _upsert_increment(db, models.QuizStats, {"quiz_id": quiz_id, "user_id": user_id}, deltas, latest)
+
+
+def record_answer(db: Session, user_id: int, quiz_id: int, correct: bool, image_shown: bool, at: datetime) -> None:
+    d = answer_deltas(correct, image_shown)
+    bump_user(db, user_id, **d)
+    bump_quiz(db, quiz_id, user_id, latest=(at, correct), **d)
+
+
+def forget_quiz(db: Session, quiz_id: int, user_id: int) -> None:
+    """クイズ削除時：そのクイズ分の回答を user_stats から引いて quiz_stats 行を消す"""
+    qs = db.get(models.QuizStats, quiz_id)
+    deltas = {"total_quizzes": -1}
+    if qs is not None:
+        deltas.update({c: -(getattr(qs, c) or 0) for c in COUNTER_COLS})
+        db.execute(delete(models.QuizStats).where(models.QuizStats.quiz_id == quiz_id))
+    bump_user(db, user_id, **deltas)
+
+
+# ---- 読み出し ----
+def ratio(num: int, den: int) -> float:
+    return float(num) / den if den else 0.0
+
+
+def get_user_stats(db: Session, user_id: Optional[int]) -> Optional[models.UserStats]:
+    if user_id is None:
+        return None
+    return db.get(models.UserStats, user_id)
+
+
+def get_quiz_stats(db: Session, quiz_id: int, user_id: Optional[int]) -> Optional[models.QuizStats]:
+    qs = db.get(models.QuizStats, quiz_id)
+    return qs if qs is not None and qs.user_id == user_id else None
+
+
+def list_quiz_stats(db: Session, user_id: Optional[int], offset: int = 0, limit: int = 200) -> List[Tuple[models.QuizStats, str]]:
+    return list(db.execute(
+        select(models.QuizStats, models.Quiz.question)
+        .join(models.Quiz, models.Quiz.id == models.QuizStats.quiz_id)
+        .where(models.QuizStats.user_id == user_id)
+        .order_by(models.QuizStats.quiz_id)
+        .offset(offset).limit(limit)
+    ).all())
+
+
+# ---- 作り直し / 検証 ----
+def _answer_aggregates(db: Session, group_cols):
+    al = models.AnswerLog
+    img = func.coalesce(al.image_shown, False)
+    return db.execute(
+        select(
+            *group_cols,
+            func.count(al.id),
+            func.sum(case((al.is_correct == True, 1), else_=0)),  # noqa: E712
+            func.sum(case((img == True, 1), else_=0)),  # noqa: E712
+            func.sum(case(((al.is_correct == True) & (img == True), 1), else_=0)),  # noqa: E712
+        ).group_by(*group_cols)
+    ).all()
+
+
+def _rollup_aggregates(db: Session, group_cols):
+    """answer_rollups（畳んだ古い回答）の分。列の並びは _answer_aggregates と同じ"""
+    ar = models.AnswerRollup
+    return db.execute(
+        select(
+            *group_cols,
+            func.sum(ar.attempts),
+            func.sum(ar.correct_attempts),
+            func.sum(case((ar.image_shown == True, ar.attempts), else_=0)),  # noqa: E712
+            func.sum(case((ar.image_shown == True, ar.correct_attempts), else_=0)),  # noqa: E712
+        ).group_by(*group_cols)
+    ).all()
+
+
+def _latest_answers(db: Session, include_rollups: bool = True):
+    """quiz_id ごとの直近の (answered_at, is_correct)。並びは answered_at、同時刻は id の大きい方"""
+    al, ar = models.AnswerLog, models.AnswerRollup
+    parts = [select(al.quiz_id.label("quiz_id"), al.answered_at.label("answered_at"),
+                    al.id.label("id"), al.is_correct.label("is_correct"))]
+    if include_rollups:
+        parts.append(select(ar.quiz_id, ar.last_answered_at, literal(0), ar.last_correct))
+    ev = (union_all(*parts) if len(parts) > 1 else parts[0]).subquery("answers")
+    ranked = select(
+        ev.c.quiz_id, ev.c.answered_at, ev.c.is_correct,
+        func.row_number().over(partition_by=ev.c.quiz_id, order_by=(desc(ev.c.answered_at), desc(ev.c.id))).label("rn"),
+    ).subquery("ranked")
+    return db.execute(select(ranked.c.quiz_id, ranked.c.answered_at, ranked.c.is_correct).where(ranked.c.rn == 1)).all()
+
+
+def compute_expected(db: Session, include_rollups: bool = True) -> Tuple[Dict[int, dict], Dict[int, dict]]:
+    al, ar = models.AnswerLog, models.AnswerRollup
+    users: Dict[int, dict] = {}
+    for uid, n in db.execute(select(models.Quiz.user_id, func.count(models.Quiz.id)).group_by(models.Quiz.user_id)):
+        users.setdefault(uid, {"total_quizzes": 0, **{c: 0 for c in COUNTER_COLS}})["total_quizzes"] = int(n)
+    quizzes: Dict[int, dict] = {}
+    sources = [(_answer_aggregates(db, (al.user_id,)), _answer_aggregates(db, (al.quiz_id, al.user_id)))]
+    if include_rollups:
+        sources.append((_rollup_aggregates(db, (ar.user_id,)), _rollup_aggregates(db, (ar.quiz_id, ar.user_id))))
+    for rows_u, rows_q in sources:
+        for uid, *vals in rows_u:
+            row = users.setdefault(uid, {"total_quizzes": 0, **{c: 0 for c in COUNTER_COLS}})
+            for c, v in zip(COUNTER_COLS, vals):
+                row[c] += int(v or 0)
+        for qid, uid, *vals in rows_q:
+            row = quizzes.setdefault(qid, {"user_id": uid, **{c: 0 for c in COUNTER_COLS}, **dict.fromkeys(LATEST_COLS)})
+            for c, v in zip(COUNTER_COLS, vals):
+                row[c] += int(v or 0)
+    for qid, at, correct in _latest_answers(db, include_rollups):
+        if qid in quizzes:
+            quizzes[qid].update(last_answered_at=at, last_correct=bool(correct))
+    return users, quizzes
+
+
+def rebuild(db: Session, include_rollups: bool = True) -> Tuple[int, int]:
+    users, quizzes = compute_expected(db, include_rollups)
+    db.execute(delete(models.QuizStats))
+    db.execute(delete(models.UserStats))
+    if users:
+        db.execute(insert(models.UserStats), [{"user_id": uid, **v} for uid, v in users.items()])
+    if quizzes:
+        db.execute(insert(models.QuizStats), [{"quiz_id": qid, **v} for qid, v in quizzes.items()])
+    db.commit()
+    return len(users), len(quizzes)
+
+
+def verify(db: Session) -> List[str]:
+    users, quizzes = compute_expected(db)
+    diffs = []
+    actual_u = {r.user_id: r for r in db.execute(select(models.UserStats)).scalars()}
+    for uid in set(users) | set(actual_u):
+        exp = users.get(uid) or {"total_quizzes": 0, **{c: 0 for c in COUNTER_COLS}}
+        act = actual_u.get(uid)
+        for c in ("total_quizzes",) + COUNTER_COLS:
+            a = getattr(act, c) if act is not None else 0
+            if a != exp[c]:
+                diffs.append(f"user {uid} {c}: stored={a} expected={exp[c]}")
+    actual_q = {r.quiz_id: r for r in db.execute(select(models.QuizStats)).scalars()}
+    for qid in set(quizzes) | set(actual_q):
+        exp = quizzes.get(qid) or {c: 0 for c in COUNTER_COLS}
+        act = actual_q.get(qid)
+        for c in COUNTER_COLS + LATEST_COLS:
+            a = getattr(act, c, None) if act is not None else (0 if c in COUNTER_COLS else None)
+            if a != exp.get(c):
+                diffs.append(f"quiz {qid} {c}: stored={a} expected={exp[c]}")
+    return diffs
+
+
+def ensure_initialized(db: Session) -> bool:
+    """集計テーブル導入前のDBなら一度だけ作り直す（起動時に呼ぶ）"""
+    has_stats = db.execute(select(models.UserStats.user_id).limit(1)).first() is not None
+    has_data = db.execute(select(models.Quiz.id).limit(1)).first() is not None
+    if has_stats or not has_data:
+        return False
+    rebuild(db, include_rollups=False)   # マイグレーション 3 の時点では answer_rollups はまだ無い（中身も空）
+    return True
+
+
+def main(argv=None) -> int:
+    from ..database import SessionLocal, Base, engine
+
+    ap = argparse.ArgumentParser(prog="python -m app.services.stats", description="user_stats / quiz_stats の検証・再構築")
+    ap.add_argument("command", choices=["verify", "rebuild"])
+    args = ap.parse_args(argv)
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if args.command == "rebuild":
+            nu, nq = rebuild(db)
+            response_cache.bump_all(db)   # 値が直ったユーザーの ETag を無効にする
+            db.commit()
+            print(f"rebuilt user_stats={nu} quiz_stats={nq}")
+            return 0
+        diffs = verify(db)
+        for d in diffs:
+            print(d)
+        print("OK" if not diffs else f"{len(diffs)} mismatch(es)")
+        return 0 if not diffs else 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,420 @@
+"""画像ファイルの置き場所と掃除
+
+- 配置: {IMAGE_DIR}/cas/{h[0:2]}/{h[2:4]}/{h}.png（h は内容の sha256）。1ディレクトリに
+  数十万ファイルが溜まらないよう2段にシャードする。派生画像は従来どおり元ファイルの隣
+- 移行: 旧配置（cas/{h}.png や quiz_{id}_{ts}.png）を参照している行を見つけ、ファイルを
+  新しい場所にリンク（できなければコピー）→ 参照を書き換え → 誰も参照しなくなった旧ファイルを消す。
+  稼働中に実行してよい
+- 掃除: IMAGE_DIR を os.scandir で歩き、batch 件ずつ generated_images / image_cache /
+  image_variants と突き合わせて、どこからも参照されないファイルを消す。書き込み直後のファイルを
+  消さないよう、更新から STORAGE_GC_GRACE 秒以内のものは残す
+- 容量: STORAGE_QUOTA_BYTES を超えたら未参照のキャッシュを LRU 順に追い出し、それでも超えて
+  いれば新規生成を StorageQuotaExceeded で断る（使用量は直近の走査結果 + その後の書き込み分）
+
+    python -m app.services.storage migrate [--dry-run]
+    python -m app.services.storage gc [--dry-run]
+    python -m app.services.storage usage
+
+STORAGE_GC_INTERVAL を設定すると、サーバー内でも migrate → gc を定期的に回す
+（複数ワーカーでもロックファイルで1つだけが動く）。
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..database import SessionLocal
+from .image_cache import ImageCache, content_path, write_atomic, remove_with_variants, _chunks
+from .image_variants import variant_path
+
+log = logging.getLogger("uvicorn")
+
+STATE_FILE = ".storage.json"
+LOCK_FILE = ".gc.lock"
+_HEX64 = re.compile(r"^[0-9a-f]{64}$")
+
+
+class StorageQuotaExceeded(Exception):
+    """画像の保存領域が STORAGE_QUOTA_BYTES を超えている"""
+
+
+# ---- 配置 ----
+def sharded_like(output_dir: Optional[str] = None) -> str:
+    """シャード配置のパスに一致する LIKE パターン"""
+    return f"{(output_dir or settings.IMAGE_DIR).rstrip('/')}/cas/__/__/%"
+
+
+def place(tmp_path: str, content_hash: str, size: int, output_dir: Optional[str] = None) -> str:
+    """書き終えた一時ファイルを内容ハッシュの場所へ置いて rel path を返す。同じ内容が既にあればそれを使う"""
+    rel_path = content_path(content_hash, output_dir)
+    abs_path = os.path.abspath(rel_path)
+    if os.path.exists(abs_path):
+        _discard(tmp_path)
+        touch(abs_path)
+    else:
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        os.replace(tmp_path, abs_path)
+        usage.add(size)
+    return rel_path
+
+
+def touch(path: str) -> None:
+    """掃除の猶予を取り直す（未参照のまま残っていたファイルを再利用するとき）"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def release(db: Session, file_paths: Iterable[str]) -> int:
+    """参照が無くなったファイル（キャッシュ中のものは除く）を派生画像ごと消す。消した件数を返す"""
+    paths = [p for p in dict.fromkeys(file_paths) if p]
+    if not paths:
+        return 0
+    n = 0
+    for p in ImageCache(db).releasable(paths):
+        if remove_with_variants(p):
+            n += 1
+    return n
+
+
+# ---- 使用量と容量制限 ----
+class Usage:
+    """直近の走査結果（STATE_FILE）に、このプロセスがその後書いた分を足した見積もり"""
+
+    RELOAD = 60.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scanned_bytes = 0
+        self._scanned_at = 0.0
+        self._added = 0
+        self._loaded_at = 0.0
+
+    def _state_path(self) -> str:
+        return os.path.join(settings.IMAGE_DIR, STATE_FILE)
+
+    def _reload(self) -> None:
+        now = time.monotonic()
+        if now - self._loaded_at < self.RELOAD:
+            return
+        self._loaded_at = now
+        try:
+            with open(self._state_path(), "r", encoding="utf-8") as f:
+                st = json.load(f)
+        except (OSError, ValueError):
+            return
+        if st.get("scanned_at", 0) > self._scanned_at:
+            self._scanned_bytes, self._scanned_at, self._added = int(st.get("bytes", 0)), st["scanned_at"], 0
+
+    def bytes(self) -> int:
+        with self._lock:
+            self._reload()
+            return self._scanned_bytes + self._added
+
+    def add(self, n: int) -> None:
+        with self._lock:
+            self._added += n
+
+    def save(self, total_bytes: int, files: int) -> None:
+        st = {"bytes": total_bytes, "files": files, "scanned_at": time.time(), "quota": settings.STORAGE_QUOTA_BYTES}
+        write_atomic(os.path.abspath(self._state_path()), json.dumps(st).encode("utf-8"))
+        with self._lock:
+            self._scanned_bytes, self._scanned_at, self._added, self._loaded_at = total_bytes, st["scanned_at"], 0, time.monotonic()
+
+
+usage = Usage()
+
+
+def check_quota() -> None:
+    quota = settings.STORAGE_QUOTA_BYTES
+    used = usage.bytes() if quota > 0 else 0
+    if quota > 0 and used >= quota:
+        raise StorageQuotaExceeded(f"image storage is over quota ({used} >= {quota} bytes)")
+
+
+# ---- 走査 ----
+def iter_files(root: str) -> Iterator[Tuple[str, int, float]]:
+    """root 以下の通常ファイルを (rel path, size, mtime) で順に返す（一覧を丸ごと持たない）"""
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except FileNotFoundError:
+            continue
+        with it:
+            for e in it:
+                if e.name.startswith("."):
+                    continue
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif e.is_file(follow_symlinks=False):
+                    st = e.stat(follow_symlinks=False)
+                    yield e.path.replace("\\", "/"), st.st_size, st.st_mtime
+
+
+def referenced(db: Session, paths: List[str]) -> Set[str]:
+    refs: Set[str] = set()
+    for col in (models.GeneratedImage.file_path, models.ImageCacheEntry.file_path, models.ImageVariant.file_path):
+        refs.update(db.execute(select(col).where(col.in_(paths)).distinct()).scalars())
+    return refs
+
+
+def _check_root(db: Session, root: str) -> None:
+    """IMAGE_DIR を書き換えた直後などに、全ファイルを未参照と見なして消してしまわないための確認"""
+    gi = models.GeneratedImage
+    prefix = root.replace("\\", "/").rstrip("/") + "/"
+    any_row = db.execute(select(gi.file_path).limit(1)).scalar_one_or_none()
+    if any_row is None:
+        return
+    under = db.execute(select(gi.id).where(gi.file_path.startswith(prefix, autoescape=True)).limit(1)).first()
+    if under is None:
+        raise RuntimeError(f"no generated_images.file_path is under IMAGE_DIR={root!r} (e.g. {any_row!r}); refusing to gc")
+
+
+def gc(db: Session, dry_run: bool = False, grace: float = None, batch: int = 1000) -> dict:
+    """どこからも参照されないファイルを消し、容量制限を超えていれば未参照のキャッシュを追い出す"""
+    root = settings.IMAGE_DIR
+    _check_root(db, root)
+    cutoff = time.time() - (settings.STORAGE_GC_GRACE if grace is None else grace)
+    out = {"files": 0, "bytes": 0, "orphans": 0, "orphan_bytes": 0, "deleted": 0, "evicted": 0}
+    for chunk in _chunks(iter_files(root), batch):
+        refs = referenced(db, [p for p, _, _ in chunk])
+        db.rollback()   # 読み取りトランザクションを閉じる（SQLite の書き込みを塞がない）
+        for path, size, mtime in chunk:
+            out["files"] += 1
+            out["bytes"] += size
+            if path in refs or mtime > cutoff:
+                continue
+            out["orphans"] += 1
+            out["orphan_bytes"] += size
+            if dry_run:
+                continue
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue   # 走査後に place() が再利用した
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning(f"[Storage] failed to delete orphan {path}: {e}")
+                continue
+            out["deleted"] += 1
+            out["files"] -= 1
+            out["bytes"] -= size
+
+    quota = settings.STORAGE_QUOTA_BYTES
+    if quota > 0 and out["bytes"] > quota and not dry_run:
+        # 参照中の画像は消せないので、減らせるのは未参照のキャッシュ分だけ
+        cache = ImageCache(db)
+        before = cache.total_bytes()
+        cache.max_bytes = max(0, before - (out["bytes"] - quota))
+        out["evicted"] = cache.evict()
+        out["bytes"] -= before - cache.total_bytes()
+        if out["bytes"] > quota:
+            log.warning(f"[Storage] over quota after gc: {out['bytes']} > {quota} bytes; new images are refused")
+    if not dry_run:
+        usage.save(out["bytes"], out["files"])
+    return out
+
+
+# ---- 旧配置からの移行 ----
+def _file_hash(path: str) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if _HEX64.match(stem):
+        return stem   # cas/{h}.png はファイル名が内容ハッシュ
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _link(src: str, dst: str) -> None:
+    if os.path.exists(dst):
+        touch(dst)
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    touch(dst)   # ハードリンクは元の mtime を引き継ぐので、参照を書き換えるまで掃除されないようにする
+
+
+def migrate_file(db: Session, old: str) -> Optional[str]:
+    """old を参照している行をシャード配置に移す。移した先を返す（ファイルが無ければ None）"""
+    if not os.path.exists(old):
+        log.warning(f"[Storage] cannot migrate missing file {old}")
+        return None
+    new = content_path(_file_hash(old))
+    if new == old:
+        return new
+    _link(old, new)
+    gi, iv = models.GeneratedImage, models.ImageVariant
+    image_ids = select(gi.id).where(gi.file_path == old).scalar_subquery()
+    for v in db.execute(select(iv).where(iv.image_id.in_(image_ids))).scalars():
+        nv = variant_path(new, v.width, v.format)
+        if v.file_path == nv:
+            continue
+        if os.path.exists(v.file_path):
+            _link(v.file_path, nv)
+            v.file_path = nv
+        else:
+            db.delete(v)   # 派生画像は作り直せるので、ファイルの無い行は捨てる
+    db.execute(update(gi).where(gi.file_path == old).values(file_path=new).execution_options(synchronize_session=False))
+    ce = models.ImageCacheEntry
+    db.execute(update(ce).where(ce.file_path == old).values(file_path=new).execution_options(synchronize_session=False))
+    db.commit()
+    release(db, [old])
+    return new
+
+
+def legacy_paths(db: Session, batch: int = 200, after: str = "") -> List[str]:
+    """シャード配置でないファイルを指す file_path（重複なし、文字列順に after より後）"""
+    like = sharded_like()
+    found: Set[str] = set()
+    for col in (models.GeneratedImage.file_path, models.ImageCacheEntry.file_path):
+        found.update(db.execute(
+            select(col).where(~col.like(like), col > after).distinct().order_by(col).limit(batch)
+        ).scalars())
+    return sorted(found)[:batch]
+
+
+def migrate_layout(db: Session, batch: int = 200, dry_run: bool = False) -> dict:
+    out = {"paths": 0, "migrated": 0, "missing": 0}
+    after = ""
+    while True:
+        paths = legacy_paths(db, batch, after)
+        if not paths:
+            break
+        after = paths[-1]
+        for p in paths:
+            out["paths"] += 1
+            if dry_run:
+                continue
+            if migrate_file(db, p) is None:
+                out["missing"] += 1
+            else:
+                out["migrated"] += 1
+    return out
+
+
+# ---- 定期実行 ----
+@contextmanager
+def _exclusive(root: str):
+    """同じ IMAGE_DIR で同時に1つだけ走らせる（取れなければ False）"""
+    os.makedirs(root, exist_ok=True)
+    f = open(os.path.join(root, LOCK_FILE), "a+")
+    try:
+        try:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except ImportError:
+            pass   # Windows ではロックなし
+        except OSError:
+            yield False
+            return
+        yield True
+    finally:
+        f.close()
+
+
+class Reconciler:
+    def __init__(self, interval: float = settings.STORAGE_GC_INTERVAL, session_factory: Callable[[], Session] = SessionLocal):
+        self.interval = interval
+        self.session_factory = session_factory
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="storage-gc", daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("[Storage] reconcile failed")
+
+    def run_once(self) -> Optional[dict]:
+        with _exclusive(settings.IMAGE_DIR) as got:
+            if not got:
+                return None
+            db = self.session_factory()
+            try:
+                moved = migrate_layout(db)
+                out = {**gc(db), "migrated": moved["migrated"]}
+            finally:
+                db.close()
+        log.info(f"[Storage] files={out['files']} bytes={out['bytes']} deleted={out['deleted']} "
+                 f"evicted={out['evicted']} migrated={out['migrated']}")
+        return out
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._thread = None
+
+
+reconciler = Reconciler()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.services.storage", description="画像ファイルの移行・掃除")
+    ap.add_argument("command", choices=["migrate", "gc", "usage"])
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--batch", type=int, default=None)
+    args = ap.parse_args(argv)
+    if args.command == "usage":
+        quota = settings.STORAGE_QUOTA_BYTES
+        print(f"{usage.bytes()} bytes" + (f" / quota {quota}" if quota else ""))
+        return 0
+    with _exclusive(settings.IMAGE_DIR) as got:
+        if not got:
+            print("another gc / migrate is running", file=sys.stderr)
+            return 1
+        db = SessionLocal()
+        try:
+            if args.command == "migrate":
+                r = migrate_layout(db, batch=args.batch or 200, dry_run=args.dry_run)
+                done = f"would migrate {r['paths']}" if args.dry_run else f"migrated {r['migrated']}"
+                print(f"{done} file(s)" + (f", {r['missing']} missing" if r["missing"] else ""))
+            else:
+                r = gc(db, dry_run=args.dry_run, batch=args.batch or 1000)
+                deleted = "" if args.dry_run else f", deleted {r['deleted']}, evicted {r['evicted']}"
+                print(f"scanned {r['files'] + r['deleted']} file(s); orphans {r['orphans']} ({r['orphan_bytes']} bytes)"
+                      f"{deleted}; usage {r['bytes']} bytes")
+        finally:
+            db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
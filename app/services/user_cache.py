@@ -0,0 +1,204 @@
+"""X-Token → user_id の解決キャッシュと、使われなかったユーザーの掃除
+
+- トークンとユーザーIDの対応は変わらないので、プロセス内の TTL 付き LRU に載せる
+- ユーザー行は書き込み（クイズ作成など）が必要になった時点で作る（routes 側）
+- DB で引いたとき（キャッシュを外れたとき）に users.last_seen_at を更新する（LAST_SEEN_RESOLUTION 単位）
+- 何も作らず、last_seen_at から older-than 日使われていないユーザーは cleanup で消す:
+
+    python -m app.services.user_cache cleanup --older-than-days 7
+
+USER_CLEANUP_INTERVAL を設定すると、サーバー内でも定期的に掃除する（消した id はそのプロセスの
+キャッシュからも消える）。他のプロセスのキャッシュにあるのは TOKEN_CACHE_TTL 以内に DB で引いた
+＝last_seen_at が新しいユーザーだけなので掃除の対象にならない。それでも書き込み用の依存
+（routes.get_write_user / get_or_create_current_user）はキャッシュの (id, token) を DB と照合する。
+users は AUTOINCREMENT なので、消したユーザーの id が別のユーザーに使い回されることも無い。
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from sqlalchemy import select, delete, exists, func, update
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+
+log = logging.getLogger("uvicorn")
+
+LAST_SEEN_RESOLUTION = timedelta(hours=1)
+
+
+class TokenCache:
+    def __init__(self, maxsize: int = settings.TOKEN_CACHE_SIZE, ttl: float = settings.TOKEN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # token -> (user_id, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[int]:
+        with self._lock:
+            hit = self._data.get(token)
+            if hit is None:
+                return None
+            uid, exp = hit
+            if exp < time.monotonic():
+                del self._data[token]
+                return None
+            self._data.move_to_end(token)
+            return uid
+
+    def put(self, token: str, user_id: int) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[token] = (user_id, time.monotonic() + self.ttl)
+            self._data.move_to_end(token)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, token: Optional[str] = None, user_ids: Optional[set] = None) -> None:
+        with self._lock:
+            if token is not None:
+                self._data.pop(token, None)
+            if user_ids:
+                for t in [t for t, (uid, _) in self._data.items() if uid in user_ids]:
+                    del self._data[t]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+token_cache = TokenCache()
+
+
+def user_lookup_stmt(token: str):
+    return select(models.User.id, models.User.last_seen_at).where(models.User.token == token)
+
+
+def touch_stmt(user_id: int, now: datetime):
+    return update(models.User).where(models.User.id == user_id).values(last_seen_at=now)
+
+
+def needs_touch(last_seen_at: Optional[datetime], now: datetime) -> bool:
+    return last_seen_at is None or now - last_seen_at >= LAST_SEEN_RESOLUTION
+
+
+def resolve_user_id(db: Session, token: str) -> Optional[int]:
+    uid = token_cache.get(token)
+    if uid is not None:
+        return uid
+    row = db.execute(user_lookup_stmt(token)).first()
+    if row is None:
+        return None
+    now = datetime.utcnow()
+    if needs_touch(row.last_seen_at, now):
+        db.execute(touch_stmt(row.id, now))
+        db.commit()
+    token_cache.put(token, row.id)
+    return row.id
+
+
+def user_matches(db: Session, user_id: int, token: str) -> bool:
+    """キャッシュから取った id がまだそのトークンのユーザーか"""
+    u = models.User
+    return db.execute(select(u.id).where(u.id == user_id, u.token == token)).first() is not None
+
+
+def find_unused_user_ids(db: Session, older_than: timedelta, limit: int) -> List[int]:
+    u = models.User
+    cutoff = datetime.utcnow() - older_than
+    return list(db.execute(
+        select(u.id)
+        .where(
+            func.coalesce(u.last_seen_at, u.created_at) < cutoff,
+            ~exists().where(models.Quiz.user_id == u.id),
+            ~exists().where(models.AnswerLog.user_id == u.id),
+        )
+        .order_by(u.id)
+        .limit(limit)
+    ).scalars())
+
+
+def cleanup_unused_users(db: Session, older_than: timedelta = timedelta(days=7), batch: int = 1000) -> int:
+    """クイズも回答もなく、older_than 以上使われていないユーザーを batch 件ずつ削除"""
+    removed = 0
+    while True:
+        ids = find_unused_user_ids(db, older_than, batch)
+        if not ids:
+            break
+        db.execute(delete(models.UserStats).where(models.UserStats.user_id.in_(ids)))
+        db.execute(delete(models.User).where(models.User.id.in_(ids)))
+        db.commit()
+        token_cache.invalidate(user_ids=set(ids))
+        removed += len(ids)
+        if len(ids) < batch:
+            break
+    return removed
+
+
+# ---- 定期実行 ----
+class UserCleaner:
+    def __init__(self, interval: float = settings.USER_CLEANUP_INTERVAL, older_than_days: float = settings.USER_CLEANUP_DAYS,
+                 session_factory: Optional[Callable[[], Session]] = None):
+        self.interval = interval
+        self.older_than = timedelta(days=older_than_days)
+        self.session_factory = session_factory
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="user-cleanup", daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        from ..database import SessionLocal
+
+        factory = self.session_factory or SessionLocal
+        while not self._stop.wait(self.interval):
+            db = factory()
+            try:
+                n = cleanup_unused_users(db, self.older_than)
+                if n:
+                    log.info(f"[Users] removed {n} unused user(s)")
+            except Exception:
+                db.rollback()
+                log.exception("[Users] cleanup failed")
+            finally:
+                db.close()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._thread = None
+
+
+user_cleaner = UserCleaner()
+
+
+def main(argv=None) -> int:
+    from ..database import SessionLocal
+
+    ap = argparse.ArgumentParser(prog="python -m app.services.user_cache", description="未使用ユーザーの削除")
+    ap.add_argument("command", choices=["cleanup"])
+    ap.add_argument("--older-than-days", type=float, default=7)
+    ap.add_argument("--batch", type=int, default=1000)
+    args = ap.parse_args(argv)
+    db = SessionLocal()
+    try:
+        n = cleanup_unused_users(db, timedelta(days=args.older_than_days), args.batch)
+        print(f"removed {n} unused user(s)")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""書き込み専用スレッドによるグループコミット（SQLite 高負荷モード用）
+
+SQLite は同時に1つしか書き込めないので、回答記録（まとめ送信を含む）・クイズの作成とインポート・画像登録の書き込みを
+1本のスレッドに集め、数ミリ秒分（最大 WRITE_BATCH_MAX 件）をまとめて1回でコミットする。
+読み取りは従来どおりリクエストごとのセッション（プールの別接続）で並列に行う。
+
+    rec = writer.run(fn, *args)   # fn(db, *args) を書き込みスレッドで実行し、コミット後に結果を返す
+
+async のルートからは asyncio.wrap_future(writer.submit(...)) で待つ（run はスレッドを止める）。
+fn はコミットしないこと（flush まで）。戻り値の ORM オブジェクトはコミット後に
+セッションから切り離して返すので、呼び出し側では読み込み済みの属性だけを使う。
+バッチ中のどれかが失敗したら全体を巻き戻し、残りを1件ずつ実行し直して失敗を切り分ける。
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, sessionmaker
+
+from ..config import settings
+from ..database import engine
+
+log = logging.getLogger("uvicorn")
+
+_STOP = object()
+
+
+class WriteQueue:
+    def __init__(
+        self,
+        session_factory: Optional[Callable[..., Session]] = None,
+        max_batch: int = settings.WRITE_BATCH_MAX,
+        max_delay: float = settings.WRITE_BATCH_DELAY_MS / 1000.0,
+    ):
+        # コミット後も読み込み済みの属性を使えるよう expire しないセッションを使う
+        self.session_factory = session_factory or sessionmaker(autoflush=False, expire_on_commit=False)
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self._q: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    # ---- lifecycle ----
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+        self._thread.start()
+        log.info(f"[Writer] started (batch<={self.max_batch}, delay={self.max_delay * 1000:.0f}ms)")
+
+    def shutdown(self, timeout: float = 5.0):
+        t, self._thread = self._thread, None
+        if t is None:
+            return
+        self._q.put(_STOP)
+        t.join(timeout)
+        # 停止後に積まれたものは待たせたままにしない
+        while True:
+            try:
+                item = self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                item[2].set_exception(RuntimeError("writer stopped"))
+
+    # ---- 呼び出し側 ----
+    def submit(self, fn: Callable, *args) -> Future:
+        fut: Future = Future()
+        self._q.put((fn, args, fut))
+        return fut
+
+    def run(self, fn: Callable, *args):
+        return self.submit(fn, *args).result()
+
+    # ---- 書き込みスレッド ----
+    def _collect(self) -> Tuple[List[tuple], bool]:
+        first = self._q.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._q.get(timeout=remaining) if remaining > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _loop(self):
+        # 接続は起動時に1本確保して持ち続ける。リクエスト側が接続を握ったまま
+        # 書き込み完了を待つので、毎回プールから借りると取り合いで詰まる
+        conn = engine.connect()
+        db = self.session_factory(bind=conn)
+        try:
+            while True:
+                batch, stop = self._collect()
+                if batch:
+                    self._commit_batch(db, batch)
+                if stop:
+                    break
+        finally:
+            db.close()
+            conn.close()
+
+    def _commit_batch(self, db: Session, batch: List[tuple]) -> None:
+        results = []
+        try:
+            for fn, args, _ in batch:
+                results.append(fn(db, *args))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            db.expunge_all()
+            if len(batch) == 1:
+                batch[0][2].set_exception(e)
+                return
+            # どれが失敗したか分からないので1件ずつやり直す
+            for item in batch:
+                self._commit_batch(db, [item])
+            return
+        db.expunge_all()
+        for (_, _, fut), res in zip(batch, results):
+            fut.set_result(res)
+
+
+writer = WriteQueue()
+
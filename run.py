@@ -1,13 +1,25 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 from sqlalchemy import text
 from sqlalchemy.engine.url import make_url
 
-from app.database import Base, engine
+from app.database import engine, async_engine, SQLITE_PERF
+from app import migrations
 from app.config import settings
 from app.routes import router as quiz_router
+from app import async_routes
+from app.services.image_jobs import image_jobs
+from app.services.a1111_client import close_clients
+from app.services.image_variants import variant_builder
+from app.services.pregenerate import pregenerator
+from app.services.storage import reconciler
+from app.services.compaction import compactor
+from app.services.user_cache import user_cleaner
+from app.services import search, metrics
+from app.services.compression import CompressionMiddleware
+from app.services.static_cache import assets, CachedStaticFiles, INDEX_CACHE_CONTROL
+from app.services.write_queue import writer
 import os, logging
 
 log = logging.getLogger("uvicorn")
@@ -15,24 +27,40 @@ log = logging.getLogger("uvicorn")
 def create_app() -> FastAPI:
     app = FastAPI(title="Quiz Image Experiment App", version="1.0.0")
 
+    # JSON・テキストの gzip / brotli（一番内側。計測のレイテンシには圧縮時間も入る）
+    if settings.RESPONSE_COMPRESSION:
+        app.add_middleware(CompressionMiddleware)
+
+    # 計測：ルートごとのレイテンシと、リクエスト中に発行された SQL の数
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine)
+    if async_engine is not None:
+        metrics.instrument_engine(async_engine.sync_engine)
+
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"], allow_credentials=True,
         allow_methods=["*"], allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "X-Token-Issued"],
     )
 
-    app.include_router(quiz_router)
+    # DB_ASYNC=1 なら主要ルートを AsyncSession 版に差し替える
+    app.include_router(async_routes.override(quiz_router) if settings.DB_ASYNC else quiz_router)
     os.makedirs(settings.IMAGE_DIR, exist_ok=True)
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+    # テキスト系は事前圧縮版をメモリから返す（services/static_cache.py）
+    app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
     @app.get("/", include_in_schema=False)
-    def root_page():
-        return FileResponse("index.html")
+    def root_page(request: Request):
+        return assets.response("index.html", request.headers, INDEX_CACHE_CONTROL) or FileResponse("index.html")
 
     # 起動時：DB接続確認
     @app.on_event("startup")
     def _db_ping():
-        Base.metadata.create_all(bind=engine)
+        # スキーマは app/migrations.py で管理（未適用分だけ当てる）
+        for name in migrations.migrate(engine):
+            log.info(f"[DB] migration applied: {name}")
+        log.info(f"[Search] backend={search.setup(engine)}")
         try:
             with engine.connect() as conn:
                 dialect = conn.dialect.name  # 'sqlite', 'postgresql', etc.
@@ -43,6 +71,52 @@ def create_app() -> FastAPI:
         except Exception as e:
             log.error(f"[DB] Connection failed: {e}")
 
+    # SQLite 高負荷モード：小さな書き込みを1本のスレッドでまとめてコミット
+    @app.on_event("startup")
+    def _start_writer():
+        if SQLITE_PERF:
+            writer.start()
+
+    # 画像生成ワーカー：未完了ジョブを再投入して起動
+    @app.on_event("startup")
+    def _start_image_jobs():
+        image_jobs.start()
+
+    # 画像ファイルの定期掃除（STORAGE_GC_INTERVAL=0 なら何もしない）
+    @app.on_event("startup")
+    def _start_storage_gc():
+        reconciler.start()
+
+    # 古い回答の日次集計・アーカイブ（ANSWER_ARCHIVE_DAYS=0 なら何もしない）
+    @app.on_event("startup")
+    def _start_answer_compaction():
+        compactor.start()
+
+    # 未使用ユーザーの掃除（USER_CLEANUP_INTERVAL=0 なら何もしない）
+    @app.on_event("startup")
+    def _start_user_cleanup():
+        user_cleaner.start()
+
+    @app.on_event("shutdown")
+    def _stop_image_jobs():
+        image_jobs.shutdown(wait=False)
+        pregenerator.shutdown()
+        reconciler.shutdown()
+        compactor.shutdown()
+        user_cleaner.shutdown()
+        close_clients()
+        variant_builder.shutdown(wait=False)
+        writer.shutdown()
+
+    @app.on_event("shutdown")
+    async def _dispose_async_engine():
+        if async_engine is not None:
+            await async_engine.dispose()
+
+    @app.get("/metrics", include_in_schema=False)
+    def prometheus_metrics():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
     @app.get("/_debug/db", tags=["debug"])
     def debug_db():
         u = make_url(settings.DATABASE_URL)
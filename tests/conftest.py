@@ -0,0 +1,64 @@
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+# 設定は import 時に読まれるので、app を import する前に一時 DB・作業ディレクトリ・A1111 のスタブへ向ける
+# （quiz.db と static/images を触らない）
+WORK = tempfile.mkdtemp(prefix="quiz-test-")
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(WORK, "test.db"))
+os.environ["IMAGE_DIR"] = "static/images"
+os.environ.setdefault("ADMIN_TOKEN", "test-admin")
+os.chdir(WORK)
+shutil.copy(os.path.join(ROOT, "index.html"), WORK)
+
+from fake_a1111 import start_in_thread  # noqa: E402
+
+FAKE_A1111 = start_in_thread()
+os.environ.setdefault("A1111_BASE_URL", f"http://127.0.0.1:{FAKE_A1111.server_port}")
+
+
+@pytest.fixture(scope="session")
+def client():
+    """アプリ全体（起動時にマイグレーション済み）。テストごとに別トークンを使って分ける"""
+    from fastapi.testclient import TestClient
+    import run
+
+    with TestClient(run.app) as c:
+        yield c
+
+
+@pytest.fixture
+def headers():
+    return {"X-Token": f"test-{uuid.uuid4().hex}"}
+
+
+@pytest.fixture
+def admin():
+    return {"X-Admin-Token": os.environ["ADMIN_TOKEN"]}
+
+
+@pytest.fixture
+def db(client):
+    from app.database import SessionLocal
+
+    s = SessionLocal()
+    yield s
+    s.close()
+
+
+def create_quizzes(client, headers, n, prefix="q"):
+    return [client.post("/quiz/create", json={"question": f"{prefix} {i}", "answer": f"a{i}"}, headers=headers).json()["id"]
+            for i in range(n)]
+
+
+def user_id(db, headers) -> int:
+    from app import models
+    return db.query(models.User.id).filter(models.User.token == headers["X-Token"]).scalar()
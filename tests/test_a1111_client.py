@@ -0,0 +1,42 @@
+import pytest
+from fake_a1111 import start_in_thread
+
+from app.services.a1111_client import A1111Client, A1111Unavailable, CircuitBreaker
+
+
+@pytest.fixture
+def failing_server():
+    server = start_in_thread(fail_rate=1.0)
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_breaker_opens_and_probes_once(failing_server):
+    breaker = CircuitBreaker(threshold=2, reset_after=0)
+    c = A1111Client(failing_server, retries=0, breaker=breaker)
+    for _ in range(2):
+        with pytest.raises(A1111Unavailable):
+            c.txt2img({"prompt": "x"})
+    assert breaker.state == "half-open"
+    assert breaker.allow() and not breaker.allow()   # 様子見は1本だけ
+    breaker.release_probe()
+    assert breaker.allow()
+
+
+def test_success_closes_breaker():
+    ok = start_in_thread()
+    try:
+        breaker = CircuitBreaker(threshold=1, reset_after=0)
+        breaker.record_failure()
+        c = A1111Client(f"http://127.0.0.1:{ok.server_port}", breaker=breaker)
+        assert "images" in c.txt2img({"prompt": "x", "width": 8, "height": 8})
+        assert breaker.state == "closed"
+    finally:
+        ok.shutdown()
+
+
+def test_zero_concurrency_is_treated_as_one(failing_server):
+    c = A1111Client(failing_server, max_concurrency=0, retries=0, queue_timeout=0.1)
+    assert c.max_concurrency == 1
+    with pytest.raises(A1111Unavailable, match="returned 500"):   # セマフォ 0 で「busy」にならず、実際に投げて失敗する
+        c.txt2img({"prompt": "x"})
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+from app import crud, models, schemas
+from app.database import SessionLocal
+
+from conftest import create_quizzes, user_id
+
+
+def _batch(client, headers, items):
+    r = client.post("/quiz/answers/batch", json={"items": items}, headers=headers)
+    assert r.status_code == 200, r.text
+    return [(x["index"], x["status"], x["correct"]) for x in r.json()["results"]]
+
+
+def test_statuses_and_idempotency(client, headers, db):
+    a, b = create_quizzes(client, headers, 2)
+    foreign = create_quizzes(client, {"X-Token": headers["X-Token"] + "-other"}, 1)[0]
+    items = [
+        {"quiz_id": a, "answer": "a0", "image_shown": False, "idempotency_key": "k1"},
+        {"quiz_id": b, "answer": "x", "image_shown": True},
+        {"quiz_id": foreign, "answer": "a0", "image_shown": False},
+        {"quiz_id": a, "answer": "x", "image_shown": False, "idempotency_key": "k1"},   # 同じバッチ内の再送
+    ]
+    assert _batch(client, headers, items) == [(0, "ok", True), (1, "ok", False), (2, "not_found", None), (3, "duplicate", True)]
+    # 再送: キー付きは duplicate、キーなしはもう一度記録される
+    assert _batch(client, headers, items[:2]) == [(0, "duplicate", True), (1, "ok", False)]
+    assert db.query(models.AnswerLog).filter(models.AnswerLog.user_id == user_id(db, headers)).count() == 3
+
+
+def test_client_time_is_kept_but_never_in_the_future(client, headers, db):
+    qid = create_quizzes(client, headers, 1)[0]
+    past = datetime.utcnow() - timedelta(days=2)
+    _batch(client, headers, [
+        {"quiz_id": qid, "answer": "a0", "image_shown": False, "client_ts": past.isoformat() + "Z"},
+        {"quiz_id": qid, "answer": "a0", "image_shown": False, "client_ts": (datetime.utcnow() + timedelta(days=1)).isoformat()},
+    ])
+    times = sorted(t for (t,) in db.query(models.AnswerLog.answered_at).filter(models.AnswerLog.quiz_id == qid))
+    assert times[0] == past
+    assert times[1] <= datetime.utcnow()
+
+
+def test_batch_size_is_limited(client, headers):
+    qid = create_quizzes(client, headers, 1)[0]
+    items = [{"quiz_id": qid, "answer": "a0", "image_shown": False}] * 1001
+    assert client.post("/quiz/answers/batch", json={"items": items}, headers=headers).status_code == 422
+
+
+def test_concurrent_resend_becomes_duplicate(client, headers, db, monkeypatch):
+    qid = create_quizzes(client, headers, 1)[0]
+    user = db.get(models.User, user_id(db, headers))
+    item = schemas.AnswerBatchItem(quiz_id=qid, answer="a0", image_shown=False, idempotency_key="race")
+    real = crud._insert_answers_batch
+
+    def racing(s, uid, new_logs):
+        # 読み取り（キー確認）のあと、こちらが書く前に同じキーの再送が先にコミットされる
+        monkeypatch.setattr(crud, "_insert_answers_batch", real)
+        other = SessionLocal()
+        try:
+            crud.log_answers_batch(other, other.get(models.User, uid), [item])
+        finally:
+            other.close()
+        return real(s, uid, new_logs)
+
+    monkeypatch.setattr(crud, "_insert_answers_batch", racing)
+    assert [(r["status"], r["correct"]) for r in crud.log_answers_batch(db, user, [item])] == [("duplicate", True)]
+    assert db.query(models.AnswerLog).filter(models.AnswerLog.quiz_id == qid).count() == 1
@@ -0,0 +1,37 @@
+import asyncio
+import os
+import threading
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app import async_crud, crud, models
+from app.database import async_url
+from app.services import storage
+
+from conftest import create_quizzes, user_id
+
+
+def test_delete_releases_files_off_the_event_loop(client, headers, db, monkeypatch):
+    qid = create_quizzes(client, headers, 1)[0]
+    path = "static/images/async_delete_test.png"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"png")
+    crud.add_image(db, db.get(models.Quiz, qid), path, None)
+
+    threads = []
+    real = storage.remove_with_variants
+    monkeypatch.setattr(storage, "remove_with_variants", lambda p: threads.append(threading.current_thread()) or real(p))
+    user = models.User(id=user_id(db, headers), token=headers["X-Token"])
+
+    async def run():
+        engine = create_async_engine(async_url(os.environ["DATABASE_URL"]))
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as s:
+                return await async_crud.delete_quiz_owned(s, qid, user), await async_crud.delete_quiz_owned(s, qid, user)
+        finally:
+            await engine.dispose()
+
+    assert asyncio.run(run()) == (True, False)
+    assert not os.path.exists(path)
+    assert threads and threading.main_thread() not in threads   # ループ（メインスレッド）では消さない
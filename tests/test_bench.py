@@ -0,0 +1,85 @@
+import base64
+import io
+import json
+import os
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+from PIL import Image
+
+import bench
+from fake_a1111 import make_png, start_in_thread
+
+from conftest import ROOT
+
+BENCH = os.path.join(ROOT, "tools", "bench.py")
+
+
+def _post(url, payload):
+    req = urllib.request.Request(url, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=10) as r:
+        return json.load(r)
+
+
+def test_fake_a1111_returns_png_and_counts_calls():
+    server = start_in_thread()
+    try:
+        data = _post(f"http://127.0.0.1:{server.server_port}/sdapi/v1/txt2img", {"prompt": "p", "width": 8, "height": 4})
+        assert server.RequestHandlerClass.calls == 1
+    finally:
+        server.shutdown()
+    with Image.open(io.BytesIO(base64.b64decode(data["images"][0]))) as im:
+        assert im.size == (8, 4)
+    assert make_png(2, 2, seed=1) == make_png(2, 2, seed=1) != make_png(2, 2, seed=2)
+
+
+def test_fake_a1111_fail_rate():
+    server = start_in_thread(fail_rate=1.0)
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            _post(f"http://127.0.0.1:{server.server_port}/sdapi/v1/txt2img", {})
+        assert e.value.code == 500
+    finally:
+        server.shutdown()
+
+
+def test_percentile_and_compare():
+    vals = sorted(float(i) for i in range(1, 101))
+    assert (bench.percentile(vals, 50), bench.percentile(vals, 95), bench.percentile([], 95)) == (50.0, 95.0, 0.0)
+
+    base = {"endpoints": {"a": {"p95_ms": 10.0, "rps": 100.0, "errors": 0}, "gone": {"p95_ms": 1, "rps": 1, "errors": 0}}}
+    ok = {"endpoints": {"a": {"p95_ms": 12.0, "rps": 80.0, "errors": 0}}}
+    bad = {"endpoints": {"a": {"p95_ms": 13.0, "rps": 70.0, "errors": 1}}}
+    assert bench.compare(base, ok, 0.25) == []
+    assert bench.compare(base, bad, 0.25) == ["a: p95 10.0ms -> 13.0ms", "a: rps 100.0 -> 70.0", "a: errors 0 -> 1"]
+
+
+def test_seed_run_and_compare_cli(tmp_path):
+    db = f"sqlite:///{tmp_path / 'bench.db'}"
+    env = {k: v for k, v in os.environ.items() if k != "DATABASE_URL"}
+
+    def cli(*args):
+        return subprocess.run([sys.executable, BENCH, *args], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=300)
+
+    seeded = cli("seed", "--db", db, "--scale", "1k")
+    assert seeded.returncode == 0, seeded.stderr
+    assert json.loads(seeded.stdout)["quizzes"] == 200
+
+    out = str(tmp_path / "run.json")
+    run = cli("run", "--db", db, "-n", "20", "-c", "4", "--warmup", "2",
+              "--endpoints", "quiz_list,quiz_search,answer,stats_summary", "--save", out)
+    assert run.returncode == 0, run.stderr
+    with open(out, encoding="utf-8") as f:
+        result = json.load(f)
+    assert set(result["endpoints"]) == {"quiz_list", "quiz_search", "answer", "stats_summary"}
+    assert all(e["errors"] == 0 for e in result["endpoints"].values())
+
+    assert cli("compare", out, out).returncode == 0
+    worse = json.loads(json.dumps(result))
+    worse["endpoints"]["quiz_list"]["errors"] = 5
+    with open(tmp_path / "worse.json", "w", encoding="utf-8") as f:
+        json.dump(worse, f)
+    assert cli("compare", out, str(tmp_path / "worse.json")).returncode == 1
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, func, select, update
+
+from app import models
+from app.database import Base
+from app.migrations import has_autoincrement, rebuild_with_autoincrement
+from app.services import compaction
+
+from conftest import create_quizzes, user_id
+
+
+def _legacy_engine(tmp_path):
+    """AUTOINCREMENT の無い answer_logs（マイグレーション 10 より前の DB）"""
+    eng = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.create_all(eng)
+    with eng.begin() as conn:
+        ddl = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name='answer_logs'").scalar()
+        conn.exec_driver_sql("DROP TABLE answer_logs")
+        conn.exec_driver_sql(ddl.replace(" AUTOINCREMENT", ""))
+        conn.exec_driver_sql("INSERT INTO answer_logs (id, user_id, quiz_id, is_correct, answered_at) "
+                             "VALUES (1, 1, 1, 1, '2024-01-01 00:00:00'), (2, 1, 1, 0, '2024-01-02 00:00:00')")
+    return eng
+
+
+def test_rebuild_with_autoincrement_keeps_rows_and_indexes(tmp_path):
+    eng = _legacy_engine(tmp_path)
+    with eng.connect() as conn:
+        assert not has_autoincrement(conn, "answer_logs")
+    assert rebuild_with_autoincrement(eng, models.AnswerLog)
+    assert not rebuild_with_autoincrement(eng, models.AnswerLog)   # 2回目は何もしない
+    with eng.connect() as conn:
+        assert has_autoincrement(conn, "answer_logs")
+        assert conn.exec_driver_sql("SELECT id, is_correct FROM answer_logs ORDER BY id").all() == [(1, 1), (2, 0)]
+        names = {r[0] for r in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='answer_logs'")}
+    assert "ix_answer_logs_user_quiz_answered" in names
+
+
+def test_compact_refuses_table_without_autoincrement(tmp_path):
+    eng = _legacy_engine(tmp_path)
+    from sqlalchemy.orm import Session
+    with Session(eng) as s:
+        with pytest.raises(RuntimeError):
+            compaction.compact(s, days=1)
+
+
+def test_compact_keeps_list_and_verifies(client, headers, db):
+    ids = create_quizzes(client, headers, 3)
+    for qid, answer in [(ids[0], "a0"), (ids[0], "x"), (ids[1], "a1"), (ids[2], "x")]:
+        client.post(f"/quiz/{qid}/answer", json={"answer": answer, "image_shown": False}, headers=headers)
+    uid = user_id(db, headers)
+    old = datetime.utcnow() - timedelta(days=100)
+    db.execute(update(models.AnswerLog).where(models.AnswerLog.user_id == uid).values(answered_at=old))
+    db.commit()
+    before = client.get("/quiz/list", headers=headers).json()
+    summary = client.get("/stats/summary", headers=headers).json()
+
+    out = compaction.compact(db, days=30)
+    assert out["archived"] >= 4
+    al, arc = models.AnswerLog, models.AnswerLogArchive
+    assert db.scalar(select(func.count()).select_from(al).where(al.user_id == uid)) == 0
+    assert db.scalar(select(func.count()).select_from(arc).where(arc.user_id == uid)) == 4
+    assert compaction.verify(db) == []
+
+    after = client.get("/quiz/list", headers=headers).json()
+    assert [(q["id"], q["attempts"], q["last_correct"]) for q in after] == \
+           [(q["id"], q["attempts"], q["last_correct"]) for q in before]
+    assert client.get("/stats/summary", headers=headers).json() == summary
@@ -0,0 +1,121 @@
+import asyncio
+import gzip
+import os
+import zlib
+
+import pytest
+
+from app import crud, schemas
+from app.services import compression, response_cache
+from app.services.compression import CompressionMiddleware, negotiate
+from app.services.response_cache import serialize
+from app.services.static_cache import AssetCache
+
+from conftest import create_quizzes
+
+
+def test_orjson_fast_path_matches_pydantic(client, headers, db):
+    pytest.importorskip("orjson")
+    qid = create_quizzes(client, headers, 3, prefix="日本語 \"q\"")[0]
+    client.post(f"/quiz/{qid}/answer", json={"answer": "a0", "image_shown": False}, headers=headers)
+    user = crud.get_user_by_token(db, headers["X-Token"])
+    items, _ = crud.list_quizzes_page(db, user, None, "newest", 0, 10, "all")
+    for adapter, data in ((schemas.QuizWithStatusList, items),
+                          (schemas.StatsSummaryAdapter, crud.get_stats_summary(db, user=user)),
+                          (schemas.QuizStatsList, crud.get_quiz_stats(db, user=user))):
+        assert serialize(adapter, data, trusted=True) == adapter.dump_json(adapter.validate_python(data))
+
+
+def test_orjson_falls_back_on_values_it_cannot_write(monkeypatch):
+    pytest.importorskip("orjson")
+    row = {"id": 2 ** 70, "question": "q", "answer": "a", "user_id": 1, "created_at": "2025-01-01T00:00:00",
+           "attempts": 0, "last_correct": None}
+    assert b'"id":%d' % 2 ** 70 in serialize(schemas.QuizWithStatusList, [row], trusted=True)
+    monkeypatch.setattr(response_cache, "orjson", None)
+    assert serialize(schemas.QuizWithStatusList, [row], trusted=True).startswith(b'[{"id":')
+
+
+def test_negotiate():
+    assert negotiate(None, ["br", "gzip"]) is None
+    assert negotiate("gzip, br", ["br", "gzip"]) == "br"   # 同じ q なら offered の順
+    assert negotiate("br;q=0.5, gzip", ["br", "gzip"]) == "gzip"
+    assert negotiate("*;q=0.1, gzip;q=0", ["br", "gzip"]) == "br"
+    assert negotiate("identity", ["br", "gzip"]) is None
+    assert negotiate("deflate, gzip;q=bad", ["gzip"]) is None
+
+
+def test_api_response_is_gzipped_above_minimum(client, headers):
+    create_quizzes(client, headers, 30, prefix="x" * 40)
+    r = client.get("/quiz/list", headers={**headers, "Accept-Encoding": "gzip"})
+    assert r.headers["content-encoding"] == "gzip" and "Accept-Encoding" in r.headers["vary"]
+    assert r.headers["etag"].startswith('W/"') and len(r.json()) == 30
+    assert int(r.headers["content-length"]) < len(r.content)
+
+    small = client.get("/stats/summary", headers={**headers, "Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    plain = client.get("/quiz/list", headers={**headers, "Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers and plain.content == r.content
+
+
+def test_streamed_body_is_compressed_per_chunk():
+    chunks = [b'{"n":%d}\n' % i * 50 for i in range(3)]
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/x-ndjson"), (b"etag", b'"e"')]})
+        for i, c in enumerate(chunks):
+            await send({"type": "http.response.body", "body": c, "more_body": i < len(chunks) - 1})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+    asyncio.run(CompressionMiddleware(app, minimum_size=10 ** 6)(scope, None, send))
+    start, bodies = sent[0], [m["body"] for m in sent[1:]]
+    hdrs = dict(start["headers"])
+    assert hdrs[b"content-encoding"] == b"gzip" and hdrs[b"etag"] == b'W/"e"' and b"content-length" not in hdrs
+    d = zlib.decompressobj(31)
+    assert d.decompress(bodies[0]) == chunks[0]   # 途中のチャンクもすぐ展開できる
+    assert d.decompress(b"".join(bodies[1:])) == b"".join(chunks[1:])
+
+
+def test_index_is_served_precompressed_with_etag(client):
+    r = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["content-encoding"] == "gzip" and r.headers["etag"].endswith('-gzip"')
+    assert r.headers["cache-control"] == "no-cache"
+    plain = client.get("/", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers and plain.content == r.content
+    assert client.get("/", headers={"If-None-Match": plain.headers["etag"]}).status_code == 304
+    assert client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": f'W/{plain.headers["etag"]}'}).status_code == 304
+
+
+def test_static_assets_reload_when_changed(client):
+    path = os.path.join("static", "test-compression.css")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("body { color: red; }\n" * 200)
+    first = client.get("/static/test-compression.css", headers={"Accept-Encoding": "gzip"})
+    assert first.headers["content-encoding"] == "gzip" and first.headers["cache-control"] == "public, no-cache"
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("p { margin: 0; }\n")
+    second = client.get("/static/test-compression.css", headers={"Accept-Encoding": "gzip"})
+    assert second.headers["etag"] != first.headers["etag"] and second.text.endswith("p { margin: 0; }\n")
+
+
+def test_asset_cache_skips_incompressible_and_oversized(tmp_path):
+    small = tmp_path / "tiny.txt"
+    small.write_bytes(b"ab")
+    big = tmp_path / "big.txt"
+    big.write_bytes(b"a" * 100)
+    cache = AssetCache(max_bytes=200)
+    assert set(cache.get(str(small)).bodies) == {"identity"}   # 圧縮して大きくなる版は持たない
+    assert cache.get(str(big)) is None                          # max_bytes の 1/4 を超える
+    assert gzip.decompress(compression.encode(b"x" * 100, "gzip")) == b"x" * 100
+
+
+def test_brotli_is_preferred_when_installed(client):
+    brotli = pytest.importorskip("brotli")
+    r = client.get("/", headers={"Accept-Encoding": "gzip, br"})
+    assert r.headers["content-encoding"] == "br" and r.headers["etag"].endswith('-br"')
+    assert brotli.decompress(compression.encode(b"x" * 100, "br")) == b"x" * 100
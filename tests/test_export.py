@@ -0,0 +1,76 @@
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+from app.services import compaction
+
+from conftest import user_id
+
+
+def _create(client, headers, question, answer):
+    return client.post("/quiz/create", json={"question": question, "answer": answer}, headers=headers).json()["id"]
+
+
+def _batch(client, headers, items):
+    client.post("/quiz/answers/batch", json={"items": items}, headers=headers)
+
+
+def _ndjson(client, headers, **params):
+    r = client.get("/export/answers", params={"format": "ndjson", **params}, headers=headers)
+    assert r.headers["content-type"] == "application/x-ndjson"
+    return [json.loads(line) for line in r.text.splitlines()]
+
+
+def test_csv_quotes_cells_and_only_exports_own_answers(client, headers, db):
+    qid = _create(client, headers, 'comma, "quote"\nnewline', "a")
+    client.post(f"/quiz/{qid}/answer", json={"answer": "a", "image_shown": True}, headers=headers)
+    other = {"X-Token": headers["X-Token"] + "-other"}
+    oid = _create(client, other, "other", "b")
+    client.post(f"/quiz/{oid}/answer", json={"answer": "b", "image_shown": False}, headers=other)
+
+    # 一般ユーザーの user_id 指定は無視される
+    r = client.get("/export/answers", params={"user_id": user_id(db, other)}, headers=headers)
+    assert r.headers["content-disposition"] == 'attachment; filename="answer_logs.csv"'
+    assert r.content.startswith("\ufeff".encode())
+    rows = list(csv.DictReader(io.StringIO(r.content.decode("utf-8-sig"))))
+    assert [(row["quiz_id"], row["question"], row["is_correct"], row["image_shown"]) for row in rows] == [
+        (str(qid), 'comma, "quote"\nnewline', "True", "True"),
+    ]
+
+
+def test_resume_with_after_id_and_time_window(client, headers):
+    qid = _create(client, headers, "q", "a")
+    now = datetime.utcnow()
+    _batch(client, headers, [
+        {"quiz_id": qid, "answer": "a", "image_shown": False, "client_ts": (now - timedelta(hours=h)).isoformat()}
+        for h in (3, 2, 1)
+    ])
+    rows = _ndjson(client, headers)
+    assert len(rows) == 3 and [r["id"] for r in rows] == sorted(r["id"] for r in rows)
+    assert _ndjson(client, headers, after_id=rows[0]["id"]) == rows[1:]
+    window = _ndjson(client, headers, since=(now - timedelta(hours=2, minutes=30)).isoformat(),
+                     until=(now - timedelta(minutes=30)).isoformat())
+    assert [r["id"] for r in window] == [r["id"] for r in rows[1:]]
+
+
+def test_archived_answers_are_merged_in_id_order(client, headers, db):
+    qid = _create(client, headers, "old", "a")
+    old = (datetime.utcnow() - timedelta(days=400)).isoformat()
+    _batch(client, headers, [{"quiz_id": qid, "answer": "a", "image_shown": False, "client_ts": old}])
+    client.post(f"/quiz/{qid}/answer", json={"answer": "x", "image_shown": False}, headers=headers)
+    _batch(client, headers, [{"quiz_id": qid, "answer": "a", "image_shown": True, "client_ts": old}])
+    before = _ndjson(client, headers)
+
+    assert compaction.compact(db, days=365)["archived"] >= 2
+    assert _ndjson(client, headers) == before
+    assert [r["is_correct"] for r in before] == [True, False, True]
+
+
+def test_admin_can_export_another_user(client, headers, admin, db):
+    qid = _create(client, headers, "q", "a")
+    client.post(f"/quiz/{qid}/answer", json={"answer": "a", "image_shown": False}, headers=headers)
+    uid = user_id(db, headers)
+    rows = _ndjson(client, {"X-Token": headers["X-Token"] + "-admin", **admin}, user_id=uid)
+    assert [(r["user_id"], r["quiz_id"]) for r in rows] == [(uid, qid)]
+
@@ -0,0 +1,86 @@
+import pytest
+from sqlalchemy import update
+
+from app import models
+from app.services.grading import RULES_VERSION, answer_key, grade, grade_normalized, normalize, rekey_quizzes
+
+from conftest import create_quizzes
+
+
+def graded(user_answer: str, answer: str) -> bool:
+    return grade_normalized(normalize(user_answer), answer_key(answer))
+
+
+@pytest.mark.parametrize("user_answer, answer", [
+    ("-5", "5"),
+    ("5", "-5"),
+    ("1/2", "12"),
+    ("3.14", "314"),
+    ("1991年", "1990年"),
+    ("平成2年", "平成3年"),
+    ("answer1", "answer0"),
+    ("第12代将軍", "第13代将軍"),
+])
+def test_numbers_must_match_exactly(user_answer, answer):
+    assert not graded(user_answer, answer)
+
+
+@pytest.mark.parametrize("user_answer, answer", [
+    ("-5", "-5"),
+    ("－５", "-5"),
+    ("1/2", "1/2"),
+    ("3.14", "3.14"),
+    ("1990年", "1990年"),
+    ("１９９０年", "1990年"),
+    ("トウキョウ", "とうきょう"),
+    ("Tokyo", "東京|とうきょう|Tokyo"),
+    ("x-ray", "X ray"),
+    ("photosynthsis", "photosynthesis"),   # 文字だけの書き間違いは許す
+    ("ミトコンドリア 2個", "みとこんどりあ2個"),
+])
+def test_accepted(user_answer, answer):
+    assert graded(user_answer, answer)
+
+
+def test_typo_tolerance_keeps_numbers():
+    assert graded("photosynthsis 1", "photosynthesis 1")
+    assert not graded("photosynthesis 2", "photosynthesis 1")
+
+
+@pytest.mark.parametrize("user_answer, answer", [
+    ("ちゅうこく", "ちゅうごく"),
+    ("チュウゴク", "ちゅうこく"),
+    ("はし", "はじ"),
+    ("きょうと", "とうきょう"),
+])
+def test_short_kana_must_match_exactly(user_answer, answer):
+    assert not graded(user_answer, answer)
+
+
+def test_long_kana_allows_one_typo():
+    assert graded("みとこんどりあのまく", "みとこんどりあのまぐ")
+    assert not graded("みとこんどりあのまく", "みとこんどりやのまぐ")
+
+
+def test_escaped_separator_is_literal():
+    assert answer_key(r"A\|B|C") == "a|b\nc"
+    assert graded("A|B", r"A\|B|C") and graded("C", r"A\|B|C")
+    assert not graded("A", r"A\|B|C")
+
+
+def test_legacy_quiz_keeps_pipe_in_answer():
+    legacy = models.Quiz(answer="はい|いいえ", answer_alternates=False)
+    assert grade("はい|いいえ", legacy)
+    assert not grade("はい", legacy)
+    assert grade("はい", models.Quiz(answer="はい|いいえ", answer_alternates=True))
+
+
+def test_rekey_respects_alternates_flag(client, headers, db):
+    qid = create_quizzes(client, headers, 1)[0]
+    db.execute(update(models.Quiz).where(models.Quiz.id == qid)
+               .values(answer="a|b", answer_alternates=False, answer_key_version=RULES_VERSION - 1))
+    db.commit()
+    rekey_quizzes(db)
+    assert db.get(models.Quiz, qid).answer_key == "a|b"
+    r = client.post(f"/quiz/{qid}/answer", json={"answer": "a", "image_shown": False}, headers=headers)
+    assert r.json()["correct"] is False
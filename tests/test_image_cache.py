@@ -0,0 +1,69 @@
+import os
+from datetime import datetime
+from uuid import uuid4
+
+from app import models
+from app.config import settings
+from app.services.image_cache import EVICT_GRACE, ImageCache, param_key
+from app.services.image_service import ImageService
+
+from conftest import FAKE_A1111, create_quizzes
+
+
+def _generate(client, headers, qid, prompt, force=False):
+    r = client.post("/quiz/image/generate", params={"force": force}, json={"quiz_id": qid, "prompt": prompt}, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+def test_param_key_covers_every_parameter():
+    base = param_key("p", 20, 512, 512, "m")
+    assert base == param_key("p", 20, 512, 512, "m")
+    assert len({base, param_key("p2", 20, 512, 512, "m"), param_key("p", 30, 512, 512, "m"),
+                param_key("p", 20, 768, 512, "m"), param_key("p", 20, 512, 512, "m2")}) == 5
+
+
+def test_same_prompt_reuses_file(client, headers, db):
+    a, b = create_quizzes(client, headers, 2)
+    prompt = f"cache {uuid4().hex}"
+    calls = FAKE_A1111.RequestHandlerClass.calls
+    first = _generate(client, headers, a, prompt)
+    second = _generate(client, headers, b, prompt)
+    assert FAKE_A1111.RequestHandlerClass.calls == calls + 1
+    assert first["file_path"] == second["file_path"] and first["id"] != second["id"]
+    payload = ImageService().build_payload(prompt)
+    key = param_key(prompt, payload["steps"], payload["width"], payload["height"], settings.A1111_MODEL)
+    assert db.get(models.ImageCacheEntry, key).hits == 1
+
+
+def test_force_bypasses_cache_and_keeps_shared_file(client, headers):
+    a, b = create_quizzes(client, headers, 2)
+    prompt = f"force {uuid4().hex}"
+    shared = _generate(client, headers, a, prompt)["file_path"]
+    _generate(client, headers, b, prompt)
+    calls = FAKE_A1111.RequestHandlerClass.calls
+    _generate(client, headers, a, prompt, force=True)
+    assert FAKE_A1111.RequestHandlerClass.calls == calls + 1
+    assert os.path.exists(shared)   # b がまだ参照している
+
+
+def test_evict_skips_referenced_and_recent(client, headers, db, tmp_path):
+    old = datetime.utcnow() - EVICT_GRACE * 2
+    qid = create_quizzes(client, headers, 1)[0]
+    paths = {}
+    for name in ("referenced", "unused", "recent"):
+        p = str(tmp_path / f"{name}.png")
+        with open(p, "wb") as f:
+            f.write(b"x" * 100)
+        key = uuid4().hex
+        paths[name] = (key, p)
+        db.add(models.ImageCacheEntry(param_key=key, content_hash=key, file_path=p, size_bytes=100,
+                                      last_used_at=datetime.utcnow() if name == "recent" else old))
+    db.add(models.GeneratedImage(quiz_id=qid, file_path=paths["referenced"][1]))
+    db.commit()
+
+    cache = ImageCache(db, str(tmp_path), max_bytes=ImageCache(db).total_bytes() - 1)
+    assert cache.evict() == 1
+    assert db.get(models.ImageCacheEntry, paths["unused"][0]) is None and not os.path.exists(paths["unused"][1])
+    assert all(db.get(models.ImageCacheEntry, paths[n][0]) for n in ("referenced", "recent"))
+
@@ -0,0 +1,48 @@
+from uuid import uuid4
+
+from app import crud, models
+from app.services.image_jobs import image_jobs
+from app.services.image_service import ImageService
+from app.services.storage import StorageQuotaExceeded
+
+from conftest import create_quizzes, user_id
+
+
+def test_sync_generate_goes_through_job_queue(client, headers, db):
+    qid = create_quizzes(client, headers, 1)[0]
+    r = client.post("/quiz/image/generate", json={"quiz_id": qid, "prompt": "sync"}, headers=headers)
+    assert r.status_code == 200, r.text
+    assert r.json()["quiz_id"] == qid
+    jobs = db.query(models.ImageJob).filter(models.ImageJob.quiz_id == qid).all()
+    assert [(j.status, j.image_id) for j in jobs] == [("done", r.json()["id"])]
+
+
+def test_sync_generate_maps_job_failure(client, headers, db, monkeypatch):
+    class FullStorage(ImageService):
+        def generate_image_for_quiz(self, *args, **kwargs):
+            raise StorageQuotaExceeded("quota exceeded")
+
+    monkeypatch.setattr(image_jobs, "service_factory", FullStorage)
+    qid = create_quizzes(client, headers, 1)[0]
+    r = client.post("/quiz/image/generate", json={"quiz_id": qid}, headers=headers)
+    assert r.status_code == 507
+    job = db.query(models.ImageJob).filter(models.ImageJob.quiz_id == qid).one()
+    assert (job.status, job.error_kind) == ("failed", "quota")
+
+
+def test_sync_generate_unknown_quiz(client, headers):
+    create_quizzes(client, headers, 1)
+    assert client.post("/quiz/image/generate", json={"quiz_id": 10**9}, headers=headers).status_code == 404
+
+
+def test_force_is_part_of_coalescing_key(client, headers, db):
+    qid = create_quizzes(client, headers, 1)[0]
+    quiz = db.get(models.Quiz, qid)
+    # ワーカーに渡さず queued のまま置いておく
+    queued = models.ImageJob(id=uuid4().hex, quiz_id=qid, user_id=user_id(db, headers), prompt="p", force=False, status="queued")
+    db.add(queued); db.commit()
+
+    assert crud.find_inflight_image_job(db, quiz, "p", force=False).id == queued.id
+    assert crud.find_inflight_image_job(db, quiz, "p", force=True) is None
+    assert crud.find_inflight_image_job(db, quiz, None, force=False) is None
+    queued.status = "failed"; db.commit()
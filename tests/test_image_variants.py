@@ -0,0 +1,40 @@
+import os
+
+import pytest
+from PIL import Image
+
+from app.services import image_variants
+from app.services.image_variants import VariantBuilder, build_variants
+
+
+@pytest.fixture
+def png(tmp_path):
+    path = str(tmp_path / "src.png")
+    Image.new("RGB", (64, 32), "red").save(path)
+    return path
+
+
+def test_failed_encode_leaves_no_temp_file(png, tmp_path, monkeypatch):
+    def broken_save(self, fp, *args, **kwargs):
+        with open(fp, "wb") as f:
+            f.write(b"partial")
+        raise OSError("encoder crashed")
+
+    monkeypatch.setattr(Image.Image, "save", broken_save)
+    with pytest.raises(OSError, match="encoder crashed"):
+        build_variants(png, [16], ["webp"])
+    assert sorted(os.listdir(tmp_path)) == ["src.png"]
+
+
+def test_builds_in_spawned_workers(png):
+    b = VariantBuilder(workers=1)
+    b.widths, b.formats = [16, 128], ["webp"]
+    try:
+        pool = b._get_pool()
+        assert pool._mp_context.get_start_method() == "spawn"
+        variants = pool.submit(build_variants, png, b.widths, b.formats).result(timeout=60)
+    finally:
+        b.shutdown(wait=True)
+    assert [(v["width"], v["height"]) for v in variants] == [(16, 8), (64, 32)]   # 元より大きい幅は元の幅で作る
+    assert all(os.path.exists(v["file_path"]) for v in variants)
+    assert image_variants.variant_path(png, 16, "webp") == variants[0]["file_path"]
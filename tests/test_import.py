@@ -0,0 +1,57 @@
+import asyncio
+import json
+
+import pytest
+
+from app.services import quiz_import
+from app.services.quiz_import import iter_records
+
+
+def _records(data: bytes, content_type: str, chunk: int):
+    async def chunks():
+        for i in range(0, len(data), chunk):
+            yield data[i:i + chunk]
+
+    async def collect():
+        return [r async for r in iter_records(chunks(), content_type)]
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("chunk", [1, 3, 4096])
+def test_csv_quoted_multiline_cells(chunk):
+    data = 'question,answer\n"first\nline",a\n\nq2,"x ""y"""\r\n"open,b\n'.encode()
+    rows = _records(data, "text/csv", chunk)
+    assert rows[:2] == [(2, {"question": "first\nline", "answer": "a"}), (5, {"question": "q2", "answer": 'x "y"'})]
+    assert rows[2][0] == 6 and isinstance(rows[2][1], ValueError)
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 7, 4096])
+def test_json_array_is_read_per_element(chunk):
+    items = [{"question": "a", "answer": "1"}, 12, "é", [1, 2], {"question": "b", "answer": "2"}]
+    data = b"\xef\xbb\xbf " + json.dumps(items, indent=1).encode() + b" "
+    assert _records(data, "application/json", chunk) == list(enumerate(items, start=1))
+
+
+def test_json_array_stops_at_broken_separator():
+    rows = _records(b"[1, 2 3]", "application/json", 1)
+    assert rows[:2] == [(1, 1), (2, 2)] and isinstance(rows[2][1], ValueError)
+
+
+def test_json_element_size_is_capped(monkeypatch):
+    monkeypatch.setattr(quiz_import, "MAX_RECORD_CHARS", 100)
+    data = json.dumps([{"question": "q", "answer": "a"}, {"question": "x" * 500, "answer": "a"}]).encode()
+    rows = _records(data, "application/json", 16)
+    assert rows[0] == (1, {"question": "q", "answer": "a"})
+    assert rows[1][0] == 2 and "too large" in str(rows[1][1])
+
+
+def test_import_endpoint_dedupes_and_reports_rows(client, headers):
+    body = 'question,answer\n"multi\nline",a\nq2,b\nq3\n'
+    r = client.post("/quiz/import", content=body, headers={**headers, "Content-Type": "text/csv"})
+    assert r.json()["inserted"] == 2
+    assert [e["row"] for e in r.json()["errors"]] == [5]
+
+    r = client.post("/quiz/import?dedupe=true", content=body, headers={**headers, "Content-Type": "text/csv"})
+    assert (r.json()["inserted"], r.json()["skipped"]) == (0, 2)
+    questions = [q["question"] for q in client.get("/quiz/list", headers=headers).json()]
+    assert sorted(questions) == ["multi\nline", "q2"]
@@ -0,0 +1,73 @@
+import asyncio
+import re
+from uuid import uuid4
+
+from sqlalchemy import text
+
+from app.database import engine
+from app.services import metrics
+from app.services.metrics import Histogram, MetricsMiddleware
+
+from conftest import create_quizzes
+
+
+def _value(body: str, series: str) -> float:
+    m = re.search("^" + re.escape(series) + r" (\S+)$", body, re.MULTILINE)
+    return float(m.group(1)) if m else 0.0
+
+
+def test_histogram_is_cumulative_and_escapes_labels():
+    h = Histogram("t_seconds", "test", ("route",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.5, 5.0):
+        h.observe(v, 'a"b')
+    out = h.render()
+    assert 't_seconds_bucket{route="a\\"b",le="0.1"} 1\n' in out
+    assert 't_seconds_bucket{route="a\\"b",le="1.0"} 3\n' in out
+    assert 't_seconds_bucket{route="a\\"b",le="+Inf"} 4\n' in out
+    assert 't_seconds_sum{route="a\\"b"} 6.05\n' in out
+    assert 't_seconds_count{route="a\\"b"} 4\n' in out
+
+
+def test_routes_are_labelled_by_template(client, headers):
+    qid = create_quizzes(client, headers, 1)[0]
+    before = client.get("/metrics").text
+    client.post(f"/quiz/{qid}/answer", json={"answer": "a0", "image_shown": False}, headers=headers)
+    after = client.get("/metrics").text
+
+    series = 'http_requests_total{method="POST",route="/quiz/{quiz_id}/answer",status="200"}'
+    assert _value(after, series) == _value(before, series) + 1
+    db = 'db_queries_total{route="/quiz/{quiz_id}/answer"}'
+    assert _value(after, db) > _value(before, db)
+    assert f"/quiz/{qid}/answer" not in after
+    assert 'route="/metrics"' not in after
+
+
+def test_a1111_calls_are_counted(client, headers):
+    qid = create_quizzes(client, headers, 1)[0]
+    series = 'a1111_requests_total{outcome="ok"}'
+    before = _value(client.get("/metrics").text, series)
+    r = client.post("/quiz/image/generate", json={"quiz_id": qid, "prompt": f"metrics {uuid4().hex}"}, headers=headers)
+    assert r.status_code == 200
+    after = client.get("/metrics").text
+    assert _value(after, series) == before + 1
+    assert _value(after, 'a1111_request_duration_seconds_count{outcome="ok"}') >= 1
+
+
+def test_query_heavy_requests_are_flagged(caplog):
+    async def app(scope, receive, send):
+        with engine.connect() as conn:
+            for _ in range(3):
+                conn.execute(text("SELECT 1"))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def noop(message):
+        pass
+
+    route = type("Route", (), {"path": "/heavy-test"})()
+    metrics.instrument_engine(engine)
+    asyncio.run(MetricsMiddleware(app, query_warn=2)({"type": "http", "method": "GET", "route": route}, None, noop))
+    out = metrics.render()
+    assert _value(out, 'http_requests_query_heavy_total{route="/heavy-test"}') == 1
+    assert _value(out, 'db_queries_total{route="/heavy-test"}') == 3
+    assert "issued 3 queries" in caplog.text
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import crud, models
+from app.config import settings
+from app.services import pregenerate
+from app.services.pregenerate import PregenRunner
+
+from conftest import create_quizzes, user_id
+
+
+def _answer(client, headers, qid, n):
+    for _ in range(n):
+        client.post(f"/quiz/{qid}/answer", json={"answer": "x", "image_shown": False}, headers=headers)
+
+
+def _items(db, run_id):
+    it = models.PregenItem
+    return [(r.quiz_id, r.status) for r in db.query(it).filter(it.run_id == run_id).order_by(it.seq)]
+
+
+def _run(db, run_id, **kw):
+    assert pregenerate.claim(db, run_id) is not None
+    return PregenRunner(run_id, rate_per_min=0, **kw).run()
+
+
+def test_items_are_ordered_and_skip_quizzes_with_images(client, headers, db):
+    a, b, c = create_quizzes(client, headers, 3)
+    _answer(client, headers, b, 2)
+    _answer(client, headers, c, 1)
+    crud.add_image(db, db.get(models.Quiz, c), "static/images/pregen-existing.png", None)
+    uid = user_id(db, headers)
+
+    run = pregenerate.create_run(db, order="most_answered", user_id=uid)
+    assert _items(db, run.id) == [(b, "pending"), (a, "pending")]
+    newest = pregenerate.create_run(db, order="newest", user_id=uid, limit=1)
+    assert _items(db, newest.id) == [(b, "pending")]
+
+
+def test_run_generates_and_resumes(client, headers, db, monkeypatch):
+    a, b, c = create_quizzes(client, headers, 3)
+    run = pregenerate.create_run(db, order="newest", user_id=user_id(db, headers))
+
+    # 1件処理したところで止める
+    real = PregenRunner._one
+
+    def one_then_stop(self, seq, quiz_id):
+        self.stop()
+        return real(self, seq, quiz_id)
+
+    monkeypatch.setattr(PregenRunner, "_one", one_then_stop)
+    out = _run(db, run.id)
+    assert (out["status"], out["done"], out["pending"]) == ("paused", 1, 2)
+    monkeypatch.setattr(PregenRunner, "_one", real)
+
+    # 止めている間に画面から生成された／削除されたものは skipped
+    crud.add_image(db, db.get(models.Quiz, b), "static/images/pregen-manual.png", None)
+    client.delete(f"/quiz/{a}", headers=headers)
+    out = _run(db, run.id)
+    assert (out["status"], out["done"], out["skipped"], out["pending"]) == ("done", 1, 2, 0)
+    assert crud.get_latest_image_by_quiz(db, db.get(models.Quiz, c)) is not None
+    assert pregenerate.claim(db, run.id) is None   # done は再開しない
+
+
+def test_unavailable_a1111_pauses_without_failing_items(client, headers, db, monkeypatch):
+    create_quizzes(client, headers, 2)
+    run = pregenerate.create_run(db, order="newest", user_id=user_id(db, headers))
+    monkeypatch.setattr(settings, "A1111_BREAKER_RESET", 0)
+    monkeypatch.setattr(settings, "A1111_RETRIES", 0)
+    out = _run(db, run.id, base_url="http://127.0.0.1:1")
+    assert (out["status"], out["pending"], out["failed"]) == ("paused", 2, 0)
+    assert out["error"] == "A1111 unavailable; resume later"
+
+
+def test_claim_is_exclusive_until_stale(client, headers, db):
+    create_quizzes(client, headers, 1)
+    run = pregenerate.create_run(db, user_id=user_id(db, headers))
+    assert pregenerate.claim(db, run.id) is not None
+    assert pregenerate.claim(db, run.id) is None
+
+    db.execute(update(models.PregenRun).where(models.PregenRun.id == run.id)
+               .values(updated_at=datetime.utcnow() - pregenerate.STALE_AFTER - timedelta(seconds=1)))
+    db.commit(); db.refresh(run)
+    assert pregenerate.request_stop(db, run).status == "paused"   # 落ちた run は stopping を待たずに止める
+    assert pregenerate.claim(db, run.id) is not None
+
+
+def test_admin_api_requires_token(client, headers, admin):
+    assert client.post("/admin/images/pregenerate", json={}, headers=headers).status_code == 403
+    assert client.get("/admin/images/pregenerate/999999", headers=admin).status_code == 404
@@ -0,0 +1,35 @@
+import pytest
+from sqlalchemy import create_engine
+
+from app.migrations import _full_scans_sqlite, check_query_plans
+
+
+def test_crud_queries_do_not_full_scan():
+    # python -m app.migrations check-plans と同じ検査（一時 SQLite）
+    problems = check_query_plans()
+    assert not problems, "\n".join(problems)
+
+
+@pytest.fixture
+def conn():
+    eng = create_engine("sqlite://")
+    with eng.connect() as c:
+        c.exec_driver_sql("CREATE TABLE t (id INTEGER PRIMARY KEY, u INTEGER, k INTEGER)")
+        c.exec_driver_sql("CREATE INDEX ix_t_u ON t (u)")
+        yield c
+
+
+@pytest.mark.parametrize("sql,expected", [
+    ("SELECT * FROM t WHERE k = 1", "SCAN t"),
+    ("SELECT u FROM t ORDER BY u", "SCAN t USING COVERING INDEX ix_t_u"),
+    ("SELECT * FROM (SELECT u, row_number() OVER (PARTITION BY u ORDER BY k) AS rn FROM t WHERE u = 1) AS r WHERE rn = 1",
+     "SCAN r"),
+    ("SELECT * FROM t WHERE u = 1 ORDER BY k", "USE TEMP B-TREE FOR ORDER BY"),
+])
+def test_checker_flags_scans_and_temp_sorts(conn, sql, expected):
+    assert expected in _full_scans_sqlite(conn, sql, ())
+
+
+def test_checker_accepts_index_search(conn):
+    assert _full_scans_sqlite(conn, "SELECT * FROM t WHERE u = 1 ORDER BY u", ()) == []
+    assert _full_scans_sqlite(conn, "SELECT * FROM t WHERE id = 1", ()) == []
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import migrations, models
+from app.database import engine
+from app.services import stats
+
+from conftest import create_quizzes
+
+
+def _answer(client, headers, qid, answer):
+    return client.post(f"/quiz/{qid}/answer", json={"answer": answer, "image_shown": False}, headers=headers)
+
+
+def _status(client, headers, **params):
+    return [(q["id"], q["attempts"], q["last_correct"])
+            for q in client.get("/quiz/list", params={"order": "created_asc", **params}, headers=headers).json()]
+
+
+def _quiz_diffs(db, ids):
+    return [d for d in stats.verify(db) if any(d.startswith(f"quiz {qid} ") for qid in ids)]
+
+
+def test_status_and_filters(client, headers, db):
+    ids = create_quizzes(client, headers, 3)
+    _answer(client, headers, ids[0], "a0")
+    _answer(client, headers, ids[0], "x")
+    _answer(client, headers, ids[1], "a1")
+
+    assert _status(client, headers) == [(ids[0], 2, False), (ids[1], 1, True), (ids[2], 0, None)]
+    assert _status(client, headers, status="incorrect_only") == [(ids[0], 2, False)]
+    assert _status(client, headers, status="unanswered_only") == [(ids[2], 0, None)]
+    assert _quiz_diffs(db, ids) == []
+
+
+def test_batch_keeps_latest_by_answered_at(client, headers, db):
+    ids = create_quizzes(client, headers, 2)
+    _answer(client, headers, ids[0], "x")
+    old = (datetime.utcnow() - timedelta(days=1)).isoformat()
+    items = [
+        {"quiz_id": ids[0], "answer": "a0", "image_shown": False, "client_ts": old},   # 古い正解は直近を変えない
+        {"quiz_id": ids[1], "answer": "a1", "image_shown": False},
+        {"quiz_id": ids[1], "answer": "x", "image_shown": False, "client_ts": old},
+    ]
+    assert client.post("/quiz/answers/batch", json={"items": items}, headers=headers).status_code == 200
+
+    assert _status(client, headers) == [(ids[0], 2, False), (ids[1], 2, True)]
+    assert _status(client, headers, status="incorrect_only") == [(ids[0], 2, False)]
+    assert _quiz_diffs(db, ids) == []
+
+
+def test_migration_backfills_latest(client, headers, db):
+    ids = create_quizzes(client, headers, 2)
+    _answer(client, headers, ids[0], "a0")
+    _answer(client, headers, ids[1], "x")
+    qs = models.QuizStats
+    db.execute(update(qs).where(qs.quiz_id.in_(ids)).values(last_answered_at=None, last_correct=None))
+    db.commit()
+
+    migrations._quiz_stats_latest(engine)
+    db.expire_all()
+    assert {q.quiz_id: q.last_correct for q in db.query(qs).filter(qs.quiz_id.in_(ids))} == {ids[0]: True, ids[1]: False}
+    assert _quiz_diffs(db, ids) == []
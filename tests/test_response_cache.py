@@ -0,0 +1,62 @@
+from app import crud
+from app.services.response_cache import ResponseCache
+
+from conftest import create_quizzes
+
+
+def test_etag_and_304(client, headers):
+    create_quizzes(client, headers, 1)
+    r = client.get("/quiz/list", headers=headers)
+    tag = r.headers["etag"]
+    assert tag.startswith('W/"') and r.headers["cache-control"] == "private, no-cache"
+
+    r304 = client.get("/quiz/list", headers={**headers, "If-None-Match": f'"other", {tag}'})
+    assert (r304.status_code, r304.content, r304.headers["etag"]) == (304, b"", tag)
+    # 版はユーザー単位なので /stats/summary も同じ ETag で 304 になる
+    assert client.get("/stats/summary", headers={**headers, "If-None-Match": tag}).status_code == 304
+
+
+def test_writes_change_the_version(client, headers):
+    qid = create_quizzes(client, headers, 1)[0]
+    tag = client.get("/quiz/list", headers=headers).headers["etag"]
+    client.post(f"/quiz/{qid}/answer", json={"answer": "a0", "image_shown": False}, headers=headers)
+
+    r = client.get("/quiz/list", headers={**headers, "If-None-Match": tag})
+    assert r.status_code == 200 and r.headers["etag"] != tag
+    assert r.json()[0]["attempts"] == 1
+
+
+def test_cached_body_is_per_query_and_keeps_headers(client, headers, monkeypatch):
+    create_quizzes(client, headers, 3)
+    first = client.get("/quiz/list", params={"limit": 2}, headers=headers)
+    assert "x-next-cursor" in first.headers
+
+    calls = []
+    real = crud.list_quizzes_page
+    monkeypatch.setattr(crud, "list_quizzes_page", lambda *a, **kw: calls.append(1) or real(*a, **kw))
+    again = client.get("/quiz/list", params={"limit": 2}, headers=headers)
+    assert calls == [] and again.content == first.content
+    assert again.headers["x-next-cursor"] == first.headers["x-next-cursor"]
+
+    client.get("/quiz/list", params={"limit": 1}, headers=headers)
+    assert calls == [1]
+
+
+def test_other_user_does_not_get_my_cache(client, headers):
+    create_quizzes(client, headers, 1)
+    mine = client.get("/quiz/list", headers=headers)
+    theirs = client.get("/quiz/list", headers={"X-Token": headers["X-Token"] + "-other",
+                                               "If-None-Match": mine.headers["etag"]})
+    assert theirs.status_code == 200 and theirs.json() == []
+
+
+def test_lru_bounds():
+    c = ResponseCache(maxsize=2, max_bytes=10)
+    c.put("a", 1, b"aaaa", {})
+    c.put("b", 1, b"bbbb", {})
+    assert c.get("a", 1) is not None   # a を新しくする
+    c.put("c", 1, b"cccc", {})          # 件数・バイト数とも超えるので一番古い b を落とす
+    assert (c.get("a", 1), c.get("b", 1), c.get("c", 1)) == ((b"aaaa", {}), None, (b"cccc", {}))
+    assert c.get("a", 2) is None        # 版が違えば使わない
+    c.put("big", 1, b"x" * 11, {})
+    assert c.get("big", 1) is None
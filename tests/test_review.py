@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+from app.services import review
+
+from conftest import create_quizzes, user_id
+
+T0 = datetime(2025, 1, 1, 9, 0)
+
+
+def _run(answers):
+    st = review.new_state(1, 1)
+    for correct, image_shown, at in answers:
+        review.apply(st, correct, image_shown, at)
+    return st
+
+
+def test_sm2_intervals_grow_with_ease():
+    st = _run([(True, False, T0)])
+    assert (st.interval_days, st.repetitions, st.due_at, st.ease) == (1, 1, T0 + timedelta(days=1), 2.5)
+    st = _run([(True, False, T0), (True, False, T0 + timedelta(days=1))])
+    assert (st.interval_days, st.due_at) == (6, T0 + timedelta(days=7))
+    st = _run([(True, False, T0), (True, False, T0 + timedelta(days=1)), (True, False, T0 + timedelta(days=7))])
+    assert (st.interval_days, st.repetitions) == (15, 3)   # round(6 * 2.5)
+
+
+def test_wrong_answer_relearns_and_lowers_ease():
+    st = _run([(True, False, T0), (True, False, T0 + timedelta(days=1)), (False, False, T0 + timedelta(days=7))])
+    assert (st.repetitions, st.lapses, st.interval_days) == (0, 1, 1)
+    assert st.due_at == T0 + timedelta(days=7) + review.RELEARN_DELAY
+    assert st.ease == 2.18
+
+
+def test_image_hint_grows_ease_less():
+    assert _run([(True, True, T0)]).ease < _run([(True, False, T0)]).ease
+    assert _run([(True, True, T0)]).ease == 2.36
+
+
+def test_early_correct_answer_does_not_extend():
+    st = _run([(True, False, T0), (True, False, T0 + timedelta(hours=1))])
+    assert (st.repetitions, st.due_at, st.last_answered_at) == (1, T0 + timedelta(days=1), T0 + timedelta(hours=1))
+
+
+def test_ease_has_a_floor():
+    st = _run([(False, False, T0 + timedelta(days=i)) for i in range(20)])
+    assert st.ease == review.MIN_EASE
+
+
+def test_queue_orders_due_first_then_new(client, headers, db):
+    a, b, c = create_quizzes(client, headers, 3)
+    now = datetime.utcnow()
+    client.post("/quiz/answers/batch", json={"items": [
+        {"quiz_id": a, "answer": "x", "image_shown": False, "client_ts": (now - timedelta(hours=2)).isoformat()},
+        {"quiz_id": b, "answer": "x", "image_shown": False, "client_ts": (now - timedelta(hours=3)).isoformat()},
+    ]}, headers=headers)
+
+    due = client.get("/review/next", headers=headers).json()
+    assert [(i["quiz_id"], i["is_new"]) for i in due] == [(b, False), (a, False)]
+    with_new = client.get("/review/next", params={"include_new": True, "limit": 3}, headers=headers).json()
+    assert [(i["quiz_id"], i["is_new"]) for i in with_new] == [(b, False), (a, False), (c, True)]
+
+    client.post(f"/quiz/{b}/answer", json={"answer": "a1", "image_shown": False}, headers=headers)
+    assert [i["quiz_id"] for i in client.get("/review/next", headers=headers).json()] == [a]
+    uid = user_id(db, headers)
+    assert [d for d in review.verify(db) if d.startswith(f"user {uid} ")] == []
@@ -0,0 +1,67 @@
+from sqlalchemy import func, select
+
+from app import models
+from app.services import search
+
+from conftest import user_id
+
+
+def _create(client, headers, question, answer):
+    return client.post("/quiz/create", json={"question": question, "answer": answer}, headers=headers).json()["id"]
+
+
+def _search(client, headers, q):
+    return [r["id"] for r in client.get("/quiz/search", params={"q": q}, headers=headers).json()]
+
+
+def _grams(db, qid):
+    return db.scalar(select(func.count()).select_from(models.QuizGram).where(models.QuizGram.quiz_id == qid))
+
+
+def test_short_terms_use_grams(client, headers):
+    a = _create(client, headers, "日本の首都は？", "東京")
+    b = _create(client, headers, "Capital of France", "Paris")
+    assert _search(client, headers, "首都") == [a]
+    assert _search(client, headers, "京") == [a]
+    assert _search(client, headers, "PA") == [b]
+    assert _search(client, headers, "首都 東京") == [a]
+    assert _search(client, headers, "都は") == [a]
+    assert _search(client, headers, "東都") == []          # 両方の 1-gram はあっても並びが違う
+    assert _search(client, headers, "of Fra") == [b]         # 短い語と長い語の混在
+    assert _search(client, headers, "of Paris") == [b]       # 語ごとに question か answer のどちらかに一致すればよい
+    assert _search(client, headers, "of Tokyo") == []
+
+
+def test_list_filter_with_short_term(client, headers):
+    a = _create(client, headers, "りんごの色", "赤")
+    _create(client, headers, "空の色", "青")
+    assert [q["id"] for q in client.get("/quiz/list", params={"q": "赤"}, headers=headers).json()] == [a]
+
+
+def test_other_users_grams_do_not_match(client, headers):
+    _create(client, {"X-Token": headers["X-Token"] + "-other"}, "首都", "x")
+    assert _search(client, headers, "首都") == []
+
+
+def test_delete_and_import_maintain_grams(client, headers, db):
+    qid = _create(client, headers, "ab", "c")
+    assert _grams(db, qid) == 4                               # a, b, c, ab
+    client.delete(f"/quiz/{qid}", headers=headers)
+    assert _grams(db, qid) == 0
+
+    r = client.post("/quiz/import", content="question,answer\n犬の鳴き声,ワン\n", headers={**headers, "Content-Type": "text/csv"})
+    assert r.json()["inserted"] == 1
+    assert len(_search(client, headers, "ワン")) == 1
+
+
+def test_rebuild_matches_incremental(client, headers, db):
+    _create(client, headers, "Rebuild me", "ok")
+    uid = user_id(db, headers)
+    g = models.QuizGram
+
+    def snapshot():
+        return sorted(db.execute(select(g.gram, g.quiz_id).where(g.user_id == uid)).all())
+
+    before = snapshot()
+    search.rebuild_grams(db)
+    assert snapshot() == before
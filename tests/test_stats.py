@@ -0,0 +1,74 @@
+from sqlalchemy import event, update
+
+from app import models
+from app.database import engine
+from app.services import stats
+
+from conftest import create_quizzes, user_id
+
+
+def _answer(client, headers, qid, answer, image_shown):
+    client.post(f"/quiz/{qid}/answer", json={"answer": answer, "image_shown": image_shown}, headers=headers)
+
+
+def _summary(client, headers):
+    return client.get("/stats/summary", headers=headers).json()
+
+
+def _user_diffs(db, headers):
+    return [d for d in stats.verify(db) if d.startswith(f"user {user_id(db, headers)} ")]
+
+
+def test_summary_splits_by_image(client, headers, db):
+    a, b = create_quizzes(client, headers, 2)
+    _answer(client, headers, a, "a0", True)
+    _answer(client, headers, a, "x", True)
+    _answer(client, headers, b, "a1", False)
+
+    s = _summary(client, headers)
+    assert (s["total_quizzes"], s["attempts"], s["correct_attempts"]) == (2, 3, 2)
+    assert (s["attempts_with_image"], s["accuracy_with_image"]) == (2, 0.5)
+    assert (s["attempts_without_image"], s["accuracy_without_image"]) == (1, 1.0)
+    assert _user_diffs(db, headers) == []
+
+
+def test_summary_reads_only_counters(client, headers):
+    qid = create_quizzes(client, headers, 1)[0]
+    _answer(client, headers, qid, "a0", False)
+    seen = []
+
+    def record(conn, cursor, statement, *args):
+        seen.append(statement)
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        _summary(client, headers)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert any("user_stats" in s for s in seen)
+    assert not any("answer_logs" in s or "count(" in s.lower() for s in seen)
+
+
+def test_delete_subtracts_counters(client, headers, db):
+    a, b = create_quizzes(client, headers, 2)
+    _answer(client, headers, a, "a0", True)
+    _answer(client, headers, b, "x", False)
+    client.delete(f"/quiz/{a}", headers=headers)
+
+    s = _summary(client, headers)
+    assert (s["total_quizzes"], s["attempts"], s["correct_attempts"], s["attempts_with_image"]) == (1, 1, 0, 0)
+    assert stats.get_quiz_stats(db, a, user_id(db, headers)) is None
+    assert _user_diffs(db, headers) == []
+
+
+def test_verify_and_rebuild_repair_drift(client, headers, db):
+    qid = create_quizzes(client, headers, 1)[0]
+    _answer(client, headers, qid, "a0", False)
+    uid = user_id(db, headers)
+    db.execute(update(models.UserStats).where(models.UserStats.user_id == uid).values(attempts=99))
+    db.commit()
+
+    assert _user_diffs(db, headers) == [f"user {uid} attempts: stored=99 expected=1"]
+    stats.rebuild(db)
+    assert _user_diffs(db, headers) == []
+    assert stats.get_user_stats(db, uid).attempts == 1
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import time
+from uuid import uuid4
+
+import pytest
+
+from app import models
+from app.config import settings
+from app.services import storage
+from app.services.image_variants import variant_path
+
+from conftest import create_quizzes
+
+OLD = time.time() - 3600
+
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    """IMAGE_DIR と使用量の見積もりをテストごとに分ける"""
+    root = str(tmp_path / "images").replace("\\", "/")
+    os.makedirs(root)
+    monkeypatch.setattr(settings, "IMAGE_DIR", root)
+    monkeypatch.setattr(storage, "usage", storage.Usage())
+    return root
+
+
+def _write(path, data=b"x" * 10, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_place_shards_and_dedups(image_dir):
+    h = hashlib.sha256(b"img").hexdigest()
+    rel = storage.place(_write(f"{image_dir}/a.tmp"), h, 10)
+    assert rel == f"{image_dir}/cas/{h[:2]}/{h[2:4]}/{h}.png" and os.path.exists(rel)
+    assert storage.place(_write(f"{image_dir}/b.tmp"), h, 10) == rel
+    assert not os.path.exists(f"{image_dir}/b.tmp")
+    assert storage.usage.bytes() == 10   # 2回目は既存を使うので増えない
+
+
+def test_release_keeps_referenced_files(client, headers, db, image_dir):
+    qid = create_quizzes(client, headers, 1)[0]
+    kept, gone = _write(f"{image_dir}/kept.png"), _write(f"{image_dir}/gone.png")
+    thumb = _write(variant_path(gone, 128, "webp"))
+    db.add(models.GeneratedImage(quiz_id=qid, file_path=kept))
+    db.commit()
+    assert storage.release(db, [kept, gone, gone, ""]) == 1
+    assert os.path.exists(kept) and not os.path.exists(gone) and not os.path.exists(thumb)
+
+
+def test_gc_removes_only_old_orphans(client, headers, db, image_dir):
+    qid = create_quizzes(client, headers, 1)[0]
+    ref = _write(f"{image_dir}/cas/aa/bb/ref.png", mtime=OLD)
+    cached = _write(f"{image_dir}/cas/aa/bb/cached.png", mtime=OLD)
+    orphan = _write(f"{image_dir}/cas/cc/dd/orphan.png", mtime=OLD)
+    recent = _write(f"{image_dir}/cas/cc/dd/recent.png")
+    db.add(models.GeneratedImage(quiz_id=qid, file_path=ref))
+    key = uuid4().hex
+    db.add(models.ImageCacheEntry(param_key=key, content_hash=key, file_path=cached, size_bytes=10))
+    db.commit()
+
+    dry = storage.gc(db, dry_run=True, grace=60, batch=2)
+    assert (dry["files"], dry["orphans"], dry["deleted"]) == (4, 1, 0) and os.path.exists(orphan)
+    out = storage.gc(db, grace=60, batch=2)
+    assert (out["files"], out["bytes"], out["deleted"]) == (3, 30, 1)
+    assert not os.path.exists(orphan) and all(os.path.exists(p) for p in (ref, cached, recent))
+    assert storage.usage.bytes() == 30   # 走査結果が STATE_FILE に残る
+    assert os.path.exists(os.path.join(image_dir, storage.STATE_FILE))
+
+
+def test_gc_refuses_when_no_image_is_under_root(client, headers, db, image_dir):
+    qid = create_quizzes(client, headers, 1)[0]
+    db.add(models.GeneratedImage(quiz_id=qid, file_path="elsewhere/x.png"))
+    db.commit()
+    orphan = _write(f"{image_dir}/orphan.png", mtime=OLD)
+    with pytest.raises(RuntimeError):   # IMAGE_DIR を書き換え忘れたときに全部消さない
+        storage.gc(db, grace=0)
+    assert os.path.exists(orphan)
+
+
+def test_quota_refuses_new_images_with_507(client, headers, monkeypatch):
+    qid = create_quizzes(client, headers, 1)[0]
+    monkeypatch.setattr(settings, "STORAGE_QUOTA_BYTES", 100)
+    monkeypatch.setattr(storage.usage, "bytes", lambda: 100)
+    with pytest.raises(storage.StorageQuotaExceeded):
+        storage.check_quota()
+    r = client.post("/quiz/image/generate", json={"quiz_id": qid, "prompt": f"quota {uuid4().hex}"}, headers=headers)
+    assert r.status_code == 507
+
+    monkeypatch.setattr(settings, "STORAGE_QUOTA_BYTES", 0)
+    storage.check_quota()   # 0 は無制限
+
+
+def test_migrate_file_moves_references_to_sharded_path(client, headers, db, image_dir):
+    qid = create_quizzes(client, headers, 1)[0]
+    data = uuid4().bytes
+    old = _write(f"{image_dir}/legacy-{uuid4().hex}.png", data)
+    old_thumb = _write(variant_path(old, 128, "webp"))
+    im = models.GeneratedImage(quiz_id=qid, file_path=old)
+    db.add(im)
+    db.flush()
+    db.add(models.ImageVariant(image_id=im.id, width=128, height=128, format="webp", file_path=old_thumb))
+    db.commit()
+    assert old in storage.legacy_paths(db, batch=10 ** 6)
+
+    new = storage.migrate_file(db, old)
+    h = hashlib.sha256(data).hexdigest()
+    assert new == storage.content_path(h) and new.startswith(f"{image_dir}/cas/{h[:2]}/{h[2:4]}/")
+    db.refresh(im)
+    assert im.file_path == new and [v.file_path for v in im.variants] == [variant_path(new, 128, "webp")]
+    assert os.path.exists(variant_path(new, 128, "webp"))
+    assert not os.path.exists(old) and not os.path.exists(old_thumb)   # どこからも参照されなくなった
+    assert old not in storage.legacy_paths(db, batch=10 ** 6)
+    assert storage.migrate_file(db, f"{image_dir}/missing.png") is None
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, delete, update
+
+from app import migrations, models
+from app.database import Base
+from app.services import user_cache
+from app.services.user_cache import cleanup_unused_users, token_cache
+
+from conftest import create_quizzes, user_id
+
+
+def test_stale_cached_id_is_not_reused_for_another_user(client, headers, db):
+    ids = create_quizzes(client, headers, 1)
+    client.delete(f"/quiz/{ids[0]}", headers=headers)
+    stale = user_id(db, headers)
+    client.get("/quiz/list", headers=headers)   # キャッシュに載せる
+    # 別プロセスの cleanup を模す: 行だけ消え、このプロセスのキャッシュには残る
+    db.execute(delete(models.User).where(models.User.id == stale)); db.commit()
+    assert token_cache.get(headers["X-Token"]) == stale
+
+    other = {"X-Token": headers["X-Token"] + "-other"}
+    other_quiz = create_quizzes(client, other, 1)[0]
+    assert user_id(db, other) != stale   # AUTOINCREMENT なので使い回さない
+
+    r = client.post(f"/quiz/{other_quiz}/answer", json={"answer": "a0", "image_shown": False}, headers=headers)
+    assert r.status_code == 404
+    assert client.delete(f"/quiz/{other_quiz}", headers=headers).status_code == 404
+    assert token_cache.get(headers["X-Token"]) is None
+
+    # 書き込みで作り直され、新しい id で使える
+    assert client.post("/quiz/create", json={"question": "q", "answer": "a"}, headers=headers).status_code == 200
+    assert user_id(db, headers) not in (None, stale)
+
+
+def test_cleanup_uses_last_seen(client, db):
+    old = datetime.utcnow() - timedelta(days=30)
+    recent = models.User(token="cleanup-recent", created_at=old, last_seen_at=datetime.utcnow())
+    idle = models.User(token="cleanup-idle", created_at=old, last_seen_at=old)
+    db.add_all([recent, idle]); db.commit()
+    cleanup_unused_users(db, timedelta(days=7))
+    tokens = {t for (t,) in db.query(models.User.token).filter(models.User.token.like("cleanup-%"))}
+    assert tokens == {"cleanup-recent"}
+
+
+def test_lookup_refreshes_last_seen(client, headers, db):
+    create_quizzes(client, headers, 1)
+    uid = user_id(db, headers)
+    old = datetime.utcnow() - timedelta(days=3)
+    db.execute(update(models.User).where(models.User.id == uid).values(last_seen_at=old)); db.commit()
+    token_cache.invalidate(token=headers["X-Token"])
+    client.get("/quiz/list", headers=headers)
+    db.expire_all()
+    assert db.get(models.User, uid).last_seen_at > datetime.utcnow() - user_cache.LAST_SEEN_RESOLUTION
+
+
+def test_users_migration_adds_last_seen_and_autoincrement(tmp_path):
+    eng = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    Base.metadata.create_all(eng)
+    with eng.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE users")
+        conn.exec_driver_sql("CREATE TABLE users (id INTEGER NOT NULL PRIMARY KEY, token VARCHAR, created_at DATETIME, "
+                             "data_version INTEGER NOT NULL DEFAULT 0)")
+        conn.exec_driver_sql("INSERT INTO users (id, token, created_at) VALUES (1, 't', '2024-01-01 00:00:00')")
+    migrations._users_last_seen(eng)
+    with eng.connect() as conn:
+        assert migrations.has_autoincrement(conn, "users")
+        assert conn.exec_driver_sql("SELECT token, last_seen_at FROM users").one() == ("t", "2024-01-01 00:00:00")
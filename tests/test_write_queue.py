@@ -0,0 +1,67 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from app import async_crud, models, schemas
+from app.database import async_url
+from app.services import response_cache, stats
+from app.services.write_queue import writer
+
+from conftest import user_id
+
+
+@pytest.fixture
+def writer_threads(client, monkeypatch):
+    """書き込みスレッドを動かし、response_cache.bump（どの書き込みも通る）を呼んだスレッド名を集める"""
+    names = []
+    real = response_cache.bump
+    monkeypatch.setattr(response_cache, "bump", lambda db, uid: names.append(threading.current_thread().name) or real(db, uid))
+    writer.start()
+    yield names
+    writer.shutdown()
+
+
+def _batch(client, headers, items):
+    return [(r["status"], r["correct"]) for r in
+            client.post("/quiz/answers/batch", json={"items": items}, headers=headers).json()["results"]]
+
+
+def test_create_import_and_batch_go_through_writer(client, headers, db, writer_threads):
+    qid = client.post("/quiz/create", json={"question": "q", "answer": "a"}, headers=headers).json()["id"]
+    r = client.post("/quiz/import", content="question,answer\nq2,b\n", headers={**headers, "Content-Type": "text/csv"})
+    assert r.json()["inserted"] == 1
+
+    item = {"quiz_id": qid, "answer": "a", "image_shown": False, "idempotency_key": "k1"}
+    assert _batch(client, headers, [item]) == [("ok", True)]
+    assert _batch(client, headers, [item]) == [("duplicate", True)]
+
+    assert writer_threads == ["db-writer"] * 3
+    uid = user_id(db, headers)
+    us = stats.get_user_stats(db, uid)
+    assert (us.total_quizzes, us.attempts) == (2, 1)
+
+
+def test_async_paths_use_writer(client, headers, db, writer_threads):
+    client.post("/quiz/create", json={"question": "seed", "answer": "x"}, headers=headers)
+    user = models.User(id=user_id(db, headers), token=headers["X-Token"])
+
+    async def run():
+        engine = create_async_engine(async_url(os.environ["DATABASE_URL"]))
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as s:
+                qz = await async_crud.create_quiz(s, user, "async q", "async a")
+                item = schemas.AnswerBatchItem(quiz_id=qz.id, answer="async a", image_shown=True, idempotency_key="k")
+                first = await async_crud.log_answers_batch(s, user, [item])
+                second = await async_crud.log_answers_batch(s, user, [item])
+                return qz, first, second
+        finally:
+            await engine.dispose()
+
+    qz, first, second = asyncio.run(run())
+    assert qz.id and qz.answer_alternates
+    assert [(r["status"], r["correct"]) for r in first] == [("ok", True)]
+    assert [(r["status"], r["correct"]) for r in second] == [("duplicate", True)]
+    assert writer_threads[-2:] == ["db-writer"] * 2
@@ -0,0 +1,555 @@
+"""負荷テスト・ベンチマーク
+
+合成データを入れた DB に対して全エンドポイントを叩き、エンドポイントごとの
+スループットと p50/p95/p99 を出す。画像生成は tools/fake_a1111.py のスタブに向ける。
+結果は JSON で保存でき、基準値と比べて遅くなっていれば終了コード 1 を返す（CI 用）。
+
+    # 1) データ投入（規模は answer_logs の行数。1k / 10k / 100k / 1m / 10m）
+    python tools/bench.py seed --db sqlite:///./bench.db --scale 100k
+
+    # 2) 計測。asgi はプロセス内（ネットワークなし）、http は uvicorn 越し
+    python tools/bench.py run --db sqlite:///./bench.db --driver asgi -c 32 -n 300 --save bench/baseline.json
+    python tools/bench.py run --db sqlite:///./bench.db --driver http --spawn --port 8765 -c 64
+    python tools/bench.py run --driver http --base-url http://127.0.0.1:8000   # 起動済みのサーバー
+
+    # 3) 基準値との比較（p95 が tolerance 以上悪化したら失敗）
+    python tools/bench.py run ... --compare bench/baseline.json --tolerance 0.25
+    python tools/bench.py compare bench/baseline.json bench/current.json
+
+    # 4) 一覧 JSON のシリアライズ（pydantic / orjson）と圧縮（gzip / brotli）のバイト数・CPU 時間
+    python tools/bench.py payload --sizes 200,1000 --save bench/payload.json
+
+既定の DB は ./bench.db。本番の quiz.db を使う場合は --db で明示すること。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_DB = "sqlite:///./bench.db"
+TOKEN_PREFIX = "bench-user-"
+
+# scale -> (users, quizzes_per_user, answer_logs)
+SCALES = {
+    "1k": (10, 20, 1_000),
+    "10k": (50, 40, 10_000),
+    "100k": (200, 50, 100_000),
+    "1m": (1_000, 100, 1_000_000),
+    "10m": (5_000, 200, 10_000_000),
+}
+SEED_CHUNK = 20_000
+
+
+# ---- データ投入 ----
+def _abs_db(url: str) -> str:
+    """相対パスの SQLite URL を絶対パスにする（計測時は作業ディレクトリを移すため）"""
+    from sqlalchemy.engine.url import make_url
+    u = make_url(url)
+    if u.get_backend_name() == "sqlite" and u.database and u.database != ":memory:" and not os.path.isabs(u.database):
+        return u.set(database=os.path.abspath(u.database)).render_as_string(hide_password=False)
+    return url
+
+
+def _use_db(url: str) -> str:
+    """app を import する前に呼ぶ（設定は import 時に読まれる）"""
+    url = _abs_db(url)
+    os.environ["DATABASE_URL"] = url
+    return url
+
+
+def _insert_quizzes(conn, quizzes: list) -> None:
+    """直接 INSERT するので短い語の検索用 quiz_grams も自分で足す"""
+    from sqlalchemy import insert
+    from app import models
+    from app.services import search
+    conn.execute(insert(models.Quiz), quizzes)
+    search.index_quizzes(conn, [(q["user_id"], q["id"], q["question"], q["answer"]) for q in quizzes])
+
+
+def seed(url: str, scale: str, rng_seed: int = 0) -> dict:
+    _use_db(url)
+    from sqlalchemy import insert, func, select, text
+    from app import models, migrations
+    from app.database import engine, SessionLocal
+    from app.services import grading, search, stats
+
+    migrations.migrate(engine)
+    search.setup(engine)
+    n_users, qpu, n_answers = SCALES[scale]
+    rnd = random.Random(rng_seed)
+    now = datetime.utcnow()
+    t0 = time.perf_counter()
+
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("PRAGMA synchronous=OFF")
+        ubase = conn.execute(select(func.coalesce(func.max(models.User.id), 0))).scalar()
+        qbase = conn.execute(select(func.coalesce(func.max(models.Quiz.id), 0))).scalar()
+        run_id = f"{int(time.time())}-"
+        users = [{"id": ubase + i + 1, "token": f"{TOKEN_PREFIX}{run_id}{i}", "created_at": now - timedelta(days=30)}
+                 for i in range(n_users)]
+        conn.execute(insert(models.User), users)
+
+        quizzes = []
+        for i in range(n_users):
+            for j in range(qpu):
+                quizzes.append({
+                    "id": qbase + i * qpu + j + 1, "user_id": ubase + i + 1,
+                    "question": f"ベンチ問題 {i}-{j} sample question {rnd.randrange(10**6)}",
+                    "answer": f"answer{j % 7}", **grading.key_fields(f"answer{j % 7}"),
+                    "created_at": now - timedelta(minutes=rnd.randrange(60 * 24 * 90)),
+                })
+                if len(quizzes) >= SEED_CHUNK:
+                    _insert_quizzes(conn, quizzes); quizzes = []
+        if quizzes:
+            _insert_quizzes(conn, quizzes)
+
+        logs = []
+        for _ in range(n_answers):
+            i = rnd.randrange(n_users)
+            j = rnd.randrange(qpu)
+            correct = rnd.random() < 0.6
+            logs.append({
+                "user_id": ubase + i + 1, "quiz_id": qbase + i * qpu + j + 1,
+                "is_correct": correct, "user_answer": f"answer{j % 7}" if correct else "x",
+                "image_shown": rnd.random() < 0.5,
+                "answered_at": now - timedelta(seconds=rnd.randrange(86400 * 90)),
+            })
+            if len(logs) >= SEED_CHUNK:
+                conn.execute(insert(models.AnswerLog), logs); logs = []
+        if logs:
+            conn.execute(insert(models.AnswerLog), logs)
+
+        if engine.dialect.name == "postgresql":
+            # id を明示して入れたので sequence を合わせる
+            for t in ("users", "quizzes"):
+                conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{t}', 'id'), (SELECT max(id) FROM {t}))"))
+
+    db = SessionLocal()
+    try:
+        stats.rebuild(db)
+    finally:
+        db.close()
+    return {"users": n_users, "quizzes": n_users * qpu, "answer_logs": n_answers,
+            "seconds": round(time.perf_counter() - t0, 2)}
+
+
+# ---- 計測シナリオ ----
+class BenchUser:
+    def __init__(self, token: str, quiz_ids: List[int]):
+        self.token = token
+        self.quiz_ids = quiz_ids
+        self.headers = {"X-Token": token}
+
+    def quiz(self) -> int:
+        return random.choice(self.quiz_ids)
+
+
+def load_users(url: str, limit: int = 200) -> List[BenchUser]:
+    from sqlalchemy import create_engine, text
+    eng = create_engine(url)
+    with eng.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT u.token, q.id FROM users u JOIN quizzes q ON q.user_id = u.id "
+            "WHERE u.token LIKE :p AND u.id IN (SELECT id FROM users WHERE token LIKE :p ORDER BY id LIMIT :n)"
+        ), {"p": TOKEN_PREFIX + "%", "n": limit}).all()
+    eng.dispose()
+    by_token: Dict[str, List[int]] = {}
+    for token, qid in rows:
+        by_token.setdefault(token, []).append(qid)
+    return [BenchUser(t, ids) for t, ids in by_token.items()]
+
+
+Spec = Tuple[str, str, dict]   # (method, url, httpx の追加引数)
+
+
+async def _quiz_delete(c, u: BenchUser) -> Spec:
+    # 計測するのは DELETE だけ。消す対象はその場で作る
+    r = await c.post("/quiz/create", json={"question": f"bench delete {random.random()}", "answer": "x"}, headers=u.headers)
+    return "DELETE", f"/quiz/{r.json()['id']}", {}
+
+
+async def _image_job_poll(c, u: BenchUser) -> Spec:
+    r = await c.post("/quiz/image/jobs", json={"quiz_id": u.quiz(), "prompt": f"bench {random.random()}"}, headers=u.headers)
+    return "GET", f"/quiz/image/jobs/{r.json()['id']}?wait=10", {}
+
+
+def _import_body() -> bytes:
+    tag = random.random()
+    return "".join(json.dumps({"question": f"bench import {tag} {i}", "answer": "y"}) + "\n" for i in range(20)).encode()
+
+
+def _spec(method: str, url: Callable[[BenchUser], str], **kw) -> Callable[..., Awaitable[Spec]]:
+    async def build(c, u: BenchUser) -> Spec:
+        extra = {k: (v(u) if callable(v) else v) for k, v in kw.items()}
+        return method, url(u), extra
+    return build
+
+
+ENDPOINTS: Dict[str, Callable[..., Awaitable[Spec]]] = {
+    "quiz_list": _spec("GET", lambda u: "/quiz/list?limit=50"),
+    "quiz_list_incorrect": _spec("GET", lambda u: "/quiz/list?status=incorrect_only&limit=50"),
+    "quiz_list_unanswered": _spec("GET", lambda u: "/quiz/list?status=unanswered_only&limit=50"),
+    "quiz_list_q": _spec("GET", lambda u: "/quiz/list?q=sample&limit=50"),
+    "quiz_search": _spec("GET", lambda u: "/quiz/search?q=question&limit=20"),
+    "quiz_create": _spec("POST", lambda u: "/quiz/create", json=lambda u: {"question": f"bench {random.random()}", "answer": "a"}),
+    "quiz_delete": _quiz_delete,
+    "quiz_import": _spec("POST", lambda u: "/quiz/import", content=lambda u: _import_body(),
+                         headers={"Content-Type": "application/x-ndjson"}),
+    "answer": _spec("POST", lambda u: f"/quiz/{u.quiz()}/answer",
+                    json=lambda u: {"answer": random.choice(["answer1", "x"]), "image_shown": random.random() < 0.5}),
+    "answer_batch": _spec("POST", lambda u: "/quiz/answers/batch", json=lambda u: {"items": [
+        {"quiz_id": u.quiz(), "answer": "answer1", "image_shown": False, "idempotency_key": f"{random.random()}"}
+        for _ in range(10)
+    ]}),
+    "stats_summary": _spec("GET", lambda u: "/stats/summary"),
+    "stats_quizzes": _spec("GET", lambda u: "/stats/quizzes?limit=50"),
+    "image_latest": _spec("GET", lambda u: f"/quiz/{u.quiz()}/images/latest?w=256"),
+    "image_generate": _spec("POST", lambda u: "/quiz/image/generate",
+                            json=lambda u: {"quiz_id": u.quiz(), "prompt": f"bench {random.random()}"}),
+    "image_job_poll": _image_job_poll,
+    "export_answers": _spec("GET", lambda u: "/export/answers?format=ndjson"),
+}
+# 画像生成・エクスポートは重いので既定では回数を減らす
+HEAVY = {"image_generate": 0.2, "image_job_poll": 0.2, "export_answers": 0.2, "quiz_import": 0.5}
+
+
+def percentile(sorted_vals: List[float], p: float) -> float:
+    """nearest-rank（p/100 * n を切り上げた順位の値）"""
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[k]
+
+
+async def run_endpoint(client, name: str, users: List[BenchUser], n: int, concurrency: int) -> dict:
+    build = ENDPOINTS[name]
+    lat: List[float] = []
+    errors = 0
+    remaining = n
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            u = random.choice(users)
+            try:
+                method, url, extra = await build(client, u)
+                extra = dict(extra)
+                extra["headers"] = {**u.headers, **extra.get("headers", {})}
+                t = time.perf_counter()
+                r = await client.request(method, url, **extra)
+                dt = time.perf_counter() - t
+            except Exception:
+                errors += 1
+                continue
+            if r.status_code >= 400:
+                errors += 1
+            lat.append(dt * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, n)))))
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {
+        "count": len(lat), "errors": errors,
+        "rps": round(len(lat) / wall, 1) if wall else 0.0,
+        "mean_ms": round(sum(lat) / len(lat), 2) if lat else 0.0,
+        "p50_ms": round(percentile(lat, 50), 2),
+        "p95_ms": round(percentile(lat, 95), 2),
+        "p99_ms": round(percentile(lat, 99), 2),
+    }
+
+
+async def run_all(client, users: List[BenchUser], names: List[str], n: int, concurrency: int, warmup: int) -> Dict[str, dict]:
+    out = {}
+    for name in names:
+        count = max(1, int(n * HEAVY.get(name, 1.0)))
+        if warmup:
+            await run_endpoint(client, name, users, warmup, concurrency)
+        out[name] = await run_endpoint(client, name, users, count, concurrency)
+        r = out[name]
+        print(f"{name:22s} n={r['count']:5d} err={r['errors']:3d} {r['rps']:8.1f} req/s  "
+              f"p50={r['p50_ms']:7.2f}ms p95={r['p95_ms']:7.2f}ms p99={r['p99_ms']:7.2f}ms", flush=True)
+    return out
+
+
+# ---- ドライバ ----
+async def drive_asgi(args, names, users) -> Dict[str, dict]:
+    import httpx
+    import run
+    app = run.app
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+            return await run_all(client, users, names, args.requests, args.concurrency, args.warmup)
+    finally:
+        await app.router.shutdown()
+
+
+async def _wait_ready(base_url: str, proc=None, timeout: float = 30.0) -> None:
+    import httpx
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as c:
+        while time.monotonic() < deadline:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"server exited with code {proc.returncode}")
+            try:
+                await c.get(base_url + "/stats/summary")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+async def drive_http(args, names, users) -> Dict[str, dict]:
+    import httpx
+    proc = None
+    base_url = args.base_url
+    if args.spawn:
+        base_url = f"http://127.0.0.1:{args.port}"
+        cmd = [sys.executable, "-m", "uvicorn", "run:app", "--port", str(args.port), "--log-level", "warning",
+               "--workers", str(args.workers)]
+        proc = subprocess.Popen(cmd, env=dict(os.environ))
+    try:
+        await _wait_ready(base_url, proc)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+            return await run_all(client, users, names, args.requests, args.concurrency, args.warmup)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(10)
+
+
+# ---- 比較 ----
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """p95 が (1 + tolerance) 倍を超えた、またはスループットが (1 - tolerance) 倍を下回ったものを返す"""
+    problems = []
+    for name, base in baseline.get("endpoints", {}).items():
+        cur = current.get("endpoints", {}).get(name)
+        if cur is None:
+            continue
+        if base["p95_ms"] and cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {base['p95_ms']}ms -> {cur['p95_ms']}ms")
+        if base["rps"] and cur["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{name}: rps {base['rps']} -> {cur['rps']}")
+        if cur["errors"] > base["errors"]:
+            problems.append(f"{name}: errors {base['errors']} -> {cur['errors']}")
+    return problems
+
+
+def _report_compare(baseline_path: str, current: dict, tolerance: float) -> int:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = compare(baseline, current, tolerance)
+    for p in problems:
+        print("REGRESSION:", p)
+    print("OK" if not problems else f"{len(problems)} regression(s)")
+    return 1 if problems else 0
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def cmd_run(args) -> int:
+    args.db = _use_db(args.db)
+    fake = None
+    if not args.a1111_url:
+        from fake_a1111 import start_in_thread
+        fake = start_in_thread(delay=args.a1111_delay)
+        os.environ["A1111_BASE_URL"] = f"http://127.0.0.1:{fake.server_port}"
+    else:
+        os.environ["A1111_BASE_URL"] = args.a1111_url
+    # 生成画像で作業ツリーを汚さないよう、一時ディレクトリをカレントにして動かす
+    work = tempfile.mkdtemp(prefix="bench-")
+    os.environ["IMAGE_DIR"] = "static/images"
+    os.makedirs(os.path.join(work, "static", "images"))
+    os.chdir(work)
+    os.environ["PYTHONPATH"] = os.pathsep.join(p for p in (ROOT, os.environ.get("PYTHONPATH")) if p)
+
+    users = load_users(args.db)
+    if not users:
+        print("no bench users found; run `python tools/bench.py seed` first", file=sys.stderr)
+        return 2
+    names = args.endpoints.split(",") if args.endpoints else list(ENDPOINTS)
+    unknown = [n for n in names if n not in ENDPOINTS]
+    if unknown:
+        print(f"unknown endpoint(s): {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    random.seed(args.seed)
+    driver = drive_asgi if args.driver == "asgi" else drive_http
+    try:
+        endpoints = asyncio.run(driver(args, names, users))
+    finally:
+        if fake is not None:
+            fake.shutdown()
+
+    result = {
+        "meta": {
+            "driver": args.driver, "concurrency": args.concurrency, "requests": args.requests,
+            "db": args.db if args.driver == "asgi" or args.spawn else args.base_url,
+            "users": len(users), "git": _git_rev(), "python": platform.python_version(),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        },
+        "endpoints": endpoints,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"saved {args.save}")
+    if args.compare:
+        return _report_compare(args.compare, result, args.tolerance)
+    return 0
+
+
+# ---- 本文のバイト数と CPU 時間 ----
+WORDS = ("apple", "りんご", "東京", "photosynthesis", "光合成", "1868", "mitochondria", "関ヶ原", "Avogadro", "三角関数")
+
+
+def _list_items(n: int, rng: random.Random) -> List[dict]:
+    """crud.list_quizzes_page が返すのと同じ形の行"""
+    base = datetime(2024, 1, 1)
+    return [{
+        "id": i + 1,
+        "question": f"質問 {i}: " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14))),
+        "answer": rng.choice(WORDS),
+        "created_at": base + timedelta(seconds=rng.randint(0, 86400 * 365), microseconds=rng.randint(0, 999999)),
+        "attempts": rng.randint(0, 30),
+        "last_correct": rng.choice([None, True, False]),
+    } for i in range(n)]
+
+
+def _cpu_us(fn: Callable[[], object], repeat: int) -> float:
+    fn()
+    t = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - t) / repeat * 1e6
+
+
+def cmd_payload(args) -> int:
+    os.environ.setdefault("DATABASE_URL", "sqlite://")   # app の import に要るだけ（DB は使わない）
+    from app import schemas
+    from app.config import settings
+    from app.services import compression
+    from app.services.response_cache import serialize, orjson
+
+    rng = random.Random(args.seed)
+    encs = compression.available()
+    rows = []
+
+    def measure(name: str, body: bytes, gzip_level: int, brotli_quality: int) -> None:
+        row = {"payload": name, "identity_bytes": len(body)}
+        for enc in encs:
+            row[f"{enc}_bytes"] = len(compression.encode(body, enc, gzip_level, brotli_quality))
+            row[f"{enc}_cpu_us"] = round(_cpu_us(lambda: compression.encode(body, enc, gzip_level, brotli_quality), args.repeat), 1)
+        rows.append(row)
+
+    for n in (int(x) for x in args.sizes.split(",")):
+        items = _list_items(n, rng)
+        slow = serialize(schemas.QuizWithStatusList, items)
+        fast = serialize(schemas.QuizWithStatusList, items, trusted=True)
+        if slow != fast:
+            print(f"list[{n}]: fast path output differs from pydantic", file=sys.stderr)
+            return 1
+        measure(f"/quiz/list limit={n}", slow, settings.COMPRESS_GZIP_LEVEL, settings.COMPRESS_BROTLI_QUALITY)
+        rows[-1]["pydantic_cpu_us"] = round(_cpu_us(lambda: serialize(schemas.QuizWithStatusList, items), args.repeat), 1)
+        rows[-1]["orjson_cpu_us"] = round(_cpu_us(lambda: serialize(schemas.QuizWithStatusList, items, trusted=True), args.repeat), 1) if orjson else None
+
+    with open(os.path.join(ROOT, "index.html"), "rb") as f:
+        index = f.read()
+    measure("index.html", index, 9, 11)   # 事前圧縮の設定。圧縮は起動後の初回だけで、以降はメモリから返す
+
+    for r in rows:
+        line = f"{r['payload']:<28} identity {r['identity_bytes']:>9,} B"
+        for enc in encs:
+            pct = 100 * (1 - r[f"{enc}_bytes"] / r["identity_bytes"])
+            line += f" | {enc} {r[f'{enc}_bytes']:>8,} B (-{pct:.0f}%) {r[f'{enc}_cpu_us']:>8.0f} us"
+        if "pydantic_cpu_us" in r:
+            line += f" | serialize pydantic {r['pydantic_cpu_us']:.0f} us"
+            if r["orjson_cpu_us"] is not None:
+                line += f" / orjson {r['orjson_cpu_us']:.0f} us (x{r['pydantic_cpu_us'] / max(r['orjson_cpu_us'], 0.1):.1f})"
+        print(line)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"meta": {"git": _git_rev(), "python": platform.python_version(), "encodings": encs}, "payloads": rows},
+                      f, ensure_ascii=False, indent=2)
+        print(f"saved {args.save}")
+    return 0
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python tools/bench.py", description="負荷テスト・ベンチマーク")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    sp = sub.add_parser("seed", help="合成データを投入")
+    sp.add_argument("--db", default=DEFAULT_DB)
+    sp.add_argument("--scale", choices=list(SCALES), default="10k")
+    sp.add_argument("--seed", type=int, default=0)
+
+    rp = sub.add_parser("run", help="計測")
+    rp.add_argument("--db", default=DEFAULT_DB)
+    rp.add_argument("--driver", choices=["asgi", "http"], default="asgi")
+    rp.add_argument("--base-url", default="http://127.0.0.1:8000", help="http ドライバの接続先（--spawn なしのとき）")
+    rp.add_argument("--spawn", action="store_true", help="uvicorn を子プロセスで起動する")
+    rp.add_argument("--port", type=int, default=8765)
+    rp.add_argument("--workers", type=int, default=1)
+    rp.add_argument("-c", "--concurrency", type=int, default=16)
+    rp.add_argument("-n", "--requests", type=int, default=200, help="エンドポイントごとのリクエスト数")
+    rp.add_argument("--warmup", type=int, default=10)
+    rp.add_argument("--endpoints", default="", help="カンマ区切り（省略時は全部）: " + ",".join(ENDPOINTS))
+    rp.add_argument("--a1111-url", default="", help="省略時は tools/fake_a1111.py をプロセス内で起動")
+    rp.add_argument("--a1111-delay", type=float, default=0.0, help="スタブの擬似生成時間（秒）")
+    rp.add_argument("--seed", type=int, default=0)
+    rp.add_argument("--save", help="結果 JSON の保存先")
+    rp.add_argument("--compare", help="基準値 JSON")
+    rp.add_argument("--tolerance", type=float, default=0.25)
+
+    cp = sub.add_parser("compare", help="保存済み結果どうしを比較")
+    cp.add_argument("baseline")
+    cp.add_argument("current")
+    cp.add_argument("--tolerance", type=float, default=0.25)
+
+    pp = sub.add_parser("payload", help="シリアライズと圧縮のバイト数・CPU 時間")
+    pp.add_argument("--sizes", default="200,1000", help="一覧の件数（カンマ区切り）")
+    pp.add_argument("--repeat", type=int, default=50)
+    pp.add_argument("--seed", type=int, default=0)
+    pp.add_argument("--save", help="結果 JSON の保存先")
+
+    args = ap.parse_args(argv)
+    if args.command == "seed":
+        print(json.dumps(seed(args.db, args.scale, args.seed)))
+        return 0
+    if args.command == "run":
+        return cmd_run(args)
+    if args.command == "payload":
+        return cmd_payload(args)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    return _report_compare(args.baseline, current, args.tolerance)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
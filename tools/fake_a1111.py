@@ -0,0 +1,92 @@
+"""A1111 (/sdapi/v1/txt2img) のローカルスタブ
+
+GPU なしで画像生成まわりを動かすためのもの。小さな PNG を base64 で返す。
+
+    python tools/fake_a1111.py --port 7861 --delay 0.5
+    A1111_BASE_URL=http://127.0.0.1:7861 uvicorn run:app
+
+テストやベンチからは start_in_thread() で起動できる。
+"""
+import argparse
+import base64
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    """単色の PNG（依存ライブラリなし）"""
+    rnd = random.Random(seed)
+    rgb = bytes(rnd.randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + rgb * width for _ in range(height))
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+class FakeA1111Handler(BaseHTTPRequestHandler):
+    delay = 0.0        # 1リクエストあたりの擬似生成時間（秒）
+    fail_rate = 0.0    # 500 を返す確率
+    calls = 0
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        if self.path != "/sdapi/v1/txt2img":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with FakeA1111Handler._lock:
+            type(self).calls += 1   # server.RequestHandlerClass.calls で参照
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_rate and random.random() < self.fail_rate:
+            self.send_error(500, "fake failure")
+            return
+        w = int(payload.get("width", 512))
+        h = int(payload.get("height", 512))
+        png = make_png(w, h, seed=hash(payload.get("prompt")) & 0xFFFF)
+        body = json.dumps({
+            "images": [base64.b64encode(png).decode()],
+            "parameters": payload,
+            "info": "{}",
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_in_thread(port: int = 0, delay: float = 0.0, fail_rate: float = 0.0) -> ThreadingHTTPServer:
+    """バックグラウンドで起動し server を返す。base_url は f"http://127.0.0.1:{server.server_port}" """
+    handler = type("Handler", (FakeA1111Handler,), {"delay": delay, "fail_rate": fail_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake A1111 txt2img server")
+    ap.add_argument("--port", type=int, default=7861)
+    ap.add_argument("--delay", type=float, default=0.0)
+    ap.add_argument("--fail-rate", type=float, default=0.0)
+    args = ap.parse_args()
+    handler = type("Handler", (FakeA1111Handler,), {"delay": args.delay, "fail_rate": args.fail_rate})
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    print(f"fake A1111 listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()